@@ -3,6 +3,7 @@ CREATE TABLE setups (
     protocol_version CHARACTER VARYING NOT NULL,
     status CHARACTER VARYING NOT NULL,
     last_checked_block_height INTEGER NULL,
+    broadcast_checked_block_height INTEGER NULL,
     payload_txid CHARACTER VARYING,
     payload_tx CHARACTER VARYING,
     payload_output_index INTEGER,
@@ -25,6 +26,8 @@ CREATE TABLE templates (
     is_external BOOLEAN NOT NULL,
     unknown_txid BOOLEAN DEFAULT FALSE,
     fundable BOOLEAN DEFAULT FALSE,
+    -- Set when the wallet's inputs and change have been added to a fundable template
+    funded BOOLEAN NOT NULL DEFAULT FALSE,
     ordinal INTEGER NOT NULL,
     inputs JSONB NOT NULL,
     outputs JSONB NOT NULL,
@@ -47,3 +50,37 @@ CREATE TABLE received (
     index_in_block INTEGER NOT NULL
 );
 CREATE INDEX received_template_id_idx ON received (template_id);
+
+CREATE TABLE signatures (
+    setup_id CHARACTER VARYING NOT NULL,
+    template_name CHARACTER VARYING NOT NULL,
+    input_index INTEGER NOT NULL,
+    role CHARACTER VARYING NOT NULL,
+    signature CHARACTER VARYING NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (setup_id, template_name, input_index, role),
+    FOREIGN KEY (setup_id, template_name) REFERENCES templates (setup_id, name) ON DELETE CASCADE
+);
+
+CREATE TABLE scripts (
+    hash BYTEA PRIMARY KEY,
+    bytes BYTEA NOT NULL
+);
+
+-- Notify listeners (e.g. the python db_listener) about status changes, so they don't have to poll
+CREATE FUNCTION notify_status_change() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' OR OLD.status IS DISTINCT FROM NEW.status THEN
+        PERFORM pg_notify(
+            'bitsnark_status',
+            json_build_object('table', TG_TABLE_NAME, 'id', NEW.id, 'status', NEW.status)::text
+        );
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER setups_status_notify AFTER INSERT OR UPDATE OF status ON setups
+    FOR EACH ROW EXECUTE FUNCTION notify_status_change();
+CREATE TRIGGER templates_status_notify AFTER INSERT OR UPDATE OF status ON templates
+    FOR EACH ROW EXECUTE FUNCTION notify_status_change();
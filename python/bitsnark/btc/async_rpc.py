@@ -0,0 +1,345 @@
+"""
+asyncio counterpart of BitcoinRPC, for making many calls concurrently from a single thread.
+
+Only needs the standard library: it speaks just enough HTTP/1.1 (keep-alive, Content-Length or chunked
+responses) for bitcoind's RPC server.
+"""
+
+from __future__ import annotations
+import asyncio
+import base64
+import itertools
+import json
+import logging
+import typing
+import urllib.parse
+from dataclasses import dataclass
+from decimal import Decimal
+
+from bitcointx.core import CTransaction, CMutableTransaction, COutPoint, CTxOut
+from bitcointx.wallet import CCoinAddress
+
+from .rpc import (
+    DecimalJSONEncoder,
+    JSONRPCError,
+    RPCBatchCall,
+    ScanTxOutSetResponse,
+    TestMempoolAcceptFailure,
+    _get_result,
+    _set_batch_responses,
+    get_tx_hex,
+    get_vout_index,
+    parse_btc_amount_sat,
+)
+
+logger = logging.getLogger(__name__)
+
+_Connection = tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+@dataclass(frozen=True)
+class HTTPResponse:
+    "The parts of a requests.Response that JSONRPCError and the result parsing look at"
+
+    status_code: int
+    reason: str
+    text: str
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+
+class AsyncBitcoinRPC:
+    """
+    asyncio RPC client, with the same calls as BitcoinRPC (as coroutines).
+
+    Connections to the node are kept alive and reused. At most max_concurrency requests are in flight
+    at a time, the others wait for their turn, so that e.g. gathering thousands of calls doesn't
+    exceed the node's -rpcthreads and -rpcworkqueue. read_timeout is None by default, as some calls
+    (e.g. scantxoutset) can take a long time.
+
+    Unlike BitcoinRPC, nothing is cached and no latency stats are kept. Only http URLs are supported.
+    """
+
+    url: str
+
+    def __init__(
+        self,
+        url: str,
+        *,
+        max_concurrency: int = 10,
+        connect_timeout: float = 10,
+        read_timeout: float | None = None,
+    ):
+        self._id_count = itertools.count(1)
+        self.url = url
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._idle_connections: list[_Connection] = []
+
+        # parse the url
+        urlparts = urllib.parse.urlparse(url)
+        if urlparts.scheme != "http":
+            raise ValueError(f"Unsupported URL scheme: {urlparts.scheme!r}")
+        self._host = urlparts.hostname
+        self._port = urlparts.port or 80
+        path = urlparts.path or "/"
+        if urlparts.query:
+            path = f"{path}?{urlparts.query}"
+        headers = {
+            "Host": f"{self._host}:{self._port}",
+            "Content-Type": "application/json",
+            "Connection": "keep-alive",
+        }
+        if urlparts.username or urlparts.password:
+            credentials = "{}:{}".format(
+                urllib.parse.unquote(urlparts.username or ""),
+                urllib.parse.unquote(urlparts.password or ""),
+            )
+            headers["Authorization"] = (
+                f"Basic {base64.b64encode(credentials.encode()).decode()}"
+            )
+        self._request_head = f"POST {path} HTTP/1.1\r\n" + "".join(
+            f"{name}: {value}\r\n" for name, value in headers.items()
+        )
+
+    async def close(self):
+        connections, self._idle_connections = self._idle_connections, []
+        for _, writer in connections:
+            writer.close()
+        for _, writer in connections:
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def __aenter__(self) -> AsyncBitcoinRPC:
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def call(self, service_name: str, *args: typing.Any):
+        return await self._jsonrpc_call(service_name, args, parse_float=Decimal)
+
+    async def call_sats(self, service_name: str, *args: typing.Any):
+        "Like call, but parse all fractional numbers in the response as BTC amounts, see BitcoinRPC.call_sats"
+        return await self._jsonrpc_call(
+            service_name, args, parse_float=parse_btc_amount_sat
+        )
+
+    def batch(self) -> AsyncRPCBatch:
+        """
+        Collect calls and send them in a single HTTP request, see AsyncRPCBatch.
+        """
+        return AsyncRPCBatch(self)
+
+    async def _jsonrpc_call(self, method, params, *, parse_float=Decimal):
+        jsonrpc_data = self._make_request(method, params)
+        response, response_json = await self._post(
+            jsonrpc_data, parse_float=parse_float
+        )
+        return _get_result(
+            response_json,
+            response=response,
+            jsonrpc_data=jsonrpc_data,
+        )
+
+    async def _jsonrpc_batch(self, calls: list[RPCBatchCall]):
+        batch_data = [call.jsonrpc_data for call in calls]
+        response, response_json = await self._post(batch_data)
+        _set_batch_responses(
+            calls, response_json, response=response, jsonrpc_data=batch_data
+        )
+
+    def _make_request(self, method, params) -> dict:
+        return {
+            "jsonrpc": "2.0",
+            "id": next(self._id_count),
+            "method": method,
+            "params": params,
+        }
+
+    async def _post(self, jsonrpc_data: dict | list[dict], *, parse_float=Decimal):
+        body = json.dumps(
+            jsonrpc_data,
+            cls=DecimalJSONEncoder,
+        ).encode()
+        async with self._semaphore:
+            response = await self._request(body)
+
+        try:
+            response_json = json.loads(
+                response.text,
+                parse_float=parse_float,
+            )
+        except json.JSONDecodeError as e:
+            raise JSONRPCError(
+                message=str(e),
+                response=response,
+                jsonrpc_data=jsonrpc_data,
+            ) from e
+        return response, response_json
+
+    async def _request(self, body: bytes) -> HTTPResponse:
+        while self._idle_connections:
+            connection = self._idle_connections.pop()
+            if connection[0].at_eof():
+                connection[1].close()
+                continue
+            try:
+                return await self._send(connection, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # The node closed the idle connection before reading the request (e.g. after its
+                # -rpcservertimeout), so it's safe to send it again
+                logger.debug("Idle connection to the node was closed, reconnecting")
+        connection = await asyncio.wait_for(
+            asyncio.open_connection(self._host, self._port),
+            self._connect_timeout,
+        )
+        return await self._send(connection, body)
+
+    async def _send(self, connection: _Connection, body: bytes) -> HTTPResponse:
+        reader, writer = connection
+        keep_alive = False
+        try:
+            writer.write(
+                f"{self._request_head}Content-Length: {len(body)}\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+            async with asyncio.timeout(self._read_timeout):
+                response, keep_alive = await _read_response(reader)
+        finally:
+            if keep_alive:
+                self._idle_connections.append(connection)
+            else:
+                writer.close()
+        return response
+
+    async def scantxoutset(
+        self,
+        *,
+        address: str | CCoinAddress,
+    ) -> ScanTxOutSetResponse:
+        desc = f"addr({address})"
+        response = await self.call(
+            "scantxoutset",
+            "start",
+            [
+                desc,
+            ],
+        )
+        logger.info("scantxoutset: %s", response)
+        return response
+
+    async def find_vout_index(self, txid: str, address: str | CCoinAddress) -> int:
+        tx_response = await self.call("getrawtransaction", txid, True)
+        tx = CTransaction.deserialize(bytes.fromhex(tx_response["hex"]))
+        return get_vout_index(tx, txid, address)
+
+    async def test_mempoolaccept(
+        self, tx: str | bytes | CTransaction | CMutableTransaction
+    ) -> None:
+        response = await self.call("testmempoolaccept", [get_tx_hex(tx)])
+        if not response[0]["allowed"]:
+            raise TestMempoolAcceptFailure(response[0])
+
+    async def get_wallet_transaction(self, txid: str) -> CTransaction:
+        """Get a transaction from the wallet"""
+        tx_response = await self.call("gettransaction", txid)
+        return CTransaction.deserialize(bytes.fromhex(tx_response["hex"]))
+
+    async def get_output(self, outpoint: COutPoint) -> CTxOut:
+        """Get output, for example for spent_outputs. Only works if the RPC points to a wallet url"""
+        tx = await self.get_wallet_transaction(outpoint.hash[::-1].hex())
+        return tx.vout[outpoint.n]
+
+    async def get_outputs(self, outpoints: typing.Sequence[COutPoint]) -> list[CTxOut]:
+        """Like get_output, but for many outputs, fetching their transactions in a single batch"""
+        async with self.batch() as batch:
+            calls = {}
+            for outpoint in outpoints:
+                txid = outpoint.hash[::-1].hex()
+                if txid not in calls:
+                    calls[txid] = batch.call("gettransaction", txid)
+        txs = {
+            txid: CTransaction.deserialize(bytes.fromhex(call.result()["hex"]))
+            for txid, call in calls.items()
+        }
+        return [
+            txs[outpoint.hash[::-1].hex()].vout[outpoint.n] for outpoint in outpoints
+        ]
+
+
+class AsyncRPCBatch:
+    """
+    Like RPCBatch, for AsyncBitcoinRPC.
+
+        async with bitcoin_rpc.batch() as batch:
+            tx1 = batch.call("getrawtransaction", txid1, True)
+            tx2 = batch.call("getrawtransaction", txid2, True)
+        print(tx1.result(), tx2.result())
+    """
+
+    def __init__(self, bitcoin_rpc: AsyncBitcoinRPC):
+        self._bitcoin_rpc = bitcoin_rpc
+        self._calls: list[RPCBatchCall] = []
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def __aenter__(self) -> AsyncRPCBatch:
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.send()
+
+    def call(self, service_name: str, *args: typing.Any) -> RPCBatchCall:
+        call = RPCBatchCall(self._bitcoin_rpc._make_request(service_name, args))
+        self._calls.append(call)
+        return call
+
+    async def send(self) -> list[RPCBatchCall]:
+        calls, self._calls = self._calls, []
+        if calls:
+            await self._bitcoin_rpc._jsonrpc_batch(calls)
+        return calls
+
+
+async def _read_response(reader: asyncio.StreamReader) -> tuple[HTTPResponse, bool]:
+    "Read an HTTP response. Returns the response, and whether the connection can be reused."
+    status_line = (await reader.readuntil(b"\r\n")).decode("latin-1").rstrip("\r\n")
+    version, status_code, *reason = status_line.split(" ", 2)
+    headers = {}
+    while (line := await reader.readuntil(b"\r\n")) != b"\r\n":
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    keep_alive = (
+        version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+    )
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while chunk_size := int((await reader.readuntil(b"\r\n")).split(b";")[0], 16):
+            chunks.append((await reader.readexactly(chunk_size + 2))[:-2])
+        # Skip the trailers
+        while await reader.readuntil(b"\r\n") != b"\r\n":
+            pass
+        body = b"".join(chunks)
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:
+        # The body ends with the connection
+        body = await reader.read()
+        keep_alive = False
+
+    response = HTTPResponse(
+        status_code=int(status_code),
+        reason=reason[0] if reason else "",
+        text=body.decode("utf-8"),
+    )
+    return response, keep_alive
@@ -0,0 +1,80 @@
+"""Caching of RPC responses."""
+
+from __future__ import annotations
+import threading
+import time
+import typing
+from collections import OrderedDict
+from dataclasses import dataclass
+
+K = typing.TypeVar("K")
+V = typing.TypeVar("V")
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    hits: int
+    misses: int
+    size: int
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class LRUCache(typing.Generic[K, V]):
+    """
+    Thread-safe least-recently-used cache, with an optional time-to-live per entry.
+    Counts hits and misses of get().
+    """
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        # key -> (expiry time or None, value)
+        self._entries: OrderedDict[K, tuple[float | None, V]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: K) -> V | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or time.monotonic() < expires_at:
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return value
+                del self._entries[key]
+            self._misses += 1
+            return None
+
+    def put(self, key: K, value: V, *, ttl: float | None = None):
+        "Add an entry, that expires after ttl seconds (or only when evicted, if None)"
+        if self._maxsize <= 0:
+            return
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: K):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self._hits, misses=self._misses, size=len(self._entries)
+            )
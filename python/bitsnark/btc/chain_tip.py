@@ -0,0 +1,114 @@
+"""Wait for new blocks, with ZMQ notifications or waitfornewblock long-polling."""
+
+from __future__ import annotations
+import logging
+import threading
+import time
+
+from .rpc import BitcoinRPC, ChainTip
+
+try:
+    import zmq
+except ImportError:  # pragma: no cover
+    zmq = None
+
+logger = logging.getLogger(__name__)
+
+
+class ChainTipWatcher:
+    """
+    Keep track of the chain tip of the node and wait for it to change.
+
+    If zmq_url is given (the node's -zmqpubhashblock address) and pyzmq is installed, hashblock notifications
+    are used. Otherwise the node is long-polled with waitfornewblock, in chunks of at most long_poll_timeout
+    seconds (so that the HTTP request doesn't time out).
+
+    Thread-safe: the tip can be read from other threads while one thread waits.
+    """
+
+    def __init__(
+        self,
+        bitcoin_rpc: BitcoinRPC,
+        *,
+        zmq_url: str | None = None,
+        long_poll_timeout: float = 30,
+    ):
+        self._bitcoin_rpc = bitcoin_rpc
+        self._long_poll_timeout = long_poll_timeout
+        self._lock = threading.Lock()
+        self._tip: ChainTip | None = None
+
+        self._zmq_context = None
+        self._zmq_socket = None
+        if zmq_url:
+            if zmq is None:
+                logger.warning(
+                    "pyzmq is not installed, long-polling the node instead of using %s",
+                    zmq_url,
+                )
+            else:
+                self._zmq_context = zmq.Context()
+                self._zmq_socket = self._zmq_context.socket(zmq.SUB)
+                self._zmq_socket.setsockopt(zmq.SUBSCRIBE, b"hashblock")
+                self._zmq_socket.connect(zmq_url)
+                logger.info("Subscribed to new blocks at %s", zmq_url)
+
+    def close(self):
+        if self._zmq_socket is not None:
+            self._zmq_socket.close()
+            self._zmq_context.term()
+            self._zmq_socket = None
+            self._zmq_context = None
+
+    @property
+    def tip(self) -> ChainTip:
+        "The last seen chain tip (fetched from the node if not known yet)"
+        with self._lock:
+            tip = self._tip
+        if tip is None:
+            self.refresh()
+            with self._lock:
+                tip = self._tip
+        return tip
+
+    def refresh(self) -> ChainTip | None:
+        "Fetch the chain tip from the node. Returns it if it changed, otherwise None"
+        return self._update(self._bitcoin_rpc.get_chain_tip())
+
+    def wait(self, timeout: float) -> ChainTip | None:
+        """
+        Block until the chain tip changes or timeout seconds have passed.
+        Returns the new tip, or None on timeout.
+        """
+        # A block might have arrived after the last wait returned
+        new_tip = self.refresh()
+        if new_tip is not None:
+            return new_tip
+
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            if self._zmq_socket is not None:
+                if not self._zmq_socket.poll(remaining * 1000):
+                    return None
+                # Only the tip is interesting, so discard all queued notifications
+                while self._zmq_socket.poll(0):
+                    self._zmq_socket.recv_multipart()
+                new_tip = self.refresh()
+            else:
+                new_tip = self._update(
+                    self._bitcoin_rpc.wait_for_new_block(
+                        min(remaining, self._long_poll_timeout)
+                    )
+                )
+            if new_tip is not None:
+                return new_tip
+        return None
+
+    def _update(self, tip: ChainTip) -> ChainTip | None:
+        with self._lock:
+            if tip == self._tip:
+                return None
+            if self._tip is not None:
+                logger.info("New block %s at height %d", tip.hash, tip.height)
+            self._tip = tip
+        return tip
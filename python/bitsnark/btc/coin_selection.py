@@ -0,0 +1,293 @@
+"""Fee-aware coin selection with incremental transaction weight estimation."""
+
+from __future__ import annotations
+import copy
+import math
+import typing
+from dataclasses import dataclass
+from decimal import Decimal
+from fractions import Fraction
+
+from bitcointx.core import CTransaction, CTxOut
+
+from .utxos import WalletUTXO
+
+WITNESS_SCALE_FACTOR = 4
+DUST_LIMIT_SAT = 546
+# Non-witness part of any input: prevout (32 + 4), scriptSig length (1), sequence (4)
+_INPUT_BASE_SIZE = 32 + 4 + 1 + 4
+# Weights of spending the different kinds of wallet coins, with the largest possible signatures
+P2TR_INPUT_WEIGHT = _INPUT_BASE_SIZE * 4 + (1 + 1 + 65)
+P2WPKH_INPUT_WEIGHT = _INPUT_BASE_SIZE * 4 + (1 + 1 + 72 + 1 + 33)
+P2SH_P2WPKH_INPUT_WEIGHT = (_INPUT_BASE_SIZE + 23) * 4 + (1 + 1 + 72 + 1 + 33)
+# Also used for unknown script types, as the largest. The empty witness still takes a byte in a segwit tx.
+P2PKH_INPUT_WEIGHT = (_INPUT_BASE_SIZE + 1 + 72 + 1 + 33) * 4 + 1
+# A P2TR change output: amount (8), script length (1), script (34)
+CHANGE_OUTPUT_WEIGHT = (8 + 1 + 34) * 4
+# Input count varint grows from 1 to 3 bytes at this many inputs
+_LARGE_INPUT_COUNT = 0xFD
+# Max number of branches to explore looking for a changeless solution
+BNB_MAX_TRIES = 100_000
+
+
+class InsufficientFunds(Exception):
+    pass
+
+
+def get_transaction_weight(tx: CTransaction) -> int:
+    "Weight of a transaction: its size without witness data counts 4 times, the witness data once"
+    return len(tx.serialize(include_witness=False)) * (WITNESS_SCALE_FACTOR - 1) + len(
+        tx.serialize()
+    )
+
+
+def get_output_weight(txout: CTxOut) -> int:
+    return len(txout.serialize()) * WITNESS_SCALE_FACTOR
+
+
+def estimate_input_weight(script_pubkey: bytes) -> int:
+    "Weight of an input spending an output with the script_pubkey, including its (largest possible) witness"
+    if len(script_pubkey) == 34 and script_pubkey[:2] == b"\x51\x20":
+        return P2TR_INPUT_WEIGHT
+    if len(script_pubkey) == 22 and script_pubkey[:2] == b"\x00\x14":
+        return P2WPKH_INPUT_WEIGHT
+    if (
+        len(script_pubkey) == 23
+        and script_pubkey[:2] == b"\xa9\x14"
+        and script_pubkey[-1:] == b"\x87"
+    ):
+        return P2SH_P2WPKH_INPUT_WEIGHT
+    return P2PKH_INPUT_WEIGHT
+
+
+@dataclass(frozen=True)
+class CoinSelection:
+    utxos: list[WalletUTXO]
+    # Estimated weight of the funded transaction
+    weight: int
+    fee_sat: int
+    # 0 if there is no change output
+    change_sat: int
+
+    @property
+    def vsize(self) -> int:
+        return math.ceil(self.weight / WITNESS_SCALE_FACTOR)
+
+    @property
+    def has_change(self) -> bool:
+        return self.change_sat > 0
+
+
+class CoinSelector:
+    """
+    Select coins to fund a (segwit) transaction at a fee rate.
+
+    base_weight and base_value_sat describe the transaction before funding: its weight, and the value of its
+    inputs minus the value of its outputs (usually around zero or negative). The weight of the funded
+    transaction is tracked incrementally from per-input and per-output weights, so selection is linear
+    in the number of coins (plus a bounded branch and bound search).
+
+    First tries to find coins that cover the fee without a change output (branch and bound), as that makes
+    the transaction smaller. Otherwise coins are added in the given order until the fee and a change output
+    are covered. A change smaller than min_change_sat is left to the fee instead. With require_change,
+    only selections with a change output are made (e.g. when the change is the only output).
+    """
+
+    def __init__(
+        self,
+        *,
+        fee_rate_sat_per_vb: int | Decimal | Fraction,
+        base_weight: int,
+        base_value_sat: int,
+        base_num_inputs: int = 1,
+        min_change_sat: int = DUST_LIMIT_SAT + 1,
+        change_output_weight: int = CHANGE_OUTPUT_WEIGHT,
+        bnb_max_tries: int = BNB_MAX_TRIES,
+        require_change: bool = False,
+    ):
+        self._fee_rate = Fraction(fee_rate_sat_per_vb)
+        self._base_weight = base_weight
+        self._base_value_sat = base_value_sat
+        self._base_num_inputs = base_num_inputs
+        self._min_change_sat = min_change_sat
+        self._change_output_weight = change_output_weight
+        self._bnb_max_tries = bnb_max_tries
+        self._require_change = require_change
+
+    @property
+    def fee_rate(self) -> Fraction:
+        "In sat/vB"
+        return self._fee_rate
+
+    def with_fee_rate(
+        self, fee_rate_sat_per_vb: int | Decimal | Fraction
+    ) -> CoinSelector:
+        "Copy of the selector, for the same transaction at another fee rate"
+        selector = copy.copy(self)
+        selector._fee_rate = Fraction(fee_rate_sat_per_vb)
+        return selector
+
+    def fee_for_weight(self, weight: int) -> int:
+        return math.ceil(
+            self._fee_rate * math.ceil(Fraction(weight, WITNESS_SCALE_FACTOR))
+        )
+
+    def effective_value(self, utxo: WalletUTXO) -> int:
+        "Value of the coin minus the fee of spending it (rounded up, to never underpay)"
+        return utxo.amount_sat - math.ceil(
+            self._fee_rate
+            * Fraction(estimate_input_weight(utxo.script_pubkey), WITNESS_SCALE_FACTOR)
+        )
+
+    def single_coin_amount_sat(self, script_pubkey: bytes) -> int:
+        "Smallest value of a coin with the script_pubkey that funds the transaction alone, without change"
+        input_weight = estimate_input_weight(script_pubkey)
+        target = self.fee_for_weight(self._base_weight) - self._base_value_sat
+        return max(
+            target
+            + math.ceil(self._fee_rate * Fraction(input_weight, WITNESS_SCALE_FACTOR)),
+            self.fee_for_weight(self._base_weight + input_weight)
+            - self._base_value_sat,
+            # Must not be dust itself
+            self._min_change_sat,
+        )
+
+    def select(self, utxos: typing.Sequence[WalletUTXO]) -> CoinSelection:
+        """
+        Select coins from utxos, which are in order of preference (e.g. oldest first).
+        Raises InsufficientFunds if they are not enough.
+        """
+        candidates = []
+        for utxo in utxos:
+            effective_value = self.effective_value(utxo)
+            # Coins that cost more to spend than they are worth are never selected
+            if effective_value > 0:
+                candidates.append((utxo, effective_value))
+
+        target = self.fee_for_weight(self._base_weight) - self._base_value_sat
+        change_fee = math.ceil(
+            self._fee_rate * Fraction(self._change_output_weight, WITNESS_SCALE_FACTOR)
+        )
+
+        if not self._require_change:
+            if target <= 0:
+                # Nothing to fund
+                return self._make_selection([], with_change=False)
+
+            # Changeless: the excess (that goes to the fee) must be less than what adding change would cost
+            changeless = _branch_and_bound(
+                [effective_value for _, effective_value in candidates],
+                lower=target,
+                upper=target + change_fee + self._min_change_sat - 1,
+                max_tries=self._bnb_max_tries,
+            )
+            if changeless is not None:
+                selection = self._make_selection(
+                    [candidates[i][0] for i in changeless], with_change=False
+                )
+                if selection is not None:
+                    return selection
+
+        selected = []
+        total = 0
+        remaining_candidates = iter(candidates)
+        while True:
+            if total >= target + change_fee:
+                with_change = total >= target + change_fee + self._min_change_sat
+                if with_change or not self._require_change:
+                    selection = self._make_selection(selected, with_change=with_change)
+                    if selection is not None:
+                        return selection
+            candidate = next(remaining_candidates, None)
+            if candidate is None:
+                break
+            utxo, effective_value = candidate
+            selected.append(utxo)
+            total += effective_value
+
+        raise InsufficientFunds(
+            f"Coins with a total effective value of {total} sat are not enough for {target + change_fee} sat"
+        )
+
+    def _make_selection(
+        self, utxos: list[WalletUTXO], *, with_change: bool
+    ) -> CoinSelection | None:
+        "Calculate the exact fee and change of the selection, or return None if it doesn't cover the fee"
+        weight = self._base_weight + sum(
+            estimate_input_weight(utxo.script_pubkey) for utxo in utxos
+        )
+        if (
+            self._base_num_inputs
+            < _LARGE_INPUT_COUNT
+            <= self._base_num_inputs + len(utxos)
+        ):
+            weight += 2 * WITNESS_SCALE_FACTOR
+        if with_change:
+            weight += self._change_output_weight
+        available_sat = self._base_value_sat + sum(utxo.amount_sat for utxo in utxos)
+        fee_sat = self.fee_for_weight(weight)
+        if available_sat < fee_sat:
+            return None
+        if with_change:
+            change_sat = available_sat - fee_sat
+            if change_sat < self._min_change_sat:
+                return None
+        else:
+            change_sat = 0
+            fee_sat = available_sat
+        return CoinSelection(
+            utxos=utxos, weight=weight, fee_sat=fee_sat, change_sat=change_sat
+        )
+
+
+def _branch_and_bound(
+    values: list[int], *, lower: int, upper: int, max_tries: int
+) -> list[int] | None:
+    """
+    Find the indices of values that sum up to between lower and upper (inclusive), as close to lower as
+    possible, exploring at most max_tries branches. Returns None if there is no such subset (or it
+    wasn't found in time).
+    """
+    # Bigger values first, so that solutions are found (and branches pruned) early
+    order = sorted(range(len(values)), key=lambda i: values[i], reverse=True)
+    sorted_values = [values[i] for i in order]
+    remaining = [0] * (len(values) + 1)
+    for i in reversed(range(len(values))):
+        remaining[i] = remaining[i + 1] + sorted_values[i]
+    if remaining[0] < lower:
+        return None
+
+    best = None
+    best_excess = None
+    included = []
+    total = 0
+    i = 0
+    for _ in range(max_tries):
+        if total > upper or total + remaining[i] < lower:
+            backtrack = True
+        elif total >= lower:
+            excess = total - lower
+            if best is None or excess < best_excess:
+                best = list(included)
+                best_excess = excess
+                if excess == 0:
+                    break
+            backtrack = True
+        else:
+            backtrack = False
+
+        if backtrack:
+            if not included:
+                break
+            # Explore the branch without the last included value
+            last = included.pop()
+            total -= sorted_values[last]
+            i = last + 1
+        else:
+            included.append(i)
+            total += sorted_values[i]
+            i += 1
+
+    if best is None:
+        return None
+    return [order[i] for i in best]
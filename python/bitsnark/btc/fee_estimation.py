@@ -0,0 +1,136 @@
+"""Fee rate estimates of the node, cached per block."""
+
+from __future__ import annotations
+import logging
+import threading
+import typing
+from dataclasses import dataclass
+from decimal import Decimal
+from fractions import Fraction
+
+from .chain_tip import ChainTipWatcher
+from .rpc import COIN, BitcoinRPC
+
+logger = logging.getLogger(__name__)
+
+# Confirmation targets (in blocks) to get estimates for
+DEFAULT_CONF_TARGETS = (1, 2, 3, 6, 12, 24, 144)
+# Target for transactions without a deadline
+DEFAULT_ROUTINE_CONF_TARGET = 6
+
+
+def btc_per_kvb_to_sat_per_vb(fee_rate: Decimal) -> Fraction:
+    return Fraction(fee_rate) * COIN / 1000
+
+
+@dataclass(frozen=True)
+class FeeEstimates:
+    "Estimates of the node at a chain tip"
+
+    tip_hash: str
+    # Confirmation target -> fee rate (sat/vB), for the targets the node has estimates for
+    fee_rates: dict[int, Fraction]
+    # Minimum fee rate for getting into the mempool of the node (sat/vB)
+    min_fee_rate: Fraction
+
+
+class FeeEstimator:
+    """
+    Fee rates for confirming within a number of blocks, from estimatesmartfee.
+
+    Estimates only change with new blocks, so the estimates for all conf_targets are fetched together
+    (in one batched request) once per block. If a chain_tip_watcher is given, its tip is used to notice
+    new blocks, otherwise the node is asked for the best block hash.
+
+    Fee rates are never below the minimum of the node's mempool. If the node has no estimates
+    (e.g. on regtest, or right after starting), fallback_fee_rate_sat_per_vb is used.
+
+    Thread-safe.
+    """
+
+    def __init__(
+        self,
+        bitcoin_rpc: BitcoinRPC,
+        *,
+        fallback_fee_rate_sat_per_vb: int | Decimal | Fraction,
+        chain_tip_watcher: ChainTipWatcher | None = None,
+        conf_targets: typing.Sequence[int] = DEFAULT_CONF_TARGETS,
+        routine_conf_target: int = DEFAULT_ROUTINE_CONF_TARGET,
+    ):
+        self._bitcoin_rpc = bitcoin_rpc
+        self._fallback_fee_rate = Fraction(fallback_fee_rate_sat_per_vb)
+        self._chain_tip_watcher = chain_tip_watcher
+        self._conf_targets = tuple(conf_targets)
+        self._routine_conf_target = routine_conf_target
+        self._lock = threading.Lock()
+        self._estimates: FeeEstimates | None = None
+
+    def get_estimates(self) -> FeeEstimates:
+        "Estimates at the current chain tip"
+        if self._chain_tip_watcher is not None:
+            tip_hash = self._chain_tip_watcher.tip.hash
+        else:
+            tip_hash = self._bitcoin_rpc.call("getbestblockhash")
+        with self._lock:
+            if self._estimates is not None and self._estimates.tip_hash == tip_hash:
+                return self._estimates
+
+        with self._bitcoin_rpc.batch() as batch:
+            estimate_calls = [
+                batch.call("estimatesmartfee", conf_target)
+                for conf_target in self._conf_targets
+            ]
+            mempool_info_call = batch.call("getmempoolinfo")
+
+        fee_rates = {}
+        for estimate_call in estimate_calls:
+            estimate = estimate_call.result()
+            if "feerate" not in estimate:
+                # Not enough data for the target
+                continue
+            # The node might have estimated for a higher target than asked for
+            conf_target = estimate["blocks"]
+            fee_rate = btc_per_kvb_to_sat_per_vb(estimate["feerate"])
+            fee_rates[conf_target] = min(fee_rate, fee_rates.get(conf_target, fee_rate))
+        mempool_info = mempool_info_call.result()
+        estimates = FeeEstimates(
+            tip_hash=tip_hash,
+            fee_rates=dict(sorted(fee_rates.items())),
+            min_fee_rate=btc_per_kvb_to_sat_per_vb(
+                max(mempool_info["mempoolminfee"], mempool_info["minrelaytxfee"])
+            ),
+        )
+        logger.debug(
+            "Fee estimates at %s: %s (min %.1f sat/vB)",
+            tip_hash,
+            {
+                conf_target: f"{float(fee_rate):.1f}"
+                for conf_target, fee_rate in estimates.fee_rates.items()
+            },
+            estimates.min_fee_rate,
+        )
+        with self._lock:
+            self._estimates = estimates
+        return estimates
+
+    def get_fee_rate(self, conf_target: int) -> Fraction:
+        "Fee rate (sat/vB) for confirming within conf_target blocks"
+        estimates = self.get_estimates()
+        fee_rate = self._fallback_fee_rate
+        if estimates.fee_rates:
+            # The cheapest estimate that still confirms in time, or the fastest one if none does
+            in_time = [
+                target for target in estimates.fee_rates if target <= conf_target
+            ]
+            target = in_time[-1] if in_time else next(iter(estimates.fee_rates))
+            fee_rate = estimates.fee_rates[target]
+        return max(fee_rate, estimates.min_fee_rate)
+
+    def get_fee_rate_for_deadline(self, blocks_left: int | None) -> Fraction:
+        """
+        Fee rate (sat/vB) for a transaction that must confirm within blocks_left blocks
+        (or None if it has no deadline, to use the routine target).
+        """
+        if blocks_left is None:
+            return self.get_fee_rate(self._routine_conf_target)
+        return self.get_fee_rate(max(1, blocks_left))
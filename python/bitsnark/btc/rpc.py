@@ -1,18 +1,27 @@
+from __future__ import annotations
 import logging
 import decimal
+import itertools
 import json
+import threading
 import time
 import typing
 import urllib.parse
+from dataclasses import dataclass, replace
 from decimal import Decimal
 
 from bitcointx.core import CTransaction, CMutableTransaction, COutPoint, CTxOut
 from bitcointx.wallet import CCoinAddress
 import requests
+from requests.adapters import HTTPAdapter
+
+from .cache import CacheStats, LRUCache
 
 
 logger = logging.getLogger(__name__)
 
+COIN = 100_000_000
+
 
 class ScanTxOutSetUtxo(typing.TypedDict):
     txid: str
@@ -32,6 +41,31 @@ class ScanTxOutSetResponse(typing.TypedDict):
     total_amount: Decimal
 
 
+@dataclass(frozen=True)
+class ChainTip:
+    hash: str
+    height: int
+
+
+@dataclass
+class MethodStats:
+    "Latency stats of calls to one RPC method"
+
+    calls: int = 0
+    errors: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+    @property
+    def mean_seconds(self) -> float:
+        return self.total_seconds / self.calls if self.calls else 0.0
+
+
+# Error codes of the node (JSONRPCError.code)
+RPC_METHOD_NOT_FOUND = -32601
+RPC_INVALID_ADDRESS_OR_KEY = -5
+
+
 class JSONRPCError(requests.HTTPError):
     def __init__(
         self, *, message, code=None, request=None, response=None, jsonrpc_data=None
@@ -62,13 +96,47 @@ class TestMempoolAcceptFailure(Exception):
 
 
 class BitcoinRPC:
-    """Requests-based RPC client, because bitcointx.rpc.RPCCaller is riddled with cryptic http errors"""
+    """
+    Requests-based RPC client, because bitcointx.rpc.RPCCaller is riddled with cryptic http errors
+
+    Connections to the node are kept alive and pooled, so the client can be shared between threads.
+    At most pool_size requests are made concurrently, other threads wait for a free connection.
+    read_timeout is None by default, as some calls (e.g. scantxoutset) can take a long time.
+
+    Transactions and blocks fetched by the helper methods (get_output, find_vout_index, get_block...)
+    are cached. The contents of a transaction never change, so confirmed transactions are cached until
+    evicted. Transactions only in the mempool (which might be replaced) are cached for at most
+    mempool_cache_ttl seconds, and dropped as soon as a new chain tip is seen -- as are block hashes
+    by height, which change on a reorg. Pass cache sizes of 0 to disable caching.
+    """
 
     url: str
 
-    def __init__(self, url: str):
-        self._id_count = 0
+    def __init__(
+        self,
+        url: str,
+        *,
+        pool_size: int = 10,
+        connect_timeout: float = 10,
+        read_timeout: float | None = None,
+        tx_cache_size: int = 1000,
+        block_cache_size: int = 16,
+        mempool_cache_ttl: float = 30,
+    ):
+        self._id_count = itertools.count(1)
         self.url = url  # so that it can be retrieved from this
+        self._timeout = (connect_timeout, read_timeout)
+        self._stats: dict[str, MethodStats] = {}
+        self._stats_lock = threading.Lock()
+
+        self._tx_cache: LRUCache[str, CTransaction] = LRUCache(tx_cache_size)
+        self._block_cache: LRUCache[str, dict] = LRUCache(block_cache_size)
+        self._block_hash_cache: LRUCache[int, str] = LRUCache(tx_cache_size)
+        self._mempool_cache_ttl = mempool_cache_ttl
+        # Cached txids of transactions that were not confirmed yet
+        self._mempool_txids: set[str] = set()
+        self._tip_hash: str | None = None
+        self._tip_lock = threading.Lock()
 
         # parse the url
         urlparts = urllib.parse.urlparse(url)
@@ -92,30 +160,141 @@ class BitcoinRPC:
             )
         )
 
+        self._session = requests.Session()
+        self._session.auth = self._auth
+        self._session.headers["Content-Type"] = "application/json"
+        # pool_block: wait for a free connection instead of opening (and throwing away) extra ones
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, pool_block=True
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def close(self):
+        self._session.close()
+
+    def __enter__(self) -> BitcoinRPC:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     # Interface to any service call
     def call(self, service_name: str, *args: typing.Any):
-        return self._jsonrpc_call(service_name, args)
+        return self._timed_call(service_name, args, parse_float=Decimal)
 
-    def _jsonrpc_call(self, method, params):
-        self._id_count += 1
+    def call_sats(self, service_name: str, *args: typing.Any):
+        """
+        Like call, but parse all fractional numbers in the response as BTC amounts, to integer satoshis.
 
-        jsonrpc_data = {
+        Avoids constructing Decimals (and converting them later) for large responses, but only use it for methods whose
+        fractional numbers are all amounts (e.g. listunspent or scantxoutset, but not getblock, whose
+        difficulty is a float). Integers are left as they are (bitcoind always formats amounts with decimals).
+        """
+        return self._timed_call(service_name, args, parse_float=parse_btc_amount_sat)
+
+    def _timed_call(
+        self,
+        service_name: str,
+        args: tuple,
+        *,
+        parse_float: typing.Callable[[str], typing.Any],
+    ):
+        start = time.perf_counter()
+        failed = True
+        try:
+            ret = self._jsonrpc_call(service_name, args, parse_float=parse_float)
+            failed = False
+            return ret
+        finally:
+            self._record_call(service_name, time.perf_counter() - start, failed=failed)
+
+    def get_stats(self) -> dict[str, MethodStats]:
+        "Latency stats of the calls made so far, by RPC method"
+        with self._stats_lock:
+            return {method: replace(stats) for method, stats in self._stats.items()}
+
+    def get_cache_stats(self) -> dict[str, CacheStats]:
+        "Hit/miss counts of the caches"
+        return {
+            "transactions": self._tx_cache.stats,
+            "blocks": self._block_cache.stats,
+            "block_hashes": self._block_hash_cache.stats,
+        }
+
+    def log_stats(self, level: int = logging.INFO):
+        for name, cache_stats in self.get_cache_stats().items():
+            logger.log(
+                level,
+                "RPC %s cache: %d hits, %d misses (%.0f%% hit rate), %d entries",
+                name,
+                cache_stats.hits,
+                cache_stats.misses,
+                cache_stats.hit_rate * 100,
+                cache_stats.size,
+            )
+        stats = self.get_stats()
+        for method, method_stats in sorted(
+            stats.items(), key=lambda item: item[1].total_seconds, reverse=True
+        ):
+            logger.log(
+                level,
+                "RPC %s: %d calls (%d errors), %.3fs total, %.1fms mean, %.1fms max",
+                method,
+                method_stats.calls,
+                method_stats.errors,
+                method_stats.total_seconds,
+                method_stats.mean_seconds * 1000,
+                method_stats.max_seconds * 1000,
+            )
+
+    def _record_call(self, method: str, seconds: float, *, failed: bool):
+        with self._stats_lock:
+            stats = self._stats.setdefault(method, MethodStats())
+            stats.calls += 1
+            stats.errors += failed
+            stats.total_seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+
+    def _jsonrpc_call(self, method, params, *, parse_float=Decimal):
+        jsonrpc_data = self._make_request(method, params)
+        response, response_json = self._post(jsonrpc_data, parse_float=parse_float)
+        return _get_result(
+            response_json,
+            response=response,
+            jsonrpc_data=jsonrpc_data,
+        )
+
+    def _jsonrpc_batch(self, calls: list[RPCBatchCall]):
+        start = time.perf_counter()
+        failed = True
+        try:
+            batch_data = [call.jsonrpc_data for call in calls]
+            response, response_json = self._post(batch_data)
+            _set_batch_responses(
+                calls, response_json, response=response, jsonrpc_data=batch_data
+            )
+            failed = False
+        finally:
+            self._record_call("batch", time.perf_counter() - start, failed=failed)
+
+    def _make_request(self, method, params) -> dict:
+        return {
             "jsonrpc": "2.0",
-            "id": self._id_count,
+            "id": next(self._id_count),
             "method": method,
             "params": params,
         }
+
+    def _post(self, jsonrpc_data: dict | list[dict], *, parse_float=Decimal):
         postdata = json.dumps(
             jsonrpc_data,
             cls=DecimalJSONEncoder,
         )
-        response = requests.post(
+        response = self._session.post(
             self._url,
             data=postdata,
-            auth=self._auth,
-            headers={
-                "Content-Type": "application/json",
-            },
+            timeout=self._timeout,
         )
 
         # Don't raise here, we want sane error messages
@@ -131,7 +310,7 @@ class BitcoinRPC:
         try:
             response_json = json.loads(
                 response.text,
-                parse_float=Decimal,
+                parse_float=parse_float,
             )
         except json.JSONDecodeError as e:
             raise JSONRPCError(
@@ -139,43 +318,116 @@ class BitcoinRPC:
                 response=response,
                 jsonrpc_data=jsonrpc_data,
             ) from e
-        error = response_json.get("error")
-        if error is not None or not response.ok:
-            if isinstance(error, dict):
-                raise JSONRPCError(
-                    message=error["message"],
-                    code=error["code"],
-                    response=response,
-                    jsonrpc_data=jsonrpc_data,
-                )
-            raise JSONRPCError(
-                message=str(error),
-                response=response,
-                jsonrpc_data=jsonrpc_data,
-            )
-        if "result" not in response_json:
-            raise JSONRPCError(
-                message="No result in response",
-                response=response,
-                jsonrpc_data=jsonrpc_data,
-            )
-        return response_json["result"]
+        return response, response_json
+
+    def batch(self) -> RPCBatch:
+        """
+        Collect calls and send them in a single HTTP request, see RPCBatch.
+        """
+        return RPCBatch(self)
 
     def mine_blocks(
-        self, num: int = 1, to_address: str = None, *, sleep: float = 1.1
+        self,
+        num: int = 1,
+        to_address: str = None,
+        *,
+        sleep: float = 0,
+        sync: bool = True,
     ) -> list[str]:
-        # Regtest only: mine blocks
+        """
+        Regtest only: mine blocks.
+
+        When this returns the blocks are connected. With sync, the wallet (and everything else
+        notified of new blocks inside the node) has processed them too. Other processes following the
+        chain (e.g. the listeners of the agents) should be waited for on their own condition, see
+        core.readiness. sleep is an additional fixed delay, for callers that can't do that.
+        """
         if to_address is None:
             # Use a random address if none is provided (not important)
             to_address = (
                 "bcrt1qtxysk2megp39dnpw9va32huk5fesrlvutl0zdpc29asar4hfkrlqs2kzv5"
             )
         ret = self.call("generatetoaddress", num, to_address)
+        if sync:
+            self.sync_with_validation_queue()
         if sleep:
-            # Sleep here by default, otherwise the tap nodes will not have time to process the block(s)
             time.sleep(sleep)
         return ret
 
+    def sync_with_validation_queue(self):
+        """
+        Wait until the node has notified (e.g. its wallets) of all the blocks and transactions it
+        has processed. Does nothing on nodes without the (hidden) syncwithvalidationinterfacequeue RPC.
+        """
+        try:
+            self.call("syncwithvalidationinterfacequeue")
+        except JSONRPCError as e:
+            if e.code != RPC_METHOD_NOT_FOUND:
+                raise
+
+    def get_chain_tip(self) -> ChainTip:
+        block_hash = self.call("getbestblockhash")
+        header = self.call("getblockheader", block_hash)
+        tip = ChainTip(hash=block_hash, height=header["height"])
+        self._observe_tip(tip)
+        return tip
+
+    def wait_for_new_block(self, timeout: float) -> ChainTip:
+        """
+        Long-poll the node until a new block arrives or timeout seconds have passed.
+        Returns the chain tip in either case.
+        """
+        response = self.call("waitfornewblock", int(timeout * 1000))
+        tip = ChainTip(hash=response["hash"], height=response["height"])
+        self._observe_tip(tip)
+        return tip
+
+    def invalidate_tip_dependent_caches(self):
+        "Drop cached data that can change when a block arrives (or on a reorg)"
+        with self._tip_lock:
+            mempool_txids, self._mempool_txids = self._mempool_txids, set()
+        for txid in mempool_txids:
+            self._tx_cache.discard(txid)
+        self._block_hash_cache.clear()
+
+    def _observe_tip(self, tip: ChainTip):
+        with self._tip_lock:
+            changed = self._tip_hash is not None and self._tip_hash != tip.hash
+            self._tip_hash = tip.hash
+        if changed:
+            self.invalidate_tip_dependent_caches()
+
+    def get_block_hash(self, height: int) -> str:
+        block_hash = self._block_hash_cache.get(height)
+        if block_hash is None:
+            block_hash = self.call("getblockhash", height)
+            self._block_hash_cache.put(height, block_hash)
+        return block_hash
+
+    def get_block(self, block_hash: str) -> dict:
+        """
+        getblock with verbosity 1 (txids only). The fields that change with the chain tip
+        (confirmations, nextblockhash) are left out, as the block is cached.
+        """
+        block = self._block_cache.get(block_hash)
+        if block is None:
+            block = self.call("getblock", block_hash, 1)
+            for key in ("confirmations", "nextblockhash"):
+                block.pop(key, None)
+            self._block_cache.put(block_hash, block)
+        return block
+
+    def _cache_transaction(self, txid: str, tx_response: dict) -> CTransaction:
+        "Deserialize and cache a (gettransaction or verbose getrawtransaction) response"
+        tx = CTransaction.deserialize(bytes.fromhex(tx_response["hex"]))
+        if tx_response.get("confirmations", 0) > 0:
+            self._tx_cache.put(txid, tx)
+        else:
+            with self._tip_lock:
+                self._mempool_txids.add(txid)
+            self._tx_cache.put(txid, tx, ttl=self._mempool_cache_ttl)
+        return tx
+
     def scantxoutset(
         self,
         *,
@@ -202,40 +454,26 @@ class BitcoinRPC:
         return response["total_amount"]
 
     def find_vout_index(self, txid: str, address: str | CCoinAddress) -> int:
-        candidates = []
-        tx = self.call("getrawtransaction", txid, True)
-        for out in tx["vout"]:
-            if out["scriptPubKey"]["address"] == str(address):
-                candidates.append(out["n"])
-        if not candidates:
-            raise LookupError(f"No outputs to {address} in tx {txid}")
-        if len(candidates) > 1:
-            raise LookupError(
-                f"Multiple outputs to {address} in tx {txid}: {candidates}"
+        tx = self._tx_cache.get(txid)
+        if tx is None:
+            tx = self._cache_transaction(
+                txid, self.call("getrawtransaction", txid, True)
             )
-        return candidates[0]
+        return get_vout_index(tx, txid, address)
 
     def test_mempoolaccept(
         self, tx: str | bytes | CTransaction | CMutableTransaction
     ) -> None:
-        if isinstance(tx, (CTransaction, CMutableTransaction)):
-            tx = tx.serialize().hex()
-        elif isinstance(tx, bytes):
-            tx = tx.hex()
-        else:
-            if not isinstance(tx, str):
-                raise ValueError(
-                    "tx must be either a CTransaction, CMutableTransaction, bytes, or str"
-                )
-        response = self.call("testmempoolaccept", [tx])
+        response = self.call("testmempoolaccept", [get_tx_hex(tx)])
         if not response[0]["allowed"]:
             raise TestMempoolAcceptFailure(response[0])
 
     def get_wallet_transaction(self, txid: str) -> CTransaction:
         """Get a transaction from the wallet"""
-        tx_response = self.call("gettransaction", txid)
-        tx_hex = tx_response["hex"]
-        return CTransaction.deserialize(bytes.fromhex(tx_hex))
+        tx = self._tx_cache.get(txid)
+        if tx is None:
+            tx = self._cache_transaction(txid, self.call("gettransaction", txid))
+        return tx
 
     def get_output(self, outpoint: COutPoint) -> CTxOut:
         """Get output, for example for spent_outputs. Only works if the RPC points to a wallet url"""
@@ -243,6 +481,184 @@ class BitcoinRPC:
         tx = self.get_wallet_transaction(txid)
         return tx.vout[outpoint.n]
 
+    def get_outputs(self, outpoints: typing.Sequence[COutPoint]) -> list[CTxOut]:
+        """Like get_output, but for many outputs, fetching their transactions in a single batch"""
+        txs = {}
+        for outpoint in outpoints:
+            txid = outpoint.hash[::-1].hex()
+            if txid not in txs:
+                txs[txid] = self._tx_cache.get(txid)
+        with self.batch() as batch:
+            calls = {
+                txid: batch.call("gettransaction", txid)
+                for txid, tx in txs.items()
+                if tx is None
+            }
+        for txid, call in calls.items():
+            txs[txid] = self._cache_transaction(txid, call.result())
+        return [
+            txs[outpoint.hash[::-1].hex()].vout[outpoint.n] for outpoint in outpoints
+        ]
+
+
+def parse_btc_amount_sat(raw: str) -> int:
+    """
+    Parse a BTC amount (e.g. 0.00012345) to satoshis.
+
+    Going through float is exact here: amounts have at most 8 decimals and are at most 21M BTC (< 2**53 sat),
+    so the error of the float is well below half a satoshi and rounding removes it.
+    """
+    return round(float(raw) * COIN)
+
+
+def get_tx_hex(tx: str | bytes | CTransaction | CMutableTransaction) -> str:
+    if isinstance(tx, (CTransaction, CMutableTransaction)):
+        return tx.serialize().hex()
+    if isinstance(tx, bytes):
+        return tx.hex()
+    if not isinstance(tx, str):
+        raise ValueError(
+            "tx must be either a CTransaction, CMutableTransaction, bytes, or str"
+        )
+    return tx
+
+
+def get_vout_index(tx: CTransaction, txid: str, address: str | CCoinAddress) -> int:
+    "Index of the only output of the transaction to the address"
+    if isinstance(address, str):
+        address = CCoinAddress(address)
+    script_pubkey = address.to_scriptPubKey()
+    candidates = [
+        n for n, out in enumerate(tx.vout) if out.scriptPubKey == script_pubkey
+    ]
+    if not candidates:
+        raise LookupError(f"No outputs to {address} in tx {txid}")
+    if len(candidates) > 1:
+        raise LookupError(f"Multiple outputs to {address} in tx {txid}: {candidates}")
+    return candidates[0]
+
+
+def _get_result(
+    response_json: dict, *, response: requests.Response, jsonrpc_data: dict
+):
+    error = response_json.get("error")
+    if error is not None or not response.ok:
+        if isinstance(error, dict):
+            raise JSONRPCError(
+                message=error["message"],
+                code=error["code"],
+                response=response,
+                jsonrpc_data=jsonrpc_data,
+            )
+        raise JSONRPCError(
+            message=str(error),
+            response=response,
+            jsonrpc_data=jsonrpc_data,
+        )
+    if "result" not in response_json:
+        raise JSONRPCError(
+            message="No result in response",
+            response=response,
+            jsonrpc_data=jsonrpc_data,
+        )
+    return response_json["result"]
+
+
+def _set_batch_responses(
+    calls: list[RPCBatchCall],
+    response_json: typing.Any,
+    *,
+    response: requests.Response,
+    jsonrpc_data: list[dict],
+):
+    "Give the calls of a batch their responses, by id"
+    if not isinstance(response_json, list):
+        # The whole batch was rejected, e.g. because of an auth error
+        error = response_json.get("error") if response_json else None
+        raise JSONRPCError(
+            message=str(error),
+            response=response,
+            jsonrpc_data=jsonrpc_data,
+        )
+    responses_by_id = {
+        call_response.get("id"): call_response for call_response in response_json
+    }
+    for call in calls:
+        call_response = responses_by_id.get(call.jsonrpc_data["id"])
+        if call_response is None:
+            call_response = {"error": "No response to call in batch"}
+        call._set_response(call_response, response=response)
+
+
+class RPCBatchCall:
+    "A call in an RPCBatch. Its result is available once the batch has been sent."
+
+    def __init__(self, jsonrpc_data: dict):
+        self.jsonrpc_data = jsonrpc_data
+        self._response_json: dict | None = None
+        self._response: requests.Response | None = None
+
+    @property
+    def method(self) -> str:
+        return self.jsonrpc_data["method"]
+
+    @property
+    def done(self) -> bool:
+        return self._response_json is not None
+
+    def result(self) -> typing.Any:
+        "Result of the call. Raises JSONRPCError if the call failed."
+        if self._response_json is None:
+            raise RuntimeError(f"Batch of {self.method} call not sent yet")
+        return _get_result(
+            self._response_json,
+            response=self._response,
+            jsonrpc_data=self.jsonrpc_data,
+        )
+
+    def _set_response(self, response_json: dict, *, response: requests.Response):
+        self._response_json = response_json
+        self._response = response
+
+
+class RPCBatch:
+    """
+    Calls collected to be sent to the node in a single HTTP request.
+
+        with bitcoin_rpc.batch() as batch:
+            tx1 = batch.call("getrawtransaction", txid1, True)
+            tx2 = batch.call("getrawtransaction", txid2, True)
+        print(tx1.result(), tx2.result())
+
+    The batch is sent when the with block exits (or with send()). The node executes the calls in order,
+    and a failing call doesn't stop the others -- its error is raised by result() of that call only.
+    """
+
+    def __init__(self, bitcoin_rpc: BitcoinRPC):
+        self._bitcoin_rpc = bitcoin_rpc
+        self._calls: list[RPCBatchCall] = []
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __enter__(self) -> RPCBatch:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+
+    def call(self, service_name: str, *args: typing.Any) -> RPCBatchCall:
+        call = RPCBatchCall(self._bitcoin_rpc._make_request(service_name, args))
+        self._calls.append(call)
+        return call
+
+    def send(self) -> list[RPCBatchCall]:
+        calls, self._calls = self._calls, []
+        if calls:
+            self._bitcoin_rpc._jsonrpc_batch(calls)
+        return calls
+
 
 class DecimalJSONEncoder(json.JSONEncoder):
     # Forked from bitcointx/rpc.py... seems like f'{somedecimal:.08f}' no longer works for python3.11?
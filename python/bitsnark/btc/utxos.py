@@ -0,0 +1,167 @@
+"""Local view of the spendable coins of the bitcoin wallet."""
+
+from __future__ import annotations
+import logging
+import threading
+import typing
+from dataclasses import dataclass
+
+from bitcointx.core import COutPoint, CTxOut
+from bitcointx.core.script import CScript
+
+from .rpc import BitcoinRPC
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class WalletUTXO:
+    txid: str
+    vout: int
+    amount_sat: int
+    script_pubkey: CScript
+    # At the time of the last refresh
+    confirmations: int
+
+    @property
+    def outpoint(self) -> COutPoint:
+        return COutPoint(bytes.fromhex(self.txid)[::-1], self.vout)
+
+    @property
+    def txout(self) -> CTxOut:
+        return CTxOut(nValue=self.amount_sat, scriptPubKey=self.script_pubkey)
+
+
+UTXOKey = tuple[str, int]
+
+
+class WalletUTXOManager:
+    """
+    Keep track of the spendable coins of the wallet, so that they don't have to be listed for each funding.
+
+    The coins are listed (listunspent) at most once per block, or when explicitly refreshed, and the local
+    view is updated with the differences. Coins are reserved atomically, so concurrent fundings never pick
+    the same coin. Reserved coins are either released (e.g. if funding failed) or marked as spent.
+
+    Thread-safe. One manager should be shared by everything funding from the same wallet.
+    """
+
+    def __init__(
+        self,
+        bitcoin_rpc: BitcoinRPC,
+        *,
+        include_unsafe: bool = False,
+    ):
+        self._bitcoin_rpc = bitcoin_rpc
+        self._include_unsafe = include_unsafe
+        self._lock = threading.Lock()
+        self._available: dict[UTXOKey, WalletUTXO] = {}
+        self._reserved: dict[UTXOKey, WalletUTXO] = {}
+        # Spent coins (by generation they were spent in) are remembered until a listing started after they
+        # were spent no longer contains them, so that an older listing can't make them available again
+        self._spent: dict[UTXOKey, int] = {}
+        self._generation = 0
+        self._tip_hash: str | None = None
+
+    @property
+    def available(self) -> list[WalletUTXO]:
+        "Coins that are not reserved, oldest (most confirmations) first"
+        with self._lock:
+            return _sorted_by_confirmations(self._available.values())
+
+    def refresh_if_new_block(self):
+        "Refresh if the chain tip changed since the last refresh (or if there was no refresh yet)"
+        tip_hash = self._bitcoin_rpc.call("getbestblockhash")
+        if tip_hash != self._tip_hash:
+            self.refresh(tip_hash=tip_hash)
+
+    def refresh(self, *, tip_hash: str | None = None):
+        "Update the local view with the current coins of the wallet"
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+        unspents = self._bitcoin_rpc.call_sats(
+            "listunspent", 0, 9999999, [], self._include_unsafe
+        )
+        listed = {}
+        for unspent in unspents:
+            if not unspent.get("spendable", True):
+                continue
+            utxo = WalletUTXO(
+                txid=unspent["txid"],
+                vout=unspent["vout"],
+                amount_sat=unspent["amount"],
+                script_pubkey=CScript(bytes.fromhex(unspent["scriptPubKey"])),
+                confirmations=unspent["confirmations"],
+            )
+            listed[(utxo.txid, utxo.vout)] = utxo
+
+        with self._lock:
+            for key, spent_generation in list(self._spent.items()):
+                if spent_generation < generation and key not in listed:
+                    del self._spent[key]
+            num_before = len(self._available)
+            self._available = {
+                key: utxo
+                for key, utxo in listed.items()
+                if key not in self._reserved and key not in self._spent
+            }
+            if tip_hash is not None:
+                self._tip_hash = tip_hash
+            logger.debug(
+                "Refreshed wallet coins: %d available (was %d), %d reserved",
+                len(self._available),
+                num_before,
+                len(self._reserved),
+            )
+
+    def reserve(
+        self,
+        select: typing.Callable[[list[WalletUTXO]], typing.Iterable[WalletUTXO]],
+    ) -> list[WalletUTXO]:
+        """
+        Reserve the coins chosen by select, which is given the available coins (oldest first).
+        Runs select while holding the lock, so it should not make RPC calls. If it raises, nothing is reserved.
+        """
+        with self._lock:
+            selected = list(select(_sorted_by_confirmations(self._available.values())))
+            keys = [(utxo.txid, utxo.vout) for utxo in selected]
+            if any(key not in self._available for key in keys):
+                raise ValueError("Can only reserve available coins")
+            for key in keys:
+                self._reserved[key] = self._available.pop(key)
+            return selected
+
+    def release(self, utxos: typing.Iterable[WalletUTXO]):
+        "Make reserved coins available again"
+        with self._lock:
+            for utxo in utxos:
+                key = (utxo.txid, utxo.vout)
+                if self._reserved.pop(key, None) is not None:
+                    self._available[key] = utxo
+
+    def mark_spent(
+        self,
+        utxos: typing.Iterable[WalletUTXO],
+        *,
+        new_utxos: typing.Iterable[WalletUTXO] = (),
+    ):
+        """
+        Forget reserved coins that were spent, and optionally add new coins of the wallet
+        (e.g. the change of the spending transaction) without waiting for a refresh.
+        """
+        with self._lock:
+            for utxo in utxos:
+                key = (utxo.txid, utxo.vout)
+                self._reserved.pop(key, None)
+                self._available.pop(key, None)
+                self._spent[key] = self._generation
+            for utxo in new_utxos:
+                key = (utxo.txid, utxo.vout)
+                # E.g. a coin that is no longer spent by a replaced transaction
+                self._spent.pop(key, None)
+                self._available[key] = utxo
+
+
+def _sorted_by_confirmations(utxos: typing.Iterable[WalletUTXO]) -> list[WalletUTXO]:
+    return sorted(utxos, key=lambda utxo: utxo.confirmations, reverse=True)
@@ -63,15 +63,19 @@ def main(argv: Sequence[str] = None):
     engine = create_engine(f"{args.db}/{args.agent_id}")
     dbsession = Session(engine, autobegin=False)
 
+    command = commands[args.command]
     bitcoin_rpc = BitcoinRPC(args.rpc)
-    try:
-        chain = determine_chain(bitcoin_rpc)
-    except Exception as e:
-        sys.exit(f"Cannot connect to the bitcoin node at {args.rpc} (error: {e})")
+    if not command.uses_node(args):
+        # Not connecting to the node, so assume the chain that is used for testing
+        chain = "bitcoin/regtest"
+    else:
+        try:
+            chain = determine_chain(bitcoin_rpc)
+        except Exception as e:
+            sys.exit(f"Cannot connect to the bitcoin node at {args.rpc} (error: {e})")
 
     with ChainParams(chain):
         with dbsession.begin():
-            command = commands[args.command]
             command.run(
                 Context(
                     args=args,
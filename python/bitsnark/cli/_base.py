@@ -2,6 +2,7 @@ from __future__ import annotations
 from abc import ABC, abstractmethod
 import argparse
 from dataclasses import dataclass
+import logging
 import os
 import sys
 from typing import Literal
@@ -12,6 +13,9 @@ from sqlalchemy.orm.session import Session
 
 from bitsnark.btc.rpc import BitcoinRPC
 from bitsnark.core.models import TransactionTemplate
+from bitsnark.core.readiness import wait_for_setups_checked_height
+
+logger = logging.getLogger(__name__)
 
 
 class Command(ABC):
@@ -21,6 +25,10 @@ class Command(ABC):
         # add args etc -- optional
         pass
 
+    def uses_node(self, args: argparse.Namespace) -> bool:
+        "Does the command (with these args) need the bitcoin node"
+        return True
+
     @abstractmethod
     def run(self, context: Context): ...
 
@@ -60,6 +68,37 @@ def find_tx_template(context: Context) -> TransactionTemplate:
         )
 
 
+def add_agent_wait_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--agent-wait-timeout",
+        type=float,
+        default=10,
+        help="Seconds to wait for the agent to check the mined block (0 to not wait)",
+    )
+
+
+def mine_and_wait_for_agent(context: Context, tx_template: TransactionTemplate):
+    """
+    Mine a block, and wait until the listener of the agent has checked it for the setup of the
+    tx template. Only warns if it hasn't in time, as the transaction is mined anyway.
+    """
+    bitcoin_rpc = context.bitcoin_rpc
+    bitcoin_rpc.mine_blocks()
+    timeout = context.args.agent_wait_timeout
+    if not timeout:
+        return
+    height = bitcoin_rpc.get_chain_tip().height
+    try:
+        wait_for_setups_checked_height(
+            context.dbsession,
+            height,
+            setup_ids=[tx_template.setup_id],
+            timeout=timeout,
+        )
+    except TimeoutError as e:
+        logger.warning("%s, is the agent running?", e)
+
+
 def get_default_prover_privkey_hex() -> str:
     return os.getenv(
         "PROVER_SCHNORR_PRIVATE",
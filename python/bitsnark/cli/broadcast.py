@@ -1,18 +1,49 @@
 """Quick and dirty transaction broadcaster."""
 
 import argparse
+import heapq
 import logging
+import typing
+from collections import defaultdict
 
+from bitcointx.core import CTransaction
 from bitcointx.core.script import CScript
 
 from ._base import Command, add_tx_template_args, find_tx_template, Context
 from ..core.funding import get_signed_transaction_from_funded_tx_template
 from ..core.models import TransactionTemplate
 from ..core.transactions import construct_signed_transaction
+from ..btc.coin_selection import get_transaction_weight
+from ..btc.rpc import BitcoinRPC, JSONRPCError
 from ..scripteval import eval_tapscript
 
 logger = logging.getLogger(__name__)
 
+# Limits of the node on packages tested together (MAX_PACKAGE_COUNT and MAX_PACKAGE_WEIGHT)
+MAX_PACKAGE_COUNT = 25
+MAX_PACKAGE_WEIGHT = 404_000
+
+
+class ParentNotBroadcast(Exception):
+    "The transaction was not broadcast, because a transaction it spends (in the same package) wasn't"
+
+
+class NotTested(Exception):
+    "The transaction was not tested, because another transaction in its package was rejected"
+
+
+def get_signed_transaction(tx_template: TransactionTemplate, dbsession) -> CTransaction:
+    "The broadcastable transaction of the template (funded or not)"
+    if tx_template.fundable:
+        return get_signed_transaction_from_funded_tx_template(
+            tx_template=tx_template,
+            dbsession=dbsession,
+        )
+    return construct_signed_transaction(
+        tx_template=tx_template,
+        dbsession=dbsession,
+    ).tx
+
 
 def broadcast_transaction(
     tx_template: TransactionTemplate,
@@ -24,17 +55,7 @@ def broadcast_transaction(
 ) -> str:
     logger.info("Attempting to broadcast %s", tx_template.name)
 
-    if tx_template.fundable:
-        tx = get_signed_transaction_from_funded_tx_template(
-            tx_template=tx_template,
-            dbsession=dbsession,
-        )
-    else:
-        signed_tx = construct_signed_transaction(
-            tx_template=tx_template,
-            dbsession=dbsession,
-        )
-        tx = signed_tx.tx
+    tx = get_signed_transaction(tx_template, dbsession)
 
     if evaluate_inputs:
         for input_index, input_witness in enumerate(tx.wit.vtxinwit):
@@ -79,6 +100,224 @@ def broadcast_transaction(
     return txid
 
 
+def sort_topologically(
+    tx_templates: typing.Sequence[TransactionTemplate],
+) -> list[TransactionTemplate]:
+    """
+    Order templates of a setup so that each comes after the templates (among them) it spends from,
+    and otherwise by ordinal.
+    """
+    by_name = {tx_template.name: tx_template for tx_template in tx_templates}
+    children = defaultdict(list)
+    num_parents = {}
+    for tx_template in tx_templates:
+        parent_names = {
+            inp["templateName"]
+            for inp in tx_template.inputs
+            if not inp.get("funded") and inp["templateName"] in by_name
+        }
+        num_parents[tx_template.name] = len(parent_names)
+        for parent_name in parent_names:
+            children[parent_name].append(tx_template)
+
+    def key(tx_template):
+        return (tx_template.ordinal is None, tx_template.ordinal or 0, tx_template.name)
+
+    heap = [key(t) for t in tx_templates if num_parents[t.name] == 0]
+    heapq.heapify(heap)
+    ordered = []
+    while heap:
+        tx_template = by_name[heapq.heappop(heap)[2]]
+        ordered.append(tx_template)
+        for child in children[tx_template.name]:
+            num_parents[child.name] -= 1
+            if num_parents[child.name] == 0:
+                heapq.heappush(heap, key(child))
+    if len(ordered) != len(tx_templates):
+        raise ValueError(f"Cycle between templates of setup {tx_templates[0].setup_id}")
+    return ordered
+
+
+def _check_parents(
+    tx_template: TransactionTemplate, failed_names: set[str]
+) -> ParentNotBroadcast | None:
+    "The error of the template if it spends one of the (not broadcast) templates in failed_names"
+    failed_parents = sorted(
+        {
+            inp["templateName"]
+            for inp in tx_template.inputs
+            if not inp.get("funded") and inp["templateName"] in failed_names
+        }
+    )
+    if not failed_parents:
+        return None
+    return ParentNotBroadcast(
+        f"{tx_template.name} spends {', '.join(failed_parents)}, which was not broadcast"
+    )
+
+
+def broadcast_transaction_package(
+    tx_templates: typing.Sequence[TransactionTemplate],
+    dbsession,
+    bitcoin_rpc: BitcoinRPC,
+    no_test_mempool_accept: bool = False,
+) -> list[Exception | None]:
+    """
+    Broadcast templates (of one or more setups) together, so that templates spending each other can be
+    tested and broadcast at the same time.
+
+    The templates of each setup are ordered topologically and split into packages (of at most
+    MAX_PACKAGE_COUNT transactions). Each package is tested with testmempoolaccept, so that children are
+    tested against their parents, and then only the accepted transactions are sent. The n-th packages of
+    all setups are tested in one (batched) request and sent in the next one, so a setup that fits in one
+    package is broadcast in two round-trips.
+
+    Returns one entry per template, in order: None if it was broadcast, otherwise the error. The
+    error is a ValueError if the mempool rejected the transaction (or it can't be built),
+    ParentNotBroadcast if a transaction it spends wasn't broadcast, and NotTested if another transaction
+    of its package was rejected.
+    """
+    errors: list[Exception | None] = [None] * len(tx_templates)
+    indices = {id(tx_template): i for i, tx_template in enumerate(tx_templates)}
+    setups = defaultdict(list)
+    for tx_template in tx_templates:
+        setups[tx_template.setup_id].append(tx_template)
+
+    # Per setup, the names of the templates that were not broadcast, and the packages as lists of
+    # (template index, transaction hex)
+    setup_packages: list[tuple[set[str], list[list[tuple[int, str]]]]] = []
+    for setup_tx_templates in setups.values():
+        failed_names = set()
+        packages = []
+        package = []
+        package_weight = 0
+        for tx_template in sort_topologically(setup_tx_templates):
+            index = indices[id(tx_template)]
+            parent_error = _check_parents(tx_template, failed_names)
+            if parent_error is not None:
+                errors[index] = parent_error
+                failed_names.add(tx_template.name)
+                continue
+            try:
+                tx = get_signed_transaction(tx_template, dbsession)
+            except Exception as e:
+                errors[index] = e
+                failed_names.add(tx_template.name)
+                continue
+            weight = get_transaction_weight(tx)
+            if package and (
+                len(package) == MAX_PACKAGE_COUNT
+                or package_weight + weight > MAX_PACKAGE_WEIGHT
+            ):
+                packages.append(package)
+                package = []
+                package_weight = 0
+            package.append((index, tx.serialize().hex()))
+            package_weight += weight
+        if package:
+            packages.append(package)
+        setup_packages.append((failed_names, packages))
+
+    num_packages = [len(packages) for _, packages in setup_packages]
+    if not any(num_packages):
+        return errors
+    logger.info(
+        "Broadcasting %d transactions in %d packages",
+        sum(len(package) for _, packages in setup_packages for package in packages),
+        sum(num_packages),
+    )
+
+    def fail(index: int, failed_names: set[str], error: Exception):
+        errors[index] = error
+        failed_names.add(tx_templates[index].name)
+
+    for package_number in range(max(num_packages)):
+        # The next package of each setup, without the transactions whose parents (in the previous
+        # packages) were not broadcast
+        round_packages = []
+        for failed_names, packages in setup_packages:
+            if package_number >= len(packages):
+                continue
+            package = []
+            for index, tx_hex in packages[package_number]:
+                parent_error = _check_parents(tx_templates[index], failed_names)
+                if parent_error is not None:
+                    fail(index, failed_names, parent_error)
+                else:
+                    package.append((index, tx_hex))
+            if package:
+                round_packages.append((failed_names, package))
+        if not round_packages:
+            continue
+
+        to_send = []
+        if no_test_mempool_accept:
+            for failed_names, package in round_packages:
+                to_send.extend((failed_names, entry) for entry in package)
+        else:
+            with bitcoin_rpc.batch() as batch:
+                mempoolaccept_calls = [
+                    batch.call("testmempoolaccept", [tx_hex for _, tx_hex in package])
+                    for _, package in round_packages
+                ]
+            for (failed_names, package), mempoolaccept_call in zip(
+                round_packages, mempoolaccept_calls
+            ):
+                try:
+                    mempoolaccept_ret = mempoolaccept_call.result()
+                except JSONRPCError as e:
+                    # Not sent, so it's tested again on the next try
+                    logger.warning("Cannot test package: %s", e)
+                    for index, _ in package:
+                        fail(index, failed_names, e)
+                    continue
+                for (index, tx_hex), tx_result in zip(package, mempoolaccept_ret):
+                    tx_template = tx_templates[index]
+                    parent_error = _check_parents(tx_template, failed_names)
+                    if parent_error is not None:
+                        fail(index, failed_names, parent_error)
+                    elif tx_result.get("allowed"):
+                        to_send.append((failed_names, (index, tx_hex)))
+                    elif "allowed" in tx_result:
+                        fail(
+                            index,
+                            failed_names,
+                            ValueError(
+                                f"Transaction {tx_template.name!r} not accepted by mempool: "
+                                f"{tx_result['reject-reason']}"
+                            ),
+                        )
+                    else:
+                        # "allowed" is missing if the transaction was not tested because of another
+                        # in the package
+                        fail(
+                            index,
+                            failed_names,
+                            NotTested(
+                                f"{tx_template.name} not tested: "
+                                f"{tx_result.get('package-error', 'package rejected')}"
+                            ),
+                        )
+
+        if not to_send:
+            continue
+        # The node runs the calls in order, so each transaction is sent after its parents
+        with bitcoin_rpc.batch() as batch:
+            send_calls = [
+                batch.call("sendrawtransaction", tx_hex) for _, (_, tx_hex) in to_send
+            ]
+        for (failed_names, (index, _)), send_call in zip(to_send, send_calls):
+            tx_template = tx_templates[index]
+            try:
+                txid = send_call.result()
+            except Exception as e:
+                fail(index, failed_names, e)
+                continue
+            assert txid == tx_template.txid
+            logger.info("Transaction %s broadcast: %s", tx_template.name, txid)
+    return errors
+
+
 class BroadcastCommand(Command):
     """
     Broadcast a transaction template to the blockchain
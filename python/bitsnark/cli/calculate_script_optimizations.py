@@ -1,10 +1,12 @@
 import argparse
+import itertools
 import logging
 
-from bitcointx.core.script import CScript, OP_DUP, OP_DROP, OP_3DUP, OP_2DUP, OP_2DROP
+from bitcointx.core.script import CScript, OP_DUP, OP_DROP
 
-from bitsnark.core.parsing import parse_hex_bytes
 from ._base import Command, add_tx_template_args, find_tx_template, Context
+from ..core.parsing import parse_hex_bytes
+from ..core.script_optimizer import PeepholeOptimizer, check_equivalent_by_eval
 
 logger = logging.getLogger(__name__)
 
@@ -14,20 +16,26 @@ class CalculateScriptOptimizationsCommand(Command):
 
     def init_parser(self, parser: argparse.ArgumentParser):
         add_tx_template_args(parser)
+        parser.add_argument(
+            "--no-eval",
+            help="Don't check the optimized scripts by evaluating them with the example witness",
+            action="store_true",
+        )
 
     def run(
         self,
         context: Context,
     ):
         tx_template = find_tx_template(context)
+        optimizer = PeepholeOptimizer()
 
         logger.info("Optimizing scripts for transaction template %s", tx_template.name)
         for output_index, output in enumerate(tx_template.outputs):
             for spending_condition_index, spending_condition in enumerate(
                 output["spendingConditions"]
             ):
-                script_raw = spending_condition.get("script")
-                if script_raw is None:
+                script = tx_template.load_script(spending_condition)
+                if script is None:
                     logger.warning(
                         "Output %s spending condition %s has no script -- skipping",
                         output_index,
@@ -40,7 +48,7 @@ class CalculateScriptOptimizationsCommand(Command):
                     output_index,
                     spending_condition_index,
                 )
-                original_script = CScript(parse_hex_bytes(script_raw))
+                original_script = CScript(script)
                 logger.info("\tOriginal script size: %s", len(original_script))
                 theoretically_optimal_script = get_theoretically_optimal_script(
                     original_script
@@ -54,45 +62,36 @@ class CalculateScriptOptimizationsCommand(Command):
                     100
                     - len(theoretically_optimal_script) / len(original_script) * 100,
                 )
-                optimized_script = optimize_script(original_script)
-                logger.info("\tOptimized script size: %s", len(optimized_script))
+                result = optimizer.optimize(original_script)
+                logger.info("\tOptimized script size: %s", len(result.script))
                 logger.info(
                     "\t\tSavings: %s %%",
-                    100 - len(optimized_script) / len(original_script) * 100,
+                    100 - len(result.script) / len(original_script) * 100,
                 )
+                for rule, count in result.applied_rules.most_common():
+                    logger.info("\t\t%6d x %s", count, rule)
 
-
-def optimize_script(script: CScript) -> CScript:
-    """
-    Optimize a script by replacing successive OP_DUPs and OP_DROPs with OP_3DUP/OP_2DUP/OP_2DROP
-    """
-    if len(script) < 2:
-        return script
-    iterator = iter(script)
-    stack = [next(iterator)]
-    logger.debug("+ %s", stack[-1])
-    for current_op in iterator:
-        prev_op = stack[-1]
-        ops = (prev_op, current_op)
-        removed = None
-        if ops == (OP_2DUP, OP_DUP):
-            removed = stack.pop()
-            added = OP_3DUP
-        elif ops == (OP_DUP, OP_DUP):
-            removed = stack.pop()
-            added = OP_2DUP
-        elif ops == (OP_DROP, OP_DROP):
-            removed = stack.pop()
-            added = OP_2DROP
-        else:
-            added = current_op
-
-        stack.append(added)
-        if removed is not None:
-            logger.debug("- %s", removed)
-        logger.debug("+ %s", added)
-
-    return CScript(stack)
+                if context.args.no_eval or "exampleWitness" not in spending_condition:
+                    continue
+                witness_elems = [
+                    parse_hex_bytes(s)
+                    for s in itertools.chain.from_iterable(
+                        spending_condition["exampleWitness"]
+                    )
+                ]
+                # Signature checks are ignored, but the signatures must be there
+                witness_elems += [bytes(64), bytes(64)]
+                mismatches = check_equivalent_by_eval(
+                    original_script, result.script, [witness_elems]
+                )
+                if mismatches:
+                    logger.error(
+                        "\tThe optimized script behaves differently: %s", mismatches
+                    )
+                else:
+                    logger.info(
+                        "\tThe optimized script behaves the same with the example witness"
+                    )
 
 
 def get_theoretically_optimal_script(script: CScript) -> CScript:
@@ -7,7 +7,14 @@ from bitcointx.core.script import CScript
 from bitcointx.wallet import CCoinAddress
 
 from bitsnark.core.parsing import parse_bignum, parse_hex_bytes
-from ._base import Command, add_tx_template_args, find_tx_template, Context
+from ._base import (
+    Command,
+    add_agent_wait_args,
+    add_tx_template_args,
+    find_tx_template,
+    mine_and_wait_for_agent,
+    Context,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -22,6 +29,7 @@ class FundAndSendCommand(Command):
 
     def init_parser(self, parser: argparse.ArgumentParser):
         add_tx_template_args(parser)
+        add_agent_wait_args(parser)
         parser.add_argument(
             "--fee-rate", help="Fee rate in sat/vB", type=float, default=10
         )
@@ -132,6 +140,6 @@ class FundAndSendCommand(Command):
         )
         # print(txid)
         assert txid == tx.GetTxid()[::-1].hex()
-        bitcoin_rpc.mine_blocks()
+        mine_and_wait_for_agent(context, tx_template)
         logger.info(f"Transaction broadcast: {txid}")
         return txid
@@ -15,12 +15,15 @@ from bitcointx.core.key import CKey
 from bitcointx.core.script import CScript, CScriptWitness, OP_RETURN
 from bitcointx.wallet import CCoinAddress
 
+from bitsnark.core.models import TransactionTemplate
 from bitsnark.core.parsing import parse_bignum, parse_hex_bytes
 from bitsnark.core.signing import sign_input
 from ._base import (
     Command,
+    add_agent_wait_args,
     add_tx_template_args,
     find_tx_template,
+    mine_and_wait_for_agent,
     Context,
     get_default_prover_privkey_hex,
     get_default_verifier_privkey_hex,
@@ -41,6 +44,94 @@ class TestMempoolAcceptFailure(Exception):
         self.raw_result = raw_result
 
 
+OP_RETURN_SCRIPT_PUBKEY = CScript(
+    [
+        OP_RETURN,
+        b"There must be some filler here or the TX will get rejected",
+    ]
+)
+
+
+def create_spending_transaction(
+    *,
+    tx_template: TransactionTemplate,
+    output_index: int,
+    spending_condition_index: int,
+    prevout: COutPoint,
+    spent_output: CTxOut,
+    prover_privkey: CKey,
+    verifier_privkey: CKey,
+    to_script_pubkey: CScript = OP_RETURN_SCRIPT_PUBKEY,
+    amount_sat_out: int = 0,
+) -> CMutableTransaction:
+    """
+    Create a transaction spending prevout (spent_output, locked like the output of the tx template) with
+    the spending condition, signed by both the prover and the verifier, with the example witness.
+    """
+    output_spec = tx_template.outputs[output_index]
+    spending_condition = output_spec["spendingConditions"][spending_condition_index]
+    tapscript = CScript(tx_template.load_script(spending_condition))
+
+    inputs = [
+        CTxIn(
+            prevout,
+            nSequence=(spending_condition.get("timeoutBlocks") or 0xFFFFFFFF),
+        )
+    ]
+    outputs = [
+        CTxOut(
+            nValue=amount_sat_out,
+            scriptPubKey=to_script_pubkey,
+        )
+    ]
+
+    tx = CMutableTransaction(
+        vin=inputs,
+        vout=outputs,
+        nVersion=2,
+    )
+    spent_outputs = [spent_output]
+    prover_signature = sign_input(
+        script=tapscript,
+        tx=tx,
+        input_index=0,
+        spent_outputs=spent_outputs,
+        private_key=prover_privkey,
+    )
+    verifier_signature = sign_input(
+        script=tapscript,
+        tx=tx,
+        input_index=0,
+        spent_outputs=spent_outputs,
+        private_key=verifier_privkey,
+    )
+
+    control_block = tx_template.load_script(spending_condition, "controlBlock")
+    example_witness_raw = spending_condition.get("exampleWitness", [])
+    example_witness = [
+        parse_hex_bytes(s)
+        for s in
+        # This flattens the list of lists
+        itertools.chain.from_iterable(example_witness_raw)
+    ]
+    input_witnesses = [
+        CTxInWitness(
+            CScriptWitness(
+                stack=[
+                    *example_witness,
+                    verifier_signature,
+                    prover_signature,
+                    tapscript,
+                    control_block,
+                ],
+            )
+        )
+    ]
+
+    tx.wit = CTxWitness(vtxinwit=input_witnesses)
+    return tx
+
+
 class SpendCommand(Command):
     """
     Spend an output according to spending condition
@@ -50,6 +141,7 @@ class SpendCommand(Command):
 
     def init_parser(self, parser: argparse.ArgumentParser):
         add_tx_template_args(parser)
+        add_agent_wait_args(parser)
         parser.add_argument(
             "--spending-condition",
             required=True,
@@ -102,18 +194,10 @@ class SpendCommand(Command):
 
         output_spec = tx_template.outputs[prev_out_index]
         amount_sat = parse_bignum(output_spec["amount"])
-        # script_pubkey = CScript(parse_hex_bytes(output_spec['taprootKey']))
-        spending_condition = output_spec["spendingConditions"][args.spending_condition]
-        tapscript = CScript(parse_hex_bytes(spending_condition["script"]))
 
         to_address = args.to_address
         if not to_address or to_address == "OP_RETURN":
-            to_script_pubkey = CScript(
-                [
-                    OP_RETURN,
-                    b"There must be some filler here or the TX will get rejected",
-                ]
-            )
+            to_script_pubkey = OP_RETURN_SCRIPT_PUBKEY
             if args.amount is not None:
                 amount_sat_out = int(args.amount)
             else:
@@ -136,65 +220,20 @@ class SpendCommand(Command):
             amount_sat_out,
         )
 
-        inputs = [
-            CTxIn(
-                COutPoint(
-                    hash=bytes.fromhex(prev_txid)[::-1],
-                    n=prev_out_index,
-                ),
-                nSequence=(spending_condition.get("timeoutBlocks") or 0xFFFFFFFF),
-            )
-        ]
-        outputs = [
-            CTxOut(
-                nValue=amount_sat_out,
-                scriptPubKey=to_script_pubkey,
-            )
-        ]
-
-        tx = CMutableTransaction(
-            vin=inputs,
-            vout=outputs,
-            nVersion=2,
-        )
-        prover_signature = sign_input(
-            script=tapscript,
-            tx=tx,
-            input_index=0,
-            spent_outputs=spent_outputs,
-            private_key=prover_privkey,
+        tx = create_spending_transaction(
+            tx_template=tx_template,
+            output_index=prev_out_index,
+            spending_condition_index=args.spending_condition,
+            prevout=COutPoint(
+                hash=bytes.fromhex(prev_txid)[::-1],
+                n=prev_out_index,
+            ),
+            spent_output=spent_outputs[0],
+            prover_privkey=prover_privkey,
+            verifier_privkey=verifier_privkey,
+            to_script_pubkey=to_script_pubkey,
+            amount_sat_out=amount_sat_out,
         )
-        verifier_signature = sign_input(
-            script=tapscript,
-            tx=tx,
-            input_index=0,
-            spent_outputs=spent_outputs,
-            private_key=verifier_privkey,
-        )
-
-        control_block = parse_hex_bytes(spending_condition["controlBlock"])
-        example_witness_raw = spending_condition.get("exampleWitness", [])
-        example_witness = [
-            parse_hex_bytes(s)
-            for s in
-            # This flattens the list of lists
-            itertools.chain.from_iterable(example_witness_raw)
-        ]
-        input_witnesses = [
-            CTxInWitness(
-                CScriptWitness(
-                    stack=[
-                        *example_witness,
-                        verifier_signature,
-                        prover_signature,
-                        tapscript,
-                        control_block,
-                    ],
-                )
-            )
-        ]
-
-        tx.wit = CTxWitness(vtxinwit=input_witnesses)
 
         serialized_tx = tx.serialize().hex()
         mempool_accept = bitcoin_rpc.call(
@@ -213,4 +252,4 @@ class SpendCommand(Command):
             serialized_tx,
         )
         logger.info("TX broadcast: %s", txid)
-        bitcoin_rpc.mine_blocks()
+        mine_and_wait_for_agent(context, tx_template)
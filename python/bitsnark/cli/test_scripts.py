@@ -1,5 +1,7 @@
 import argparse
+import hashlib
 import logging
+import time
 
 import sqlalchemy as sa
 from bitcointx.core.key import CKey
@@ -11,15 +13,24 @@ from ._base import (
     get_default_verifier_privkey_hex,
 )
 from ..core.models import TransactionTemplate
+from ..core.script_test_cache import (
+    DEFAULT_CACHE_PATH,
+    ScriptTestCache,
+    get_test_case_key,
+)
+from ..core.script_test_report import write_json_report, write_junit_report
 from ..core.script_testing import (
-    TestCase,
     Result,
-    execute_script_test_case,
+    execute_script_test_cases,
+    execute_script_test_cases_offline,
     collect_script_test_cases,
 )
 
 logger = logging.getLogger(__name__)
 
+# Number of slowest test cases to log
+NUM_SLOWEST_REPORTED = 5
+
 
 class TestScriptsCommand(Command):
     """
@@ -83,6 +94,49 @@ class TestScriptsCommand(Command):
         parser.add_argument(
             "--eval", help="Evaluate script before submitting", action="store_true"
         )
+        parser.add_argument(
+            "--offline",
+            help=(
+                "Test without the node: build the transactions locally and evaluate the scripts, "
+                "checking signatures"
+            ),
+            action="store_true",
+        )
+        parser.add_argument(
+            "--confirm",
+            help="With --offline, confirm the passing tests on the node",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--jobs",
+            "-j",
+            type=int,
+            default=1,
+            help=(
+                "Number of worker processes evaluating scripts with --offline, "
+                "and of concurrent requests testing transactions on the node"
+            ),
+        )
+        parser.add_argument(
+            "--no-cache",
+            help="Re-test the cases that passed with the same script, witness and flags before",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--cache-file",
+            default=DEFAULT_CACHE_PATH,
+            help="SQLite file of the results of earlier runs (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--json-report", help="Write a JSON report of the results to this file"
+        )
+        parser.add_argument(
+            "--junit-report",
+            help="Write a JUnit XML report of the results to this file",
+        )
+
+    def uses_node(self, args: argparse.Namespace) -> bool:
+        return not args.offline or args.confirm
 
     def run(
         self,
@@ -103,7 +157,6 @@ class TestScriptsCommand(Command):
         prover_privkey = CKey.fromhex(context.args.prover_privkey)
         verifier_privkey = CKey.fromhex(context.args.verifier_privkey)
 
-        change_address = bitcoin_rpc.call("getnewaddress")
         filter_parts = [] if not context.args.filter else context.args.filter.split("/")
         filter_name = filter_parts[0] if len(filter_parts) > 0 else None
         filter_output_index = int(filter_parts[1]) if len(filter_parts) > 1 else None
@@ -118,11 +171,6 @@ class TestScriptsCommand(Command):
                 filter_spending_condition_index,
             )
 
-        logger.info(
-            "Mining 101 blocks to %s to ensure we have enough funds", change_address
-        )
-        bitcoin_rpc.mine_blocks(101, change_address)
-
         tx_template_query = sa.select(TransactionTemplate).filter_by(
             setup_id=setup_id,
         )
@@ -142,10 +190,56 @@ class TestScriptsCommand(Command):
             enable_timelocks=context.args.enable_timelocks,
         )
 
-        results = []
+        # Only the test cases that didn't pass before with the same inputs are run
+        all_test_cases = test_cases
+        cached_results: dict[int, Result] = {}
+        cache = None
+        cache_keys = []
+        if not context.args.no_cache:
+            cache = ScriptTestCache(context.args.cache_file)
+            flags = {
+                "offline": context.args.offline,
+                "node": self.uses_node(context.args),
+                "eval": context.args.eval,
+                "keys": hashlib.sha256(
+                    bytes(prover_privkey) + bytes(verifier_privkey)
+                ).hexdigest(),
+            }
+            cache_keys = [
+                get_test_case_key(test_case, flags=flags) for test_case in test_cases
+            ]
+            cache_entries = cache.get_many(cache_keys)
+            for index, (test_case, key) in enumerate(zip(test_cases, cache_keys)):
+                if key in cache_entries:
+                    cached_results[index] = Result(
+                        test_case=test_case,
+                        success=True,
+                        cached=True,
+                        **cache_entries[key],
+                    )
+            test_cases = [
+                test_case
+                for index, test_case in enumerate(test_cases)
+                if index not in cached_results
+            ]
+            logger.info(
+                "%s of %s test cases passed before (cache hits), testing %s",
+                len(cached_results),
+                len(all_test_cases),
+                len(test_cases),
+            )
+
+        change_address = None
+        if self.uses_node(context.args) and test_cases:
+            change_address = bitcoin_rpc.call("getnewaddress")
+            logger.info(
+                "Mining 101 blocks to %s to ensure we have enough funds", change_address
+            )
+            bitcoin_rpc.mine_blocks(101, change_address)
+
         for test_index, test_case in enumerate(test_cases, start=1):
             logger.info(
-                "[%s/%s] Testing %s, used by: %s",
+                "[%s/%s] Adding %s, used by: %s",
                 test_index,
                 len(test_cases),
                 test_case.script_repr(limit=50),
@@ -154,9 +248,44 @@ class TestScriptsCommand(Command):
             if context.args.print_script:
                 logger.info("Script:\n%s", test_case.script_repr(newlines=True))
 
+        start_time = time.perf_counter()
+        results = []
+        if context.args.offline:
+            num_done = 0
+
+            def log_result(result: Result):
+                nonlocal num_done
+                num_done += 1
+                logger.info(
+                    "[%s/%s] %s %s (%.2fs)",
+                    num_done,
+                    len(test_cases),
+                    "OK" if result.success else "FAIL",
+                    result.test_case.sources_repr(),
+                    result.duration or 0,
+                )
+
+            results = execute_script_test_cases_offline(
+                test_cases=test_cases,
+                prover_privkey=prover_privkey,
+                verifier_privkey=verifier_privkey,
+                jobs=context.args.jobs,
+                debug=context.args.debug,
+                print_witness=context.args.print_witness,
+                on_result=log_result,
+            )
+
+        if change_address is not None:
+            # Test on the node all at once (only the ones that passed offline, if tested offline)
+            to_test = (
+                [result.test_case for result in results if result.success]
+                if context.args.offline
+                else test_cases
+            )
+            logger.info("Testing %d scripts on the node", len(to_test))
             try:
-                result = execute_script_test_case(
-                    test_case=test_case,
+                node_results = execute_script_test_cases(
+                    test_cases=to_test,
                     bitcoin_rpc=bitcoin_rpc,
                     change_address=change_address,
                     debug=context.args.debug,
@@ -164,22 +293,55 @@ class TestScriptsCommand(Command):
                     verifier_privkey=verifier_privkey,
                     evaluate=context.args.eval,
                     print_witness=context.args.print_witness,
+                    jobs=context.args.jobs,
                 )
             except Exception as e:
                 logger.exception(e)
-                result = Result(
-                    test_case=test_case,
-                    success=False,
-                    error=e,
-                    reason="An exception occured",
-                )
+                node_results = [
+                    Result(
+                        test_case=test_case,
+                        success=False,
+                        error=e,
+                        reason="An exception occured",
+                    )
+                    for test_case in to_test
+                ]
+            if context.args.offline:
+                node_results_iter = iter(node_results)
+                results = [
+                    next(node_results_iter) if result.success else result
+                    for result in results
+                ]
+            else:
+                results = node_results
 
-            results.append(result)
+        if cached_results:
+            results_iter = iter(results)
+            results = [
+                cached_results[index] if index in cached_results else next(results_iter)
+                for index in range(len(all_test_cases))
+            ]
+        if cache is not None:
+            cache.put_many(
+                [
+                    (
+                        key,
+                        result.test_case.sources_repr(),
+                        result.duration,
+                        result.witness_size,
+                    )
+                    for result, key in zip(results, cache_keys)
+                    if result.success and not result.cached
+                ]
+            )
+            cache.close()
 
         num_success = len([r for r in results if r.success])
         num_fail = len([r for r in results if not r.success])
         for result in results:
             status = "OK" if result.success else "FAIL"
+            if result.cached:
+                status += " (cached)"
             error_repr = f"error: {str(result.error)[:100]} " if result.error else ""
             reason_repr = f"reason: {result.reason} " if result.reason else ""
 
@@ -191,5 +353,37 @@ class TestScriptsCommand(Command):
                 error_repr,
                 reason_repr,
             )
-        logger.info("Total:\t%s OK\t%s FAIL", num_success, num_fail)
+        logger.info(
+            "Total:\t%s OK\t%s FAIL\t(%s cache hits)",
+            num_success,
+            num_fail,
+            len(cached_results),
+        )
+
+        duration = time.perf_counter() - start_time
+        slowest = sorted(
+            (
+                result
+                for result in results
+                if result.duration is not None and not result.cached
+            ),
+            key=lambda result: result.duration,
+            reverse=True,
+        )[:NUM_SLOWEST_REPORTED]
+        if slowest:
+            logger.info(
+                "Slowest:\n%s",
+                "\n".join(
+                    f"{result.duration:8.2f}s  {result.test_case.sources_repr()} "
+                    f"(script: {len(result.test_case.script)} bytes, "
+                    f"witness: {result.witness_size} bytes)"
+                    for result in slowest
+                ),
+            )
+        if context.args.json_report:
+            write_json_report(context.args.json_report, results, duration=duration)
+            logger.info("JSON report written to %s", context.args.json_report)
+        if context.args.junit_report:
+            write_junit_report(context.args.junit_report, results, duration=duration)
+            logger.info("JUnit report written to %s", context.args.junit_report)
         return results
@@ -3,6 +3,9 @@ import logging
 from dataclasses import dataclass
 
 import sqlalchemy as sa
+from bitcointx.core import COutPoint, CTxOut
+from bitcointx.core.key import CKey
+from bitcointx.core.script import CScript
 
 from ._base import (
     Command,
@@ -10,12 +13,16 @@ from ._base import (
     get_default_prover_privkey_hex,
     get_default_verifier_privkey_hex,
 )
-from .fund_and_send import FundAndSendCommand
-from .spend import SpendCommand
-from ..core.models import TransactionTemplate, SpendingConditionJson
+from .spend import TestMempoolAcceptFailure, create_spending_transaction
+from ..core.models import TransactionTemplate, SpendingConditionJson, has_script
+from ..core.parsing import parse_hex_bytes
+from ..core.script_testing import fund_test_outputs, send_test_transactions
 
 logger = logging.getLogger(__name__)
 
+# Amount of each tested output
+OUTPUT_AMOUNT_SAT = 100_000
+
 
 @dataclass
 class Result:
@@ -114,7 +121,7 @@ class TestSpendingConditionsCommand(Command):
         for tx_template in tx_templates:
             for output_index, output in enumerate(tx_template.outputs):
                 for spending_condition in output["spendingConditions"]:
-                    if "script" not in spending_condition:
+                    if not has_script(spending_condition):
                         logger.info(
                             "Skipping spending condition without script (%s/%s/%s)",
                             tx_template.name,
@@ -163,13 +170,49 @@ class TestSpendingConditionsCommand(Command):
                     )
                     to_test.append((tx_template, output_index, spending_condition))
 
-        results = []
+        # Fund the outputs of all the tests with one transaction, and spend them all at once
+        prover_privkey = CKey.fromhex(context.args.prover_privkey)
+        verifier_privkey = CKey.fromhex(context.args.verifier_privkey)
+        results = [
+            Result(
+                tx_template=tx_template,
+                output_index=output_index,
+                spending_condition_index=spending_condition["index"],
+                error=None,
+            )
+            for tx_template, output_index, spending_condition in to_test
+        ]
+        spent_outputs = [
+            CTxOut(
+                nValue=OUTPUT_AMOUNT_SAT,
+                scriptPubKey=CScript(
+                    parse_hex_bytes(tx_template.outputs[output_index]["taprootKey"])
+                ),
+            )
+            for tx_template, output_index, _ in to_test
+        ]
+        funding_txid = None
+        if to_test:
+            funding_txid = fund_test_outputs(
+                bitcoin_rpc=bitcoin_rpc,
+                outputs=spent_outputs,
+                change_address=change_address,
+            )
+            max_timeout_blocks = max(
+                spending_condition.get("timeoutBlocks") or 0
+                for _, _, spending_condition in to_test
+            )
+            if max_timeout_blocks:
+                logger.info("Mining %d blocks to test timeouts", max_timeout_blocks)
+                bitcoin_rpc.mine_blocks(max_timeout_blocks)
+
+        spending_txs = {}
         for test_index, (tx_template, output_index, spending_condition) in enumerate(
-            to_test, start=1
+            to_test
         ):
             logger.info(
                 "[%s/%s] Testing #%s: %s (%s), output #%s spending condition #%s",
-                test_index,
+                test_index + 1,
                 len(to_test),
                 tx_template.ordinal,
                 tx_template.name,
@@ -177,51 +220,33 @@ class TestSpendingConditionsCommand(Command):
                 output_index,
                 spending_condition["index"],
             )
-
-            txid = FundAndSendCommand().run(
-                Context(
-                    dbsession=dbsession,
-                    bitcoin_rpc=bitcoin_rpc,
-                    args=argparse.Namespace(
-                        setup_id=tx_template.setup_id,
-                        name=tx_template.name,
-                        change_address=change_address,
-                        fee_rate=10,
-                        output_amount=100_000,
-                    ),
-                )
-            )
-            logger.info("Sent funded tx: %s", txid)
-
-            result = Result(
-                tx_template=tx_template,
-                output_index=output_index,
-                spending_condition_index=spending_condition["index"],
-                error=None,
-            )
             try:
-                SpendCommand().run(
-                    Context(
-                        dbsession=dbsession,
-                        bitcoin_rpc=bitcoin_rpc,
-                        args=argparse.Namespace(
-                            setup_id=tx_template.setup_id,
-                            name=tx_template.name,
-                            spending_condition=spending_condition["index"],
-                            prevout=f"{txid}:{output_index}",
-                            prover_privkey=context.args.prover_privkey,
-                            verifier_privkey=context.args.verifier_privkey,
-                            to_address="OP_RETURN",
-                            amount=0,
-                        ),
-                    )
+                spending_txs[test_index] = create_spending_transaction(
+                    tx_template=tx_template,
+                    output_index=output_index,
+                    spending_condition_index=spending_condition["index"],
+                    prevout=COutPoint(
+                        hash=bytes.fromhex(funding_txid)[::-1], n=test_index
+                    ),
+                    spent_output=spent_outputs[test_index],
+                    prover_privkey=prover_privkey,
+                    verifier_privkey=verifier_privkey,
                 )
             except Exception as e:
-                result.error = e
+                results[test_index].error = e
                 logger.info("ERROR! %s", e)
+
+        sent = send_test_transactions(
+            bitcoin_rpc=bitcoin_rpc, txs=list(spending_txs.values())
+        )
+        for test_index, (txid, reason) in zip(spending_txs, sent):
+            if txid is None:
+                results[test_index].error = TestMempoolAcceptFailure(
+                    reject_reason=reason
+                )
+                logger.info("ERROR! %s", reason)
             else:
-                logger.info("Success!")
-            results.append(result)
+                logger.info("Spent %s", txid)
 
         num_success = len([r for r in results if r.error is None])
         num_fail = len([r for r in results if r.error is not None])
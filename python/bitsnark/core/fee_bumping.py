@@ -0,0 +1,452 @@
+"""Bump the fees of published funded transactions that are stuck in the mempool."""
+
+from __future__ import annotations
+import logging
+import math
+import typing
+from dataclasses import dataclass
+from fractions import Fraction
+
+from bitcointx.core import CMutableTransaction, CTransaction, CTxIn, CTxOut
+from bitcointx.core.psbt import PartiallySignedTransaction, PSBT_Input, PSBT_Output
+from bitcointx.wallet import CCoinAddress
+from sqlalchemy import exists
+from sqlalchemy.orm.session import Session
+
+from .funding import (
+    INCREMENTAL_RELAY_FEE_SAT_PER_VB,
+    MIN_NON_DUST_SAT,
+    OutOfFunds,
+    get_funded_tx_template_fee_sat,
+    get_signed_transaction_from_funded_tx_template,
+    refund_tx_template_from_wallet,
+)
+from .models import (
+    OutgoingStatus,
+    Received,
+    TransactionTemplate,
+    select_template_summaries,
+)
+from .timelocks import get_confirmation_deadline_height
+from .work_queue import process_claimed
+from ..btc.coin_selection import (
+    CoinSelector,
+    InsufficientFunds,
+    estimate_input_weight,
+    get_output_weight,
+    get_transaction_weight,
+)
+from ..btc.fee_estimation import FeeEstimator
+from ..btc.rpc import (
+    RPC_INVALID_ADDRESS_OR_KEY,
+    RPC_METHOD_NOT_FOUND,
+    BitcoinRPC,
+    JSONRPCError,
+)
+from ..btc.utxos import WalletUTXO, WalletUTXOManager
+from ..cli.broadcast import broadcast_transaction
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class FeeBumpPolicy:
+    """
+    When and how much to bump fees.
+
+    Transactions are funded at a low fee rate, and only bumped if they don't confirm: a transaction that is
+    still unconfirmed stuck_after_blocks blocks after entering the mempool gets its fee rate multiplied by
+    bump_factor. A transaction whose confirmation deadline (see get_confirmation_deadline_height) is at most
+    urgent_blocks blocks away is bumped to max_fee_rate_sat_per_vb right away.
+
+    With a fee estimate for the deadline (see FeeEstimator), the bumped fee rate is at least the estimate,
+    and urgent transactions are bumped to the estimate for the next block instead of the maximum.
+    """
+
+    max_fee_rate_sat_per_vb: int = 200
+    bump_factor: Fraction = Fraction(3, 2)
+    stuck_after_blocks: int = 2
+    urgent_blocks: int = 3
+
+    def is_urgent(self, blocks_left: int | None) -> bool:
+        return blocks_left is not None and blocks_left <= self.urgent_blocks
+
+    def get_bumped_fee_rate(
+        self,
+        fee_rate_sat_per_vb: Fraction,
+        *,
+        blocks_left: int | None,
+        estimated_fee_rate_sat_per_vb: Fraction | None = None,
+    ) -> Fraction:
+        if self.is_urgent(blocks_left) and estimated_fee_rate_sat_per_vb is None:
+            return Fraction(self.max_fee_rate_sat_per_vb)
+        return min(
+            Fraction(self.max_fee_rate_sat_per_vb),
+            max(
+                fee_rate_sat_per_vb * self.bump_factor,
+                fee_rate_sat_per_vb + INCREMENTAL_RELAY_FEE_SAT_PER_VB,
+                estimated_fee_rate_sat_per_vb or 0,
+            ),
+        )
+
+
+def bump_stuck_transactions(
+    dbsession: Session,
+    bitcoin_rpc: BitcoinRPC,
+    *,
+    tx_names: typing.Collection[str],
+    tip_height: int,
+    policy: FeeBumpPolicy,
+    utxo_manager: WalletUTXOManager | None = None,
+    fee_estimator: FeeEstimator | None = None,
+):
+    """
+    Claim published funded transactions (of templates with the given names) that are not confirmed yet
+    one at a time, and bump the fees of the stuck ones (see FeeBumpPolicy).
+
+    The funding of the template is replaced with one at a higher fee rate (RBF), which is possible as
+    the template's own input and output are signed with SIGHASH_SINGLE|ANYONECANPAY. If that would
+    evict transactions spending the template's output, or fails, a child spending the change of the
+    funding is attached instead (CPFP).
+    """
+
+    def bump(summary):
+        tx_template = dbsession.get(TransactionTemplate, summary.id)
+        bump_transaction_fee(
+            tx_template=tx_template,
+            dbsession=dbsession,
+            bitcoin_rpc=bitcoin_rpc,
+            tip_height=tip_height,
+            policy=policy,
+            utxo_manager=utxo_manager,
+            fee_estimator=fee_estimator,
+        )
+
+    process_claimed(
+        dbsession=dbsession,
+        query=select_template_summaries()
+        .where(TransactionTemplate.status == OutgoingStatus.PUBLISHED)
+        .where(TransactionTemplate.name.in_(tx_names))
+        .where(TransactionTemplate.fundable)
+        .where(TransactionTemplate.funded)
+        .where(~exists().where(Received.template_id == TransactionTemplate.id))
+        .order_by(TransactionTemplate.ordinal),
+        process=bump,
+    )
+
+
+def bump_transaction_fee(
+    *,
+    tx_template: TransactionTemplate,
+    dbsession: Session,
+    bitcoin_rpc: BitcoinRPC,
+    tip_height: int,
+    policy: FeeBumpPolicy,
+    utxo_manager: WalletUTXOManager | None = None,
+    fee_estimator: FeeEstimator | None = None,
+) -> bool:
+    """
+    Bump the fee of the published funded template, if it's stuck. Returns whether it was bumped.
+    With a fee_estimator, a transaction with a deadline is also bumped (before it's stuck) if its fee
+    rate is below the estimate for confirming in time.
+    """
+    txid = tx_template.txid
+    try:
+        mempool_entry = bitcoin_rpc.call_sats("getmempoolentry", txid)
+    except JSONRPCError as e:
+        if e.code != RPC_INVALID_ADDRESS_OR_KEY:
+            raise
+        mempool_entry = None
+
+    if mempool_entry is None:
+        try:
+            wallet_tx = bitcoin_rpc.call_sats("gettransaction", txid)
+        except JSONRPCError as e:
+            if e.code != RPC_INVALID_ADDRESS_OR_KEY:
+                raise
+            # None of its coins are ours, so it can't be told whether it's confirmed (and it can't be
+            # refunded from this wallet anyway)
+            logger.warning(
+                "%s is neither in the mempool nor a wallet transaction, not bumping it",
+                tx_template.name,
+            )
+            return False
+        if wallet_tx["confirmations"] != 0:
+            # Confirmed (the bitcoin listener will notice), or conflicted
+            logger.debug(
+                "%s is not in the mempool, but has %d confirmations",
+                tx_template.name,
+                wallet_tx["confirmations"],
+            )
+            return False
+        # Evicted, or never accepted (e.g. the fee rate was below the minimum of the mempool).
+        # The fee of gettransaction only counts the wallet's inputs, so it's computed from the template.
+        tx, fee_sat = get_funded_tx_template_fee_sat(
+            tx_template=tx_template,
+            dbsession=dbsession,
+            bitcoin_rpc=bitcoin_rpc,
+        )
+        vsize = tx.get_virtual_size()
+        fee_rate = Fraction(fee_sat, vsize)
+        replaced_fee_sat = 0
+        stuck = True
+    else:
+        fee_sat = mempool_entry["fees"]["base"]
+        vsize = mempool_entry["vsize"]
+        # Including children (e.g. an earlier CPFP)
+        fee_rate = max(
+            Fraction(fee_sat, vsize),
+            Fraction(
+                mempool_entry["fees"]["descendant"], mempool_entry["descendantsize"]
+            ),
+        )
+        replaced_fee_sat = mempool_entry["fees"]["descendant"]
+        stuck = tip_height - mempool_entry["height"] >= policy.stuck_after_blocks
+
+    deadline_height = get_confirmation_deadline_height(
+        dbsession=dbsession, tx_template=tx_template
+    )
+    blocks_left = None if deadline_height is None else deadline_height - tip_height
+    estimated_fee_rate = None
+    if fee_estimator is not None:
+        estimated_fee_rate = fee_estimator.get_fee_rate_for_deadline(
+            1 if policy.is_urgent(blocks_left) else blocks_left
+        )
+    behind_deadline = (
+        blocks_left is not None
+        and estimated_fee_rate is not None
+        and fee_rate < estimated_fee_rate
+    )
+    if not stuck and not policy.is_urgent(blocks_left) and not behind_deadline:
+        return False
+    new_fee_rate = policy.get_bumped_fee_rate(
+        fee_rate,
+        blocks_left=blocks_left,
+        estimated_fee_rate_sat_per_vb=estimated_fee_rate,
+    )
+    if new_fee_rate <= fee_rate:
+        logger.warning(
+            "%s is stuck at %.1f sat/vB, but its fee rate can't be bumped further",
+            tx_template.name,
+            fee_rate,
+        )
+        return False
+    logger.info(
+        "Bumping fee rate of %s from %.1f to %.1f sat/vB (%s)",
+        tx_template.name,
+        fee_rate,
+        new_fee_rate,
+        "no deadline" if blocks_left is None else f"{blocks_left} blocks to deadline",
+    )
+
+    spenders = (
+        {}
+        if mempool_entry is None
+        else _get_spenders(bitcoin_rpc, txid, mempool_entry["spentby"])
+    )
+    # Output 0 belongs to the protocol, its spenders must not be evicted
+    if 0 not in spenders:
+        try:
+            # Roll back the changes to the template if it can't be broadcast
+            with dbsession.begin_nested():
+                refund_tx_template_from_wallet(
+                    tx_template=tx_template,
+                    dbsession=dbsession,
+                    bitcoin_rpc=bitcoin_rpc,
+                    # Tested when broadcasting
+                    test_mempoolaccept=False,
+                    fee_rate_sat_per_vb=new_fee_rate,
+                    replaced_fee_sat=replaced_fee_sat,
+                    utxo_manager=utxo_manager,
+                    broadcast=lambda refunded_tx_template: broadcast_transaction(
+                        refunded_tx_template, dbsession, bitcoin_rpc
+                    ),
+                )
+            return True
+        except (OutOfFunds, ValueError, JSONRPCError) as e:
+            logger.warning(
+                "Cannot replace %s (%s), attaching a child instead", tx_template.name, e
+            )
+
+    parent_tx = get_signed_transaction_from_funded_tx_template(
+        tx_template=tx_template,
+        dbsession=dbsession,
+    )
+    attach_cpfp_child(
+        parent_tx=parent_tx,
+        parent_fee_sat=fee_sat,
+        parent_in_mempool=mempool_entry is not None,
+        # An earlier child spending the same change is replaced
+        replaced_fee_sat=(
+            bitcoin_rpc.call_sats("getmempoolentry", spenders[1])["fees"]["descendant"]
+            if 1 in spenders
+            else 0
+        ),
+        fee_rate_sat_per_vb=new_fee_rate,
+        bitcoin_rpc=bitcoin_rpc,
+        utxo_manager=utxo_manager,
+    )
+    return True
+
+
+def attach_cpfp_child(
+    *,
+    parent_tx: CTransaction,
+    parent_fee_sat: int,
+    parent_in_mempool: bool,
+    fee_rate_sat_per_vb: Fraction,
+    bitcoin_rpc: BitcoinRPC,
+    replaced_fee_sat: int = 0,
+    utxo_manager: WalletUTXOManager | None = None,
+) -> CTransaction:
+    """
+    Broadcast a child transaction spending the (wallet's) change of a funded transaction, so that the two
+    together pay fee_rate_sat_per_vb. If the parent is not in the mempool, both are submitted as a package.
+
+    The output 0 of the parent belongs to the protocol, so only its other outputs can be spent.
+    """
+    if len(parent_tx.vout) < 2:
+        raise OutOfFunds("Transaction has no change output to attach a child to")
+    parent_txid = parent_tx.GetTxid()[::-1].hex()
+    change_utxo = WalletUTXO(
+        txid=parent_txid,
+        vout=1,
+        amount_sat=parent_tx.vout[1].nValue,
+        script_pubkey=parent_tx.vout[1].scriptPubKey,
+        confirmations=0,
+    )
+    change_address = CCoinAddress(bitcoin_rpc.call("getrawchangeaddress"))
+
+    parent_fee_deficit_sat = max(
+        0,
+        math.ceil(fee_rate_sat_per_vb * parent_tx.get_virtual_size()) - parent_fee_sat,
+    )
+    child_selector = CoinSelector(
+        fee_rate_sat_per_vb=fee_rate_sat_per_vb,
+        # Segwit marker and flag, and the change input
+        base_weight=get_transaction_weight(CMutableTransaction())
+        + 2
+        + estimate_input_weight(change_utxo.script_pubkey),
+        base_value_sat=change_utxo.amount_sat - parent_fee_deficit_sat,
+        min_change_sat=MIN_NON_DUST_SAT + 1,
+        change_output_weight=get_output_weight(
+            CTxOut(nValue=0, scriptPubKey=change_address.to_scriptPubKey())
+        ),
+        # The change is the only output
+        require_change=True,
+    )
+    selection = None
+
+    def select_utxos(available_utxos: list[WalletUTXO]) -> list[WalletUTXO]:
+        nonlocal selection
+        change_key = (change_utxo.txid, change_utxo.vout)
+        other_utxos = [
+            utxo for utxo in available_utxos if (utxo.txid, utxo.vout) != change_key
+        ]
+        selector = child_selector
+        try:
+            selection = selector.select(other_utxos)
+            if selection.fee_sat < replaced_fee_sat + selection.vsize:
+                # Replacing an earlier child, which must be outbid
+                selector = selector.with_fee_rate(
+                    Fraction(replaced_fee_sat + selection.vsize, selection.vsize) + 1
+                )
+                selection = selector.select(other_utxos)
+        except InsufficientFunds as e:
+            raise OutOfFunds(f"Not enough funds for a CPFP child: {e}") from e
+        # The wallet might list the change as available too
+        return selection.utxos + [
+            utxo for utxo in available_utxos if (utxo.txid, utxo.vout) == change_key
+        ]
+
+    if utxo_manager is None:
+        utxo_manager = WalletUTXOManager(bitcoin_rpc)
+    utxo_manager.refresh_if_new_block()
+    reserved_utxos = utxo_manager.reserve(select_utxos)
+    try:
+        psbt = PartiallySignedTransaction()
+        for utxo in [change_utxo, *selection.utxos]:
+            psbt.add_input(CTxIn(prevout=utxo.outpoint), PSBT_Input(utxo=utxo.txout))
+        psbt.add_output(
+            CTxOut(
+                nValue=selection.change_sat,
+                scriptPubKey=change_address.to_scriptPubKey(),
+            ),
+            PSBT_Output(),
+        )
+        process_psbt_response = bitcoin_rpc.call("walletprocesspsbt", psbt.to_base64())
+        if not process_psbt_response["complete"]:
+            raise ValueError(
+                f"PSBT from walletprocesspsbt not complete: {process_psbt_response}"
+            )
+        child_tx = PartiallySignedTransaction.from_base64(
+            process_psbt_response["psbt"]
+        ).extract_transaction()
+
+        if parent_in_mempool:
+            bitcoin_rpc.call("sendrawtransaction", child_tx.serialize().hex())
+        else:
+            submit_package(bitcoin_rpc, [parent_tx, child_tx])
+    except BaseException:
+        utxo_manager.release(reserved_utxos)
+        raise
+    utxo_manager.mark_spent([change_utxo, *reserved_utxos])
+    logger.info(
+        "Attached child %s to %s, paying %d sat",
+        child_tx.GetTxid()[::-1].hex(),
+        parent_txid,
+        selection.fee_sat,
+    )
+    return child_tx
+
+
+def submit_package(bitcoin_rpc: BitcoinRPC, txs: typing.Sequence[CTransaction]):
+    """
+    Submit transactions (parents first) to the mempool together, so that children can pay for parents
+    that don't pay the minimum fee rate of the mempool alone. Falls back to sending them one by one if
+    the node doesn't support submitpackage.
+    """
+    tx_hexes = [tx.serialize().hex() for tx in txs]
+    try:
+        result = bitcoin_rpc.call("submitpackage", tx_hexes)
+    except JSONRPCError as e:
+        if e.code != RPC_METHOD_NOT_FOUND:
+            raise
+        logger.info("Node doesn't support submitpackage, sending one by one")
+        with bitcoin_rpc.batch() as batch:
+            send_calls = [
+                batch.call("sendrawtransaction", tx_hex) for tx_hex in tx_hexes
+            ]
+        for send_call in send_calls:
+            send_call.result()
+        return
+
+    tx_errors = [
+        tx_result["error"]
+        for tx_result in result.get("tx-results", {}).values()
+        if tx_result.get("error")
+    ]
+    # package_msg was added in Bitcoin Core 28
+    if result.get("package_msg", "success") != "success" or tx_errors:
+        raise ValueError(
+            f"Package not accepted: {result.get('package_msg')} {tx_errors}"
+        )
+
+
+def _get_spenders(
+    bitcoin_rpc: BitcoinRPC, txid: str, spending_txids: list[str]
+) -> dict[int, str]:
+    "Map outputs of the transaction to the (mempool) transactions spending them"
+    if not spending_txids:
+        return {}
+    with bitcoin_rpc.batch() as batch:
+        calls = {
+            spending_txid: batch.call("getrawtransaction", spending_txid, True)
+            for spending_txid in spending_txids
+        }
+    return {
+        tx_input["vout"]: spending_txid
+        for spending_txid, call in calls.items()
+        for tx_input in call.result()["vin"]
+        if tx_input.get("txid") == txid
+    }
@@ -1,5 +1,8 @@
+from __future__ import annotations
 import logging
+import typing
 from decimal import Decimal
+from fractions import Fraction
 
 from bitcointx.core import (
     CTransaction,
@@ -10,28 +13,30 @@ from bitcointx.core import (
     CTxInWitness,
 )
 from bitcointx.core.psbt import PartiallySignedTransaction, PSBT_Input, PSBT_Output
-from bitcointx.core.key import CKey
-from bitcointx.core.script import CScriptWitness, CScript
-from bitcointx.wallet import CCoinAddress, P2TRCoinAddress
+from bitcointx.core.script import CScript
+from bitcointx.wallet import CCoinAddress
 from sqlalchemy.orm.session import Session
 from sqlalchemy.orm.attributes import flag_modified
 
 from .models import TransactionTemplate
 from .parsing import serialize_hex, serialize_bignum, parse_hex_bytes, parse_bignum
-from .transactions import construct_signed_transaction
-from ..btc.rpc import BitcoinRPC
+from .transactions import SignedTransaction, construct_signed_transaction
+from ..btc.coin_selection import (
+    CHANGE_OUTPUT_WEIGHT,
+    CoinSelection,
+    CoinSelector,
+    InsufficientFunds,
+    get_output_weight,
+    get_transaction_weight,
+)
+from ..btc.rpc import BitcoinRPC, JSONRPCError, TestMempoolAcceptFailure
+from ..btc.utxos import WalletUTXO, WalletUTXOManager
 
 
 logger = logging.getLogger(__name__)
 MIN_NON_DUST_SAT = 546
-# Example values for psbt size estimation, determined empirically (might not be accurate)
-MOCK_OUTPUT = CTxOut(
-    nValue=MIN_NON_DUST_SAT,
-    scriptPubKey=P2TRCoinAddress.from_xonly_pubkey(
-        CKey.from_secret_bytes(b"1" * 32).xonly_pub
-    ).to_scriptPubKey(),
-)
-MOCK_SCRIPT_WITNESS = CScriptWitness([b"1" * 71, b"2" * 33])
+# Replacements must pay at least this much more than the transactions they replace (per vB of the replacement)
+INCREMENTAL_RELAY_FEE_SAT_PER_VB = 1
 
 
 class OutOfFunds(Exception):
@@ -55,6 +60,7 @@ def fund_tx_template_from_wallet(
     fee_rate_sat_per_vb: int | Decimal,
     change_address: str | CCoinAddress | None = None,
     lock_unspent: bool = True,
+    utxo_manager: WalletUTXOManager | None = None,
 ):
     """
     Fund a tx template from wallet, modifying it in place and storing results in the DB
@@ -68,8 +74,136 @@ def fund_tx_template_from_wallet(
         fee_rate_sat_per_vb=fee_rate_sat_per_vb,
         change_address=change_address,
         lock_unspent=lock_unspent,
+        utxo_manager=utxo_manager,
     )
 
+    _store_funded_transaction(tx_template=tx_template, tx=tx, dbsession=dbsession)
+
+
+def fund_tx_templates_from_wallet(
+    *,
+    tx_templates: typing.Sequence[TransactionTemplate],
+    dbsession: Session,
+    bitcoin_rpc: BitcoinRPC,
+    test_mempoolaccept: bool = True,
+    fee_rate_sat_per_vb: (
+        int | Decimal | Fraction | typing.Callable[[TransactionTemplate], Fraction]
+    ),
+    lock_unspent: bool = True,
+    utxo_manager: WalletUTXOManager | None = None,
+    presplit: bool = True,
+) -> list[Exception | None]:
+    """
+    Fund many tx templates from wallet together, modifying the funded ones in place and storing results in the DB
+
+    Coins for all templates are selected at once. If the wallet doesn't have enough separate coins for all of
+    them and presplit is set, a transaction splitting the wallet's coins into one (exactly sized) coin per
+    template is broadcast first. Change addresses are requested, PSBTs signed and transactions tested
+    with one (batched) request each, instead of once per template.
+
+    fee_rate_sat_per_vb can also be a function giving the fee rate of each template (e.g. by its deadline).
+
+    Returns one entry per template: None if it was funded, or the exception that prevented funding it.
+    """
+    errors: list[Exception | None] = [None] * len(tx_templates)
+    fundings: dict[int, _Funding] = {}
+    for index, tx_template in enumerate(tx_templates):
+        try:
+            fundings[index] = _Funding.prepare(
+                tx_template=tx_template,
+                dbsession=dbsession,
+                fee_rate_sat_per_vb=(
+                    fee_rate_sat_per_vb(tx_template)
+                    if callable(fee_rate_sat_per_vb)
+                    else fee_rate_sat_per_vb
+                ),
+            )
+        except Exception as e:
+            logger.exception("Cannot fund %s", tx_template.name)
+            errors[index] = e
+    if not fundings:
+        return errors
+
+    if utxo_manager is None:
+        utxo_manager = WalletUTXOManager(bitcoin_rpc)
+    utxo_manager.refresh_if_new_block()
+    unfundable = {}
+
+    def select_utxos(available_utxos: list[WalletUTXO]) -> list[WalletUTXO]:
+        # Each template gets coins from what is left by the previous ones
+        unfundable.clear()
+        selected_utxos = []
+        for index, funding in fundings.items():
+            try:
+                selection = funding.select(available_utxos)
+            except OutOfFunds as e:
+                unfundable[index] = e
+                continue
+            selected_utxos.extend(selection.utxos)
+            available_utxos = [
+                utxo for utxo in available_utxos if utxo not in selection.utxos
+            ]
+        return selected_utxos
+
+    selected_utxos = utxo_manager.reserve(select_utxos)
+    if unfundable:
+        # The wallet might have received coins since the last refresh
+        utxo_manager.release(selected_utxos)
+        utxo_manager.refresh()
+        selected_utxos = utxo_manager.reserve(select_utxos)
+    if unfundable and presplit and len(fundings) > 1:
+        # Probably not enough separate coins, rather than not enough funds
+        utxo_manager.release(selected_utxos)
+        try:
+            split_utxos = _split_wallet_coins(
+                fundings=list(fundings.values()),
+                bitcoin_rpc=bitcoin_rpc,
+                utxo_manager=utxo_manager,
+            )
+        except (OutOfFunds, ValueError, JSONRPCError, TestMempoolAcceptFailure) as e:
+            logger.warning("Cannot split wallet coins for funding: %s", e)
+            selected_utxos = utxo_manager.reserve(select_utxos)
+        else:
+            unfundable.clear()
+            for (index, funding), split_utxo in zip(fundings.items(), split_utxos):
+                try:
+                    funding.select([split_utxo])
+                except OutOfFunds as e:
+                    unfundable[index] = e
+    for index, e in unfundable.items():
+        errors[index] = e
+        del fundings[index]
+
+    try:
+        txs = _finalize_funded_psbts(
+            fundings=fundings,
+            bitcoin_rpc=bitcoin_rpc,
+            test_mempoolaccept=test_mempoolaccept,
+            lock_unspent=lock_unspent,
+            errors=errors,
+        )
+    except BaseException:
+        for funding in fundings.values():
+            utxo_manager.release(funding.selection.utxos)
+        raise
+
+    for index, funding in fundings.items():
+        if index in txs:
+            _store_funded_transaction(
+                tx_template=funding.tx_template, tx=txs[index], dbsession=dbsession
+            )
+            utxo_manager.mark_spent(funding.selection.utxos)
+        else:
+            utxo_manager.release(funding.selection.utxos)
+    return errors
+
+
+def _store_funded_transaction(
+    *,
+    tx_template: TransactionTemplate,
+    tx: CTransaction,
+    dbsession: Session,
+):
     for input_index, tx_input in enumerate(tx.vin):
         if input_index == 0:
             # First input is unchanged
@@ -102,6 +236,7 @@ def fund_tx_template_from_wallet(
 
     tx_template.txid = tx.GetTxid()[::-1].hex()
     tx_template.unknown_txid = False
+    tx_template.funded = True
     flag_modified(tx_template, "inputs")
     flag_modified(tx_template, "outputs")
 
@@ -166,6 +301,35 @@ def get_signed_transaction_from_funded_tx_template(
     return tx.to_immutable()
 
 
+def get_funded_tx_template_fee_sat(
+    *,
+    tx_template: TransactionTemplate,
+    dbsession: Session,
+    bitcoin_rpc: BitcoinRPC,
+) -> tuple[CTransaction, int]:
+    """
+    Get the transaction of a funded transaction template, and its fee: the amounts of the outputs it
+    spends (of the protocol input from the template, of the funding coins from the wallet) minus the
+    amounts of its outputs
+    """
+    tx = get_signed_transaction_from_funded_tx_template(
+        tx_template=tx_template,
+        dbsession=dbsession,
+    )
+    (protocol_spent_output,) = construct_signed_transaction(
+        tx_template=tx_template,
+        dbsession=dbsession,
+        ignore_funded_inputs_and_outputs=True,
+    ).signable_tx.spent_outputs
+    funding_spent_outputs = bitcoin_rpc.get_outputs(
+        [tx_input.prevout for tx_input in tx.vin[1:]]
+    )
+    spent_sat = protocol_spent_output.nValue + sum(
+        txout.nValue for txout in funding_spent_outputs
+    )
+    return tx, spent_sat - sum(txout.nValue for txout in tx.vout)
+
+
 def create_funded_transaction(
     *,
     tx_template: TransactionTemplate,
@@ -177,93 +341,475 @@ def create_funded_transaction(
         str | CCoinAddress | None
     ) = None,  # Default to getting an address from the wallet
     lock_unspent: bool = True,
+    utxo_manager: WalletUTXOManager | None = None,
 ) -> CTransaction:
     """
     Create a broadcastable transaction from a transaction template, funding it from the wallet
+
+    Pass a shared utxo_manager when funding many templates, so that the wallet's coins are not listed
+    again for each of them (and concurrent fundings don't pick the same coins).
     """
-    if not tx_template.fundable:
-        raise NotFundable(f"Transaction template {tx_template.name} is not fundable")
+    funding = _Funding.prepare(
+        tx_template=tx_template,
+        dbsession=dbsession,
+        fee_rate_sat_per_vb=fee_rate_sat_per_vb,
+        change_address=change_address,
+    )
 
-    if len(tx_template.inputs) != 1 or len(tx_template.outputs) != 1:
-        raise AlreadyFunded(
-            f"Transaction template {tx_template.name} seems to be already funded "
-            f"(has {len(tx_template.inputs)} inputs and {len(tx_template.outputs)} outputs)"
+    if utxo_manager is None:
+        utxo_manager = WalletUTXOManager(bitcoin_rpc)
+    utxo_manager.refresh_if_new_block()
+    try:
+        selected_utxos = utxo_manager.reserve(lambda utxos: funding.select(utxos).utxos)
+    except OutOfFunds:
+        # The wallet might have received coins since the last refresh
+        utxo_manager.refresh()
+        selected_utxos = utxo_manager.reserve(lambda utxos: funding.select(utxos).utxos)
+
+    try:
+        tx = _finalize_funded_psbt(
+            psbt=funding.make_psbt(),
+            change_sat=funding.selection.change_sat,
+            bitcoin_rpc=bitcoin_rpc,
+            test_mempoolaccept=test_mempoolaccept,
+            change_address=change_address,
+            lockable_utxos=(
+                [{"txid": utxo.txid, "vout": utxo.vout} for utxo in selected_utxos]
+                if lock_unspent
+                else []
+            ),
         )
+    except BaseException:
+        utxo_manager.release(selected_utxos)
+        raise
+    utxo_manager.mark_spent(selected_utxos)
+    return tx
 
-    signed_tx_envelope = construct_signed_transaction(
+
+def refund_tx_template_from_wallet(
+    *,
+    tx_template: TransactionTemplate,
+    dbsession: Session,
+    bitcoin_rpc: BitcoinRPC,
+    test_mempoolaccept: bool = True,
+    fee_rate_sat_per_vb: int | Decimal | Fraction,
+    replaced_fee_sat: int = 0,
+    utxo_manager: WalletUTXOManager | None = None,
+    broadcast: typing.Callable[[TransactionTemplate], typing.Any] | None = None,
+) -> CTransaction:
+    """
+    Replace the funding of a funded tx template with one at a higher fee rate (to replace-by-fee the funded
+    transaction if it's stuck), modifying it in place and storing results in the DB
+
+    The coins of the current funding are preferred, so usually only the change is smaller. The fee is raised
+    further if needed to pay replaced_fee_sat (the fees of all the transactions the replacement evicts from
+    the mempool) plus the incremental relay fee. Coins of the current funding that are no longer used are unlocked.
+
+    If broadcast is given, it's called with the refunded template, and the new coins are only locked (and the
+    unused ones unlocked) if it succeeds. Otherwise the new coins are released and the error is raised; the
+    caller should roll back the template then (e.g. with a savepoint).
+    """
+    current_tx = get_signed_transaction_from_funded_tx_template(
         tx_template=tx_template,
         dbsession=dbsession,
     )
-    signed_nonfunded_tx = signed_tx_envelope.tx
-
-    # Manually add the existing input (along with its witness data) and output to the PSBT
-    psbt = PartiallySignedTransaction()
-    psbt.add_input(
-        signed_nonfunded_tx.vin[0],
-        PSBT_Input(
-            final_script_witness=signed_nonfunded_tx.wit.vtxinwit[0].scriptWitness,
-            utxo=signed_tx_envelope.signable_tx.spent_outputs[0],
-        ),
+    current_outpoints = [tx_input.prevout for tx_input in current_tx.vin[1:]]
+    current_utxos = [
+        WalletUTXO(
+            txid=outpoint.hash[::-1].hex(),
+            vout=outpoint.n,
+            amount_sat=txout.nValue,
+            script_pubkey=txout.scriptPubKey,
+            confirmations=0,
+        )
+        for outpoint, txout in zip(
+            current_outpoints, bitcoin_rpc.get_outputs(current_outpoints)
+        )
+    ]
+    funding = _Funding.prepare(
+        tx_template=tx_template,
+        dbsession=dbsession,
+        fee_rate_sat_per_vb=fee_rate_sat_per_vb,
+        refund=True,
     )
-    psbt.add_output(signed_nonfunded_tx.vout[0], PSBT_Output())
-
-    # Sanity checks -- the PSBT should match the original transaction at this point
-    assert psbt.is_final()
-    _tx = psbt.extract_transaction()
-    assert _tx.serialize() == signed_nonfunded_tx.serialize()
-    del _tx
-
-    # Coin selection
-    # We default to coins with most confirmations (oldest coins) first
-    include_unsafe = False
-    available_utxos = bitcoin_rpc.call("listunspent", 0, 9999999, [], include_unsafe)
-    available_utxos.sort(key=lambda u: u["confirmations"], reverse=True)
-
-    lockable_utxos = []
-    while True:
-        psbt_size = estimate_funded_psbt_size_vb(psbt)
-        required_fee = int(fee_rate_sat_per_vb * psbt_size)
-        psbt_fee = psbt.get_fee(allow_negative=True)
 
-        logger.debug(
-            "Estimated PSBT size: %d vB, req fee: %d sat, fee: %d sat",
-            psbt_size,
-            required_fee,
-            psbt_fee,
+    def select_utxos(available_utxos: list[WalletUTXO]) -> list[WalletUTXO]:
+        # The current coins are not available (they are spent by the transaction being replaced)
+        selection = funding.select(current_utxos + available_utxos)
+        min_fee_sat = (
+            replaced_fee_sat + selection.vsize * INCREMENTAL_RELAY_FEE_SAT_PER_VB
+        )
+        if selection.fee_sat < min_fee_sat:
+            # Select again at the lowest fee rate that pays enough (with some slack, as the size might change)
+            funding.coin_selector = funding.coin_selector.with_fee_rate(
+                Fraction(min_fee_sat, selection.vsize) + 1
+            )
+            selection = funding.select(current_utxos + available_utxos)
+        return [utxo for utxo in selection.utxos if utxo not in current_utxos]
+
+    if utxo_manager is None:
+        utxo_manager = WalletUTXOManager(bitcoin_rpc)
+    utxo_manager.refresh_if_new_block()
+    new_utxos = utxo_manager.reserve(select_utxos)
+
+    try:
+        tx = _finalize_funded_psbt(
+            psbt=funding.make_psbt(),
+            change_sat=funding.selection.change_sat,
+            bitcoin_rpc=bitcoin_rpc,
+            test_mempoolaccept=test_mempoolaccept,
+            change_address=None,
+            # Locked below, once the replacement is used
+            lockable_utxos=[],
+        )
+        tx_template.inputs = [
+            inp for inp in tx_template.inputs if not inp.get("funded")
+        ]
+        tx_template.outputs = [
+            out for out in tx_template.outputs if not out.get("funded")
+        ]
+        _store_funded_transaction(tx_template=tx_template, tx=tx, dbsession=dbsession)
+        if broadcast is not None:
+            broadcast(tx_template)
+    except BaseException:
+        utxo_manager.release(new_utxos)
+        raise
+
+    # The current coins are locked already
+    if new_utxos:
+        logger.debug("Locking utxos: %s", new_utxos)
+        bitcoin_rpc.call(
+            "lockunspent",
+            False,
+            [{"txid": utxo.txid, "vout": utxo.vout} for utxo in new_utxos],
+        )
+    unused_utxos = [
+        utxo for utxo in current_utxos if utxo not in funding.selection.utxos
+    ]
+    if unused_utxos:
+        logger.debug("Unlocking utxos no longer used: %s", unused_utxos)
+        bitcoin_rpc.call(
+            "lockunspent",
+            True,
+            [{"txid": utxo.txid, "vout": utxo.vout} for utxo in unused_utxos],
         )
+    utxo_manager.mark_spent(new_utxos, new_utxos=unused_utxos)
+    return tx
 
-        if psbt_fee >= required_fee:
-            break
-        try:
-            utxo = available_utxos.pop(0)
-        except IndexError:
-            raise OutOfFunds(
-                f"Ran out of available UTXOs when trying to fund {tx_template.name}"
+
+class _Funding:
+    "Funding of one transaction template: the signed non-funded transaction, and the coins selected for it"
+
+    def __init__(
+        self,
+        *,
+        tx_template: TransactionTemplate,
+        signed_tx_envelope: SignedTransaction,
+        coin_selector: CoinSelector,
+    ):
+        self.tx_template = tx_template
+        self.signed_tx_envelope = signed_tx_envelope
+        self.coin_selector = coin_selector
+        self.selection: CoinSelection | None = None
+
+    @classmethod
+    def prepare(
+        cls,
+        *,
+        tx_template: TransactionTemplate,
+        dbsession: Session,
+        fee_rate_sat_per_vb: int | Decimal,
+        change_address: str | CCoinAddress | None = None,
+        refund: bool = False,
+    ) -> _Funding:
+        "Prepare funding the template. With refund, the existing funding of the template is ignored."
+        if not tx_template.fundable:
+            raise NotFundable(
+                f"Transaction template {tx_template.name} is not fundable"
+            )
+
+        if not refund and (
+            len(tx_template.inputs) != 1 or len(tx_template.outputs) != 1
+        ):
+            raise AlreadyFunded(
+                f"Transaction template {tx_template.name} seems to be already funded "
+                f"(has {len(tx_template.inputs)} inputs and {len(tx_template.outputs)} outputs)"
             )
 
+        signed_tx_envelope = construct_signed_transaction(
+            tx_template=tx_template,
+            dbsession=dbsession,
+            ignore_funded_inputs_and_outputs=refund,
+        )
+        signed_nonfunded_tx = signed_tx_envelope.tx
+
+        if change_address is None:
+            # The wallet picks the change address, assume the largest common kind
+            change_output_weight = CHANGE_OUTPUT_WEIGHT
+        else:
+            if isinstance(change_address, str):
+                change_address = CCoinAddress(change_address)
+            change_output_weight = get_output_weight(
+                CTxOut(nValue=0, scriptPubKey=change_address.to_scriptPubKey())
+            )
+        funding = cls(
+            tx_template=tx_template,
+            signed_tx_envelope=signed_tx_envelope,
+            coin_selector=CoinSelector(
+                fee_rate_sat_per_vb=fee_rate_sat_per_vb,
+                base_weight=get_transaction_weight(signed_nonfunded_tx),
+                base_value_sat=(
+                    signed_tx_envelope.signable_tx.spent_outputs[0].nValue
+                    - signed_nonfunded_tx.vout[0].nValue
+                ),
+                min_change_sat=MIN_NON_DUST_SAT + 1,
+                change_output_weight=change_output_weight,
+            ),
+        )
+
+        # Sanity checks -- the PSBT should match the original transaction at this point
+        _psbt = funding.make_psbt()
+        assert _psbt.is_final()
+        _tx = _psbt.extract_transaction()
+        assert _tx.serialize() == signed_nonfunded_tx.serialize()
+        return funding
+
+    def select(self, available_utxos: list[WalletUTXO]) -> CoinSelection:
+        "Select coins from available_utxos (most preferred first) for the template"
+        try:
+            self.selection = self.coin_selector.select(available_utxos)
+        except InsufficientFunds as e:
+            raise OutOfFunds(
+                f"Ran out of available UTXOs when trying to fund {self.tx_template.name}: {e}"
+            ) from e
         logger.debug(
-            "Adding UTXO %s:%d to fund %s", utxo["txid"], utxo["vout"], tx_template.name
+            "Selected %d UTXOs to fund %s: estimated size %d vB, fee %d sat, change %d sat",
+            len(self.selection.utxos),
+            self.tx_template.name,
+            self.selection.vsize,
+            self.selection.fee_sat,
+            self.selection.change_sat,
         )
+        return self.selection
 
-        prev_outpoint = COutPoint(bytes.fromhex(utxo["txid"])[::-1], utxo["vout"])
-        prev_output = bitcoin_rpc.get_output(prev_outpoint)
+    def make_psbt(self) -> PartiallySignedTransaction:
+        "PSBT of the template, with the selected coins (if any) as additional inputs (without change)"
+        signed_nonfunded_tx = self.signed_tx_envelope.tx
+        # Manually add the existing input (along with its witness data) and output to the PSBT
+        psbt = PartiallySignedTransaction()
         psbt.add_input(
-            CTxIn(
-                prevout=prev_outpoint,
-                nSequence=0,
-            ),
+            signed_nonfunded_tx.vin[0],
             PSBT_Input(
-                utxo=prev_output,  # This argument might not be necessary
+                final_script_witness=signed_nonfunded_tx.wit.vtxinwit[0].scriptWitness,
+                utxo=self.signed_tx_envelope.signable_tx.spent_outputs[0],
             ),
         )
-        lockable_utxos.append(
-            {
-                "txid": utxo["txid"],
-                "vout": utxo["vout"],
-            }
+        psbt.add_output(signed_nonfunded_tx.vout[0], PSBT_Output())
+        for utxo in self.selection.utxos if self.selection is not None else []:
+            psbt.add_input(
+                CTxIn(
+                    prevout=utxo.outpoint,
+                    nSequence=0,
+                ),
+                PSBT_Input(
+                    utxo=utxo.txout,  # This argument might not be necessary
+                ),
+            )
+        return psbt
+
+
+def _split_wallet_coins(
+    *,
+    fundings: list[_Funding],
+    bitcoin_rpc: BitcoinRPC,
+    utxo_manager: WalletUTXOManager,
+) -> list[WalletUTXO]:
+    """
+    Broadcast a transaction paying the wallet one coin for each funding, that is enough to fund it alone.
+    It pays the highest fee rate of the fundings, so that it doesn't hold any of them up.
+    Returns the new coins (which are not available in the utxo_manager), in the order of fundings.
+    """
+    with bitcoin_rpc.batch() as batch:
+        address_calls = [batch.call("getnewaddress") for _ in fundings]
+        change_address_call = batch.call("getrawchangeaddress")
+    split_tx = CMutableTransaction()
+    for funding, address_call in zip(fundings, address_calls):
+        script_pubkey = CCoinAddress(address_call.result()).to_scriptPubKey()
+        split_tx.vout.append(
+            CTxOut(
+                nValue=funding.coin_selector.single_coin_amount_sat(script_pubkey),
+                scriptPubKey=script_pubkey,
+            )
+        )
+    change_script_pubkey = CCoinAddress(change_address_call.result()).to_scriptPubKey()
+
+    split_selector = CoinSelector(
+        fee_rate_sat_per_vb=max(funding.coin_selector.fee_rate for funding in fundings),
+        # Segwit marker and flag
+        base_weight=get_transaction_weight(split_tx) + 2,
+        base_value_sat=-sum(txout.nValue for txout in split_tx.vout),
+        base_num_inputs=0,
+        min_change_sat=MIN_NON_DUST_SAT + 1,
+        change_output_weight=get_output_weight(
+            CTxOut(nValue=0, scriptPubKey=change_script_pubkey)
+        ),
+    )
+    selection = None
+
+    def select_utxos(available_utxos: list[WalletUTXO]) -> list[WalletUTXO]:
+        nonlocal selection
+        try:
+            selection = split_selector.select(available_utxos)
+        except InsufficientFunds as e:
+            raise OutOfFunds(f"Not enough funds to split for funding: {e}") from e
+        return selection.utxos
+
+    selected_utxos = utxo_manager.reserve(select_utxos)
+    try:
+        psbt = PartiallySignedTransaction()
+        for utxo in selected_utxos:
+            psbt.add_input(CTxIn(prevout=utxo.outpoint), PSBT_Input(utxo=utxo.txout))
+        for txout in split_tx.vout:
+            psbt.add_output(txout, PSBT_Output())
+        if selection.has_change:
+            psbt.add_output(
+                CTxOut(nValue=selection.change_sat, scriptPubKey=change_script_pubkey),
+                PSBT_Output(),
+            )
+        process_psbt_response = bitcoin_rpc.call("walletprocesspsbt", psbt.to_base64())
+        if not process_psbt_response["complete"]:
+            raise ValueError(
+                f"PSBT from walletprocesspsbt not complete: {process_psbt_response}"
+            )
+        tx = PartiallySignedTransaction.from_base64(
+            process_psbt_response["psbt"]
+        ).extract_transaction()
+        tx_hex = tx.serialize().hex()
+        mempoolaccept_ret = bitcoin_rpc.call("testmempoolaccept", [tx_hex])
+        if not mempoolaccept_ret[0]["allowed"]:
+            raise TestMempoolAcceptFailure(mempoolaccept_ret[0])
+        txid = bitcoin_rpc.call("sendrawtransaction", tx_hex)
+    except BaseException:
+        utxo_manager.release(selected_utxos)
+        raise
+
+    logger.info(
+        "Split wallet coins into %d coins for funding in %s", len(fundings), txid
+    )
+    split_utxos = [
+        WalletUTXO(
+            txid=txid,
+            vout=vout,
+            amount_sat=txout.nValue,
+            script_pubkey=txout.scriptPubKey,
+            confirmations=0,
+        )
+        for vout, txout in enumerate(tx.vout)
+    ]
+    utxo_manager.mark_spent(
+        selected_utxos,
+        new_utxos=split_utxos[len(fundings) :],
+    )
+    return split_utxos[: len(fundings)]
+
+
+def _finalize_funded_psbts(
+    *,
+    fundings: dict[int, _Funding],
+    bitcoin_rpc: BitcoinRPC,
+    test_mempoolaccept: bool,
+    lock_unspent: bool,
+    errors: list[Exception | None],
+) -> dict[int, CTransaction]:
+    """
+    Add change, sign the wallet inputs and lock them, for many fundings with batched requests.
+    Errors of individual fundings are stored in errors, only the successful transactions are returned.
+    """
+    psbts = {index: funding.make_psbt() for index, funding in fundings.items()}
+
+    with bitcoin_rpc.batch() as batch:
+        change_address_calls = {
+            index: batch.call("getnewaddress")
+            for index, funding in fundings.items()
+            if funding.selection.change_sat > MIN_NON_DUST_SAT
+        }
+    for index, change_address_call in change_address_calls.items():
+        psbts[index].add_output(
+            CTxOut(
+                nValue=fundings[index].selection.change_sat,
+                scriptPubKey=CCoinAddress(
+                    change_address_call.result()
+                ).to_scriptPubKey(),
+            ),
+            PSBT_Output(),
         )
 
-    change_sat = psbt_fee - required_fee
+    # Process the PSBTs using the bitcoin wallet. This will add signatures to recently added inputs
+    with bitcoin_rpc.batch() as batch:
+        process_psbt_calls = {
+            index: batch.call("walletprocesspsbt", psbt.to_base64())
+            for index, psbt in psbts.items()
+        }
+    txs = {}
+    for index, process_psbt_call in process_psbt_calls.items():
+        try:
+            process_psbt_response = process_psbt_call.result()
+            if not process_psbt_response["complete"]:
+                raise ValueError(
+                    f"PSBT from walletprocesspsbt not complete: {process_psbt_response}"
+                )
+            final_psbt = PartiallySignedTransaction.from_base64(
+                process_psbt_response["psbt"]
+            )
+            assert final_psbt.is_final()
+            txs[index] = final_psbt.extract_transaction()
+        except Exception as e:
+            logger.exception("Error signing %s", fundings[index].tx_template.name)
+            errors[index] = e
+
+    if test_mempoolaccept:
+        with bitcoin_rpc.batch() as batch:
+            mempoolaccept_calls = {
+                index: batch.call("testmempoolaccept", [tx.serialize().hex()])
+                for index, tx in txs.items()
+            }
+        for index, mempoolaccept_call in mempoolaccept_calls.items():
+            try:
+                mempoolaccept_ret = mempoolaccept_call.result()
+                if not mempoolaccept_ret[0]["allowed"]:
+                    raise TestMempoolAcceptFailure(mempoolaccept_ret[0])
+            except Exception as e:
+                logger.error(
+                    "Funded %s not accepted by mempool: %s",
+                    fundings[index].tx_template.name,
+                    e,
+                )
+                errors[index] = e
+                del txs[index]
+
+    # Lock used UTXOs to prevent accidental double-spending, if so requested
+    lockable_utxos = [
+        {"txid": utxo.txid, "vout": utxo.vout}
+        for index in txs
+        for utxo in fundings[index].selection.utxos
+    ]
+    if lock_unspent and lockable_utxos:
+        logger.debug("Locking utxos: %s", lockable_utxos)
+        bitcoin_rpc.call("lockunspent", False, lockable_utxos)
+
+    return txs
+
+
+def _finalize_funded_psbt(
+    *,
+    psbt: PartiallySignedTransaction,
+    change_sat: int,
+    bitcoin_rpc: BitcoinRPC,
+    test_mempoolaccept: bool,
+    change_address: str | CCoinAddress | None,
+    lockable_utxos: list[dict],
+) -> CTransaction:
+    "Add change, sign the wallet inputs and lock them"
     logger.debug("Change amount sat: %d", change_sat)
     if change_sat > MIN_NON_DUST_SAT:
         if change_address is None:
@@ -290,7 +836,7 @@ def create_funded_transaction(
     assert final_psbt.is_final()
 
     # Lock used UTXOs to prevent accidental double-spending, if so requested
-    if lock_unspent:
+    if lockable_utxos:
         logger.debug("Locking utxos: %s", lockable_utxos)
         bitcoin_rpc.call("lockunspent", False, lockable_utxos)
 
@@ -300,50 +846,3 @@ def create_funded_transaction(
         bitcoin_rpc.test_mempoolaccept(tx.serialize().hex())
 
     return tx
-
-
-def estimate_funded_psbt_size_vb(
-    psbt: PartiallySignedTransaction,
-    *,
-    add_change: bool = True,
-) -> int:
-    """
-    Estimate the virtual size of a PSBT that is being funded (for fee calculation).
-
-    As the witness data of all inputs is not known, this is not necessarily 100% correct.
-    """
-    estimated_psbt = PartiallySignedTransaction()
-
-    # Add outputs, these should already have all the data needed
-    for tx_output, psbt_output in zip(psbt.unsigned_tx.vout, psbt.outputs):
-        estimated_psbt.add_output(
-            tx_output,
-            psbt_output,
-        )
-
-    # Add inputs. For inputs that don't have witness data (i.e. no signatures), default to the mock witness
-    for tx_input, orig_psbt_input in zip(psbt.unsigned_tx.vin, psbt.inputs):
-        if orig_psbt_input.final_script_witness.is_null():
-            final_script_witness = MOCK_SCRIPT_WITNESS
-        else:
-            final_script_witness = orig_psbt_input.final_script_witness
-        if orig_psbt_input.utxo is None:
-            utxo = MOCK_OUTPUT
-        else:
-            utxo = orig_psbt_input.utxo
-        psbt_input = PSBT_Input(
-            final_script_witness=final_script_witness,
-            utxo=utxo,
-        )
-        estimated_psbt.add_input(
-            tx_input,
-            psbt_input,
-        )
-
-    if add_change:
-        estimated_psbt.add_output(
-            MOCK_OUTPUT,
-            PSBT_Output(),
-        )
-
-    return estimated_psbt.extract_transaction().get_virtual_size()
@@ -0,0 +1,325 @@
+"""asyncio runtime for the db listener, running each stage as its own task."""
+
+from __future__ import annotations
+import asyncio
+import contextlib
+import contextvars
+import logging
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Iterable
+
+import sqlalchemy as sa
+from sqlalchemy.orm.session import Session
+
+from ..btc.chain_tip import ChainTipWatcher
+from .notifications import StatusChangeListener, wait_for_status_changes
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before reconnecting the status change listener of an agent after an error, doubling
+# up to the poll interval
+RECONNECT_DELAY = 1
+
+
+@dataclass(frozen=True)
+class Stage:
+    """
+    A step of the listener, e.g. signing or broadcasting.
+
+    `run` does one pass over the DB and is blocking, so it's run in an executor thread
+    (with the stage's own Session).
+    """
+
+    name: str
+    run: Callable[[Session], None]
+    # Status changes in these tables wake the stage up
+    tables: tuple[str, ...] = ("setups", "templates")
+    # Stages to wake up after a pass of this stage
+    downstream: tuple[str, ...] = ()
+    # Wake the stage up when a new block arrives (needs a ChainTipWatcher)
+    on_new_block: bool = False
+
+
+@dataclass(frozen=True)
+class Agent:
+    "An agent DB and the stages to run against it"
+
+    agent_id: str
+    engine: sa.Engine
+    stages: list[Stage]
+
+
+@dataclass
+class _AgentListener:
+    "The status change listener of an agent, which is reconnected on its own if it fails"
+
+    agent: Agent
+    listener: StatusChangeListener | None = None
+    reconnect_delay: float = field(default_factory=lambda: RECONNECT_DELAY)
+    # Monotonic time of the next connection attempt while not connected
+    reconnect_at: float = 0
+
+    def connect(self):
+        listener = StatusChangeListener(self.agent.engine)
+        try:
+            listener.start()
+        except BaseException:
+            listener.close()
+            raise
+        self.listener = listener
+        self.reconnect_delay = RECONNECT_DELAY
+
+    def disconnect(self):
+        if self.listener is not None:
+            with contextlib.suppress(Exception):
+                self.listener.close()
+            self.listener = None
+
+    def schedule_reconnect(self, max_delay: float):
+        self.reconnect_at = time.monotonic() + self.reconnect_delay
+        self.reconnect_delay = min(self.reconnect_delay * 2, max_delay)
+
+
+def _find_failed_listeners(
+    listeners: Iterable[StatusChangeListener],
+) -> dict[StatusChangeListener, Exception | None]:
+    "Find the listeners whose connections fail, e.g. after an error waiting for all of them"
+    failed = {}
+    for listener in listeners:
+        try:
+            listener.drain()
+        except Exception as e:
+            failed[listener] = e
+    # Don't keep failing the same way if the error was elsewhere
+    return failed or {listener: None for listener in listeners}
+
+
+class ListenerRuntime:
+    """
+    Run listener stages concurrently, so that e.g. a slow broadcast doesn't hold up signing.
+
+    Stages are connected by queues of wake-up reasons. A stage is woken up by DB status changes
+    (see StatusChangeListener), by new blocks (see ChainTipWatcher), by upstream stages finishing a pass,
+    and by a slow fallback poll.
+    Wake-ups that arrive while a stage is busy are coalesced into one more pass.
+
+    Multiple agents can be served by the same runtime. By default every stage gets a thread of its own;
+    with max_workers, all stages of all agents share a pool of that many threads. Each stage has at most
+    one pass queued in the pool at a time and the pool is FIFO, so a busy agent can't starve the others.
+    The status change listener of each agent fails and reconnects on its own, so one DB going away
+    doesn't stop the notifications of the others.
+    """
+
+    def __init__(
+        self,
+        *,
+        agents: list[Agent],
+        poll_interval: float,
+        max_workers: int | None = None,
+        chain_tip_watcher: ChainTipWatcher | None = None,
+    ):
+        self._agents = agents
+        self._chain_tip_watcher = chain_tip_watcher
+        self._poll_interval = poll_interval
+        self._max_workers = max_workers
+        self._queues: dict[tuple[str, str], asyncio.Queue[str]] = {}
+
+    def run_forever(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        self._queues = {
+            (agent.agent_id, stage.name): asyncio.Queue()
+            for agent in self._agents
+            for stage in agent.stages
+        }
+        with contextlib.ExitStack() as exit_stack:
+            if self._max_workers is not None:
+                shared_executor = exit_stack.enter_context(
+                    ThreadPoolExecutor(
+                        max_workers=self._max_workers, thread_name_prefix="listener"
+                    )
+                )
+            else:
+                shared_executor = None
+
+            async with asyncio.TaskGroup() as task_group:
+                for agent in self._agents:
+                    for stage in agent.stages:
+                        task_group.create_task(
+                            self._run_stage(agent, stage, shared_executor),
+                            name=f"{agent.agent_id}/{stage.name}",
+                        )
+                task_group.create_task(self._watch_status_changes(), name="watcher")
+                if self._chain_tip_watcher is not None:
+                    task_group.create_task(
+                        self._watch_chain_tip(), name="chain-tip-watcher"
+                    )
+
+    def wake(self, agent_id: str, stage_name: str, reason: str):
+        self._queues[(agent_id, stage_name)].put_nowait(reason)
+
+    def _wake_agent(self, agent: Agent, reason: str):
+        for stage in agent.stages:
+            self.wake(agent.agent_id, stage.name, reason)
+
+    def _wake_all(self, reason: str):
+        for agent_id, stage_name in self._queues:
+            self.wake(agent_id, stage_name, reason)
+
+    async def _watch_status_changes(self):
+        agent_listeners = [_AgentListener(agent) for agent in self._agents]
+        try:
+            # Start listening before the first pass so that no changes are missed in between
+            for agent_listener in agent_listeners:
+                await self._connect(agent_listener, "startup")
+            await self._dispatch_status_changes(agent_listeners)
+        finally:
+            for agent_listener in agent_listeners:
+                agent_listener.disconnect()
+
+    async def _connect(self, agent_listener: _AgentListener, reason: str):
+        agent = agent_listener.agent
+        try:
+            await asyncio.to_thread(agent_listener.connect)
+        except Exception:
+            # Stages of the agent run on the poll until its listener is back
+            logger.exception(
+                "Cannot listen to status changes of %s, retrying in %.1fs",
+                agent.agent_id,
+                agent_listener.reconnect_delay,
+            )
+            agent_listener.schedule_reconnect(self._poll_interval)
+            self._wake_agent(agent, "poll")
+            return
+        self._wake_agent(agent, reason)
+
+    async def _dispatch_status_changes(self, agent_listeners: list[_AgentListener]):
+        poll_at = time.monotonic() + self._poll_interval
+        while True:
+            for agent_listener in agent_listeners:
+                if (
+                    agent_listener.listener is None
+                    and agent_listener.reconnect_at <= time.monotonic()
+                ):
+                    # Changes might have been missed while not listening
+                    await self._connect(agent_listener, "reconnected")
+            listeners = {
+                agent_listener.listener: agent_listener
+                for agent_listener in agent_listeners
+                if agent_listener.listener is not None
+            }
+            wake_at = min(
+                [poll_at]
+                + [
+                    agent_listener.reconnect_at
+                    for agent_listener in agent_listeners
+                    if agent_listener.listener is None
+                ]
+            )
+            try:
+                # A single thread waits for the notifications of all agents
+                changes_by_listener = await asyncio.to_thread(
+                    wait_for_status_changes,
+                    list(listeners),
+                    max(wake_at - time.monotonic(), 0),
+                )
+            except Exception:
+                failed = await asyncio.to_thread(_find_failed_listeners, listeners)
+                for listener, agent_listener in listeners.items():
+                    if listener in failed:
+                        # E.g. the DB connection was lost
+                        logger.error(
+                            "Error listening to status changes of %s, reconnecting in %.1fs",
+                            agent_listener.agent.agent_id,
+                            agent_listener.reconnect_delay,
+                            exc_info=failed[listener],
+                        )
+                        agent_listener.disconnect()
+                        agent_listener.schedule_reconnect(self._poll_interval)
+                        reason = "poll"
+                    else:
+                        # Its changes might have been lost with the error
+                        reason = "listener error"
+                    self._wake_agent(agent_listener.agent, reason)
+                continue
+
+            if any(changes_by_listener.values()):
+                poll_at = time.monotonic() + self._poll_interval
+            elif time.monotonic() >= poll_at:
+                self._wake_all("poll")
+                poll_at = time.monotonic() + self._poll_interval
+            for listener, changes in changes_by_listener.items():
+                agent = listeners[listener].agent
+                changed_tables = {change.table for change in changes}
+                for stage in agent.stages:
+                    if changed_tables.intersection(stage.tables):
+                        self.wake(agent.agent_id, stage.name, "notification")
+
+    async def _watch_chain_tip(self):
+        watcher = self._chain_tip_watcher
+        tip = None
+        while True:
+            try:
+                if tip is None:
+                    tip = await asyncio.to_thread(lambda: watcher.tip)
+                    logger.info("Chain tip is %s at height %d", tip.hash, tip.height)
+                    continue
+                new_tip = await asyncio.to_thread(watcher.wait, self._poll_interval)
+            except Exception:
+                # E.g. the node is restarting or still starting up. Stages still run on the fallback poll.
+                logger.exception("Error waiting for a new block")
+                await asyncio.sleep(self._poll_interval)
+                continue
+            if new_tip is None:
+                continue
+            tip = new_tip
+            for agent in self._agents:
+                for stage in agent.stages:
+                    if stage.on_new_block:
+                        self.wake(agent.agent_id, stage.name, f"block {tip.height}")
+
+    async def _run_stage(
+        self, agent: Agent, stage: Stage, shared_executor: Executor | None
+    ):
+        loop = asyncio.get_running_loop()
+        queue = self._queues[(agent.agent_id, stage.name)]
+        dbsession = Session(agent.engine, autobegin=False)
+        with contextlib.ExitStack() as exit_stack:
+            if shared_executor is not None:
+                executor = shared_executor
+            else:
+                executor = exit_stack.enter_context(
+                    ThreadPoolExecutor(
+                        max_workers=1,
+                        thread_name_prefix=f"listener-{agent.agent_id}-{stage.name}",
+                    )
+                )
+
+            while True:
+                reasons = {await queue.get()}
+                while not queue.empty():
+                    reasons.add(queue.get_nowait())
+                logger.debug(
+                    "Running stage %s for %s (%s)",
+                    stage.name,
+                    agent.agent_id,
+                    ", ".join(reasons),
+                )
+
+                # Run in a copy of the current context, so that e.g. the selected bitcointx chain params
+                # (which are context variables) are visible in the executor thread too
+                context = contextvars.copy_context()
+                try:
+                    await loop.run_in_executor(
+                        executor, context.run, stage.run, dbsession
+                    )
+                except Exception:
+                    logger.exception(
+                        "Error in stage %s for %s", stage.name, agent.agent_id
+                    )
+
+                for name in stage.downstream:
+                    self.wake(agent.agent_id, name, stage.name)
@@ -1,11 +1,30 @@
 from __future__ import annotations
 import datetime
 import enum
-from typing import TypedDict, Optional, ClassVar, Any
-from sqlalchemy.orm import Mapped, mapped_column, declarative_base
-from sqlalchemy import Column, Integer, JSON, String, Boolean, TIMESTAMP, Enum
+import logging
+from typing import TypedDict, Optional, ClassVar, Any, Iterable, NamedTuple
+from sqlalchemy.orm import Mapped, mapped_column, declarative_base, object_session
+from sqlalchemy.orm.session import Session
+from sqlalchemy import (
+    select,
+    Select,
+    Row,
+    Column,
+    Integer,
+    JSON,
+    String,
+    Boolean,
+    TIMESTAMP,
+    Enum,
+    LargeBinary,
+    false,
+)
 from sqlalchemy.schema import FetchedValue
 
+from .parsing import parse_hex_bytes
+
+logger = logging.getLogger(__name__)
+
 
 class SetupStatus(enum.Enum):
     PENDING = "PENDING"
@@ -32,6 +51,7 @@ class Setups(Base):
     protocol_version: Mapped[str] = mapped_column(String, nullable=False)
     status: Mapped[str] = mapped_column(Enum(SetupStatus), nullable=False)
     last_checked_block_height: Mapped[Optional[int]] = mapped_column(Integer)
+    broadcast_checked_block_height: Mapped[Optional[int]] = mapped_column(Integer)
     payload_txid: Mapped[Optional[str]] = mapped_column(String)
     payload_output_index: Mapped[Optional[int]] = mapped_column(Integer)
     payload_amount: Mapped[Optional[int]] = mapped_column(Integer)
@@ -53,6 +73,9 @@ class TransactionTemplate(Base):
     is_external: Mapped[bool] = mapped_column(Boolean, nullable=False)
     unknown_txid: Mapped[bool] = mapped_column(Boolean, nullable=False)
     fundable: Mapped[bool] = mapped_column(Boolean, nullable=False)
+    funded: Mapped[bool] = mapped_column(
+        Boolean, nullable=False, server_default=false()
+    )
     ordinal: Mapped[Optional[int]] = Column(Integer)
     inputs: Mapped[list] = mapped_column(JSON, nullable=False)
     outputs: Mapped[list] = mapped_column(JSON, nullable=False)
@@ -69,6 +92,120 @@ class TransactionTemplate(Base):
             f"role={self.role}, is_external={self.is_external}, inputs=..., outputs=...)>"
         )
 
+    def load_script(self, obj: dict, key: str = "script") -> Optional[bytes]:
+        """
+        Get script bytes (or e.g. a control block) from an input or a spending condition of this template.
+
+        The bytes are either inline in the JSON (`script`) or stored in the scripts table by hash
+        (`scriptHash`), in which case they are loaded from the DB only now.
+        Returns None if the object has neither.
+        """
+        raw = obj.get(key)
+        if raw is not None:
+            return parse_hex_bytes(raw)
+        hash_raw = obj.get(f"{key}Hash")
+        if hash_raw is None:
+            return None
+        dbsession = object_session(self)
+        if dbsession is None:
+            raise ValueError(
+                f"Cannot load {key} of {self.name}: template is not attached to a session"
+            )
+        # Session.get uses the identity map, so each script is only loaded once per session
+        script = dbsession.get(Script, parse_hex_bytes(hash_raw))
+        if script is None:
+            raise LookupError(f"{key} with hash {hash_raw} of {self.name} not found")
+        return script.script_bytes
+
+
+class TemplateSummary(NamedTuple):
+    """
+    Lightweight projection of a tx template, without the (potentially huge) inputs, outputs and
+    protocol_data. The fields have the same names as the columns of TransactionTemplate.
+    """
+
+    id: int
+    txid: str
+    setup_id: str
+    name: str
+    role: str
+    is_external: bool
+    unknown_txid: bool
+    fundable: bool
+    ordinal: Optional[int]
+    status: OutgoingStatus
+    updated_at: datetime.datetime
+
+
+def select_template_summaries() -> Select:
+    """
+    Select the columns of TemplateSummary, for scheduling decisions that only need the template metadata.
+    Load the full templates (see load_tx_templates) only for the ones that are actually processed.
+    """
+    return select(
+        *(getattr(TransactionTemplate, name) for name in TemplateSummary._fields)
+    )
+
+
+def load_tx_templates(
+    dbsession: Session, summaries: Iterable[TemplateSummary | Row]
+) -> list[TransactionTemplate]:
+    """
+    Load the full templates of the summaries (or rows with an id) in one query, in the same order.
+
+    Templates deleted since the summaries were selected are left out.
+    """
+    ids = [summary.id for summary in summaries]
+    if not ids:
+        return []
+    by_id = {
+        tx_template.id: tx_template
+        for tx_template in dbsession.scalars(
+            select(TransactionTemplate).where(TransactionTemplate.id.in_(ids))
+        )
+    }
+    missing_ids = [id_ for id_ in ids if id_ not in by_id]
+    if missing_ids:
+        logger.info("Tx templates %s were deleted, skipping them", missing_ids)
+    return [by_id[id_] for id_ in ids if id_ in by_id]
+
+
+def has_script(obj: dict, key: str = "script") -> bool:
+    "Does the input or spending condition have a script (inline or by hash)"
+    return key in obj or f"{key}Hash" in obj
+
+
+class Received(Base):
+    "Transactions of tx templates found on chain (by the bitcoin listener of the agent)"
+
+    __tablename__ = "received"
+    template_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    txid: Mapped[str] = mapped_column(String, nullable=False)
+    block_hash: Mapped[str] = mapped_column(String, nullable=False)
+    block_height: Mapped[int] = mapped_column(Integer, nullable=False)
+    index_in_block: Mapped[int] = mapped_column(Integer, nullable=False)
+    detected_at: Mapped[datetime.datetime] = mapped_column(
+        TIMESTAMP, server_default=FetchedValue(), nullable=False
+    )
+
+
+class Script(Base):
+    __tablename__ = "scripts"
+    hash: Mapped[bytes] = mapped_column(LargeBinary, primary_key=True)
+    script_bytes: Mapped[bytes] = mapped_column("bytes", LargeBinary, nullable=False)
+
+
+class TemplateSignature(Base):
+    __tablename__ = "signatures"
+    setup_id: Mapped[str] = mapped_column(String, primary_key=True)
+    template_name: Mapped[str] = mapped_column(String, primary_key=True)
+    input_index: Mapped[int] = mapped_column(Integer, primary_key=True)
+    role: Mapped[str] = mapped_column(String, primary_key=True)
+    signature: Mapped[str] = mapped_column(String, nullable=False)
+    updated_at: Mapped[datetime.datetime] = mapped_column(
+        TIMESTAMP, server_default=FetchedValue(), nullable=False
+    )
+
 
 JsonHexStr = str
 JsonBigNum = str
@@ -0,0 +1,125 @@
+"""Wake up on DB status changes using postgres LISTEN/NOTIFY."""
+
+from __future__ import annotations
+import json
+import logging
+import select
+import time
+from dataclasses import dataclass
+
+import sqlalchemy as sa
+
+logger = logging.getLogger(__name__)
+
+# Must match the channel in notify_status_change() in db/schema.sql
+STATUS_CHANNEL = "bitsnark_status"
+
+
+@dataclass(frozen=True)
+class StatusChange:
+    table: str
+    id: str | int
+    status: str
+
+
+class StatusChangeListener:
+    """
+    Listen to status changes of setups and templates.
+
+    Uses its own autocommit connection, as notifications are only delivered outside of transactions.
+    """
+
+    def __init__(self, engine: sa.Engine, *, channel: str = STATUS_CHANNEL):
+        self._engine = engine
+        self._channel = channel
+        self._conn: sa.Connection | None = None
+
+    def __enter__(self) -> StatusChangeListener:
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        self._conn = self._engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT"
+        )
+        self._conn.exec_driver_sql(f"LISTEN {self._channel}")
+        logger.info("Listening to status changes on channel %s", self._channel)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def fileno(self) -> int:
+        "File descriptor of the underlying connection, for select()"
+        return self._driver_connection.fileno()
+
+    @property
+    def _driver_connection(self):
+        if self._conn is None:
+            raise RuntimeError("Listener not started")
+        return self._conn.connection.driver_connection
+
+    def wait(self, timeout: float, *, settle_time: float = 0.05) -> list[StatusChange]:
+        """
+        Block until at least one status change is received or timeout seconds have passed.
+
+        Changes arriving within settle_time of the first one are returned together,
+        so that a burst of updates (e.g. a whole setup) only wakes us up once.
+        Returns an empty list on timeout.
+        """
+        return wait_for_status_changes([self], timeout, settle_time=settle_time)[self]
+
+    def drain(self) -> list[StatusChange]:
+        "Return the changes received so far, without blocking"
+        driver_conn = self._driver_connection
+        driver_conn.poll()
+        changes = []
+        while driver_conn.notifies:
+            notify = driver_conn.notifies.pop(0)
+            try:
+                payload = json.loads(notify.payload)
+                changes.append(
+                    StatusChange(
+                        table=payload["table"],
+                        id=payload["id"],
+                        status=payload["status"],
+                    )
+                )
+            except (ValueError, KeyError):
+                logger.warning("Ignoring invalid notification: %s", notify.payload)
+        return changes
+
+
+def wait_for_status_changes(
+    listeners: list[StatusChangeListener],
+    timeout: float,
+    *,
+    settle_time: float = 0.05,
+) -> dict[StatusChangeListener, list[StatusChange]]:
+    """
+    Like StatusChangeListener.wait, but wait on multiple listeners (e.g. one per agent DB) at once.
+    """
+    changes = {listener: listener.drain() for listener in listeners}
+
+    def select_and_drain(wait_time: float) -> None:
+        readable, _, _ = select.select(listeners, [], [], wait_time)
+        for listener in readable:
+            changes[listener].extend(listener.drain())
+
+    deadline = time.monotonic() + timeout
+    while not any(changes.values()):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return changes
+        select_and_drain(remaining)
+
+    settle_deadline = time.monotonic() + settle_time
+    while (remaining := settle_deadline - time.monotonic()) > 0:
+        select_and_drain(remaining)
+
+    logger.debug("Received %d status changes", sum(len(c) for c in changes.values()))
+    return changes
@@ -0,0 +1,71 @@
+"""Wait for the agents to catch up with the chain, instead of sleeping for a fixed time."""
+
+import logging
+import time
+from typing import Callable, Iterable
+
+import sqlalchemy as sa
+from sqlalchemy.orm.session import Session
+
+from .models import Setups
+
+logger = logging.getLogger(__name__)
+
+
+def wait_until(
+    condition: Callable[[], bool],
+    *,
+    timeout: float,
+    poll_interval: float = 0.05,
+    max_poll_interval: float = 1,
+    description: str = "condition",
+):
+    """
+    Call condition until it returns True.
+
+    The poll interval doubles after every try (up to max_poll_interval), so that a condition that
+    becomes true quickly is noticed quickly. Raises TimeoutError after timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        if condition():
+            return
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Timed out after {timeout}s waiting for {description}")
+        time.sleep(min(poll_interval, remaining))
+        poll_interval = min(poll_interval * 2, max_poll_interval)
+
+
+def wait_for_setups_checked_height(
+    dbsession: Session,
+    height: int,
+    *,
+    setup_ids: Iterable[str] | None = None,
+    timeout: float = 30,
+) -> int:
+    """
+    Wait until the listener of the agent has checked the blocks up to height for the setups
+    (all setups if setup_ids is None), as recorded in setups.last_checked_block_height.
+    Returns the lowest checked height of the setups.
+    """
+    query = sa.select(
+        sa.func.min(sa.func.coalesce(Setups.last_checked_block_height, -1))
+    )
+    if setup_ids is not None:
+        query = query.filter(Setups.id.in_(list(setup_ids)))
+
+    checked_height = None
+
+    def is_checked() -> bool:
+        nonlocal checked_height
+        checked_height = dbsession.scalar(query)
+        return checked_height is not None and checked_height >= height
+
+    wait_until(
+        is_checked,
+        timeout=timeout,
+        description=f"the setups to be checked up to block {height}",
+    )
+    logger.debug("Setups checked up to block %s", checked_height)
+    return checked_height
@@ -0,0 +1,446 @@
+"""
+Peephole optimization of scripts, with a declarative table of rewrite rules.
+
+Rules are written like "OP_1 OP_ROLL -> OP_SWAP". `<a>`, `<b>`... match any single push (data or a
+small number) and can be used on both sides, e.g. "<a> <b> OP_SWAP -> <b> <a>".
+
+Every rule is checked when the optimizer is created, by running both sides on a symbolic model of the
+stacks: for every initial stack depth where the pattern runs, the replacement must run too and leave the
+same stacks (and check the same conditions with VERIFY), and where the pattern fails the replacement must
+fail too. A rule that isn't equivalent, or that uses opcodes the model doesn't know, is rejected. So
+rules that only cancel out operations (like "OP_DUP OP_DROP ->") aren't allowed, as they would make a
+script that fails on a too short stack succeed. Replacements must also be smaller than their patterns, so
+that rewriting always terminates.
+"""
+
+from __future__ import annotations
+import logging
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Iterable, Sequence, Union
+
+from bitcointx.core.script import (
+    CScript,
+    CScriptOp,
+    OPCODES_BY_NAME,
+    OP_0,
+    OP_1,
+    OP_16,
+    OP_1NEGATE,
+    OP_CODESEPARATOR,
+    OP_PUSHDATA4,
+)
+from bitcointx.core.scripteval import EvalScriptError
+
+from ..scripteval import eval_tapscript
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RULES = (
+    # Constant PICK/ROLL
+    "OP_0 OP_PICK -> OP_DUP",
+    "OP_1 OP_PICK -> OP_OVER",
+    "OP_1 OP_ROLL -> OP_SWAP",
+    "OP_2 OP_ROLL -> OP_ROT",
+    "OP_3 OP_PICK OP_3 OP_PICK -> OP_2OVER",
+    "OP_2 OP_PICK OP_2 OP_PICK OP_2 OP_PICK -> OP_3DUP",
+    "OP_3 OP_ROLL OP_3 OP_ROLL -> OP_2SWAP",
+    "OP_5 OP_ROLL OP_5 OP_ROLL -> OP_2ROT",
+    # Combined stack operations
+    "OP_OVER OP_OVER -> OP_2DUP",
+    "OP_DROP OP_DROP -> OP_2DROP",
+    "OP_SWAP OP_DROP -> OP_NIP",
+    "OP_NIP OP_DROP -> OP_2DROP",
+    "OP_SWAP OP_OVER -> OP_TUCK",
+    # Pushes that cancel out
+    "<a> OP_DROP ->",
+    "<a> <b> OP_2DROP ->",
+    "<a> <b> OP_SWAP -> <b> <a>",
+    # Shorter forms of operations
+    "OP_1 OP_ADD -> OP_1ADD",
+    "OP_1 OP_SUB -> OP_1SUB",
+    "OP_EQUAL OP_VERIFY -> OP_EQUALVERIFY",
+    "OP_NUMEQUAL OP_VERIFY -> OP_NUMEQUALVERIFY",
+    "OP_CHECKSIG OP_VERIFY -> OP_CHECKSIGVERIFY",
+)
+
+# Max initial depth of the stacks the rules are checked with
+MAX_CHECKED_DEPTH = 10
+
+# A script item is an opcode or the data of a push (small numbers are opcodes, e.g. OP_5)
+Item = Union[CScriptOp, bytes]
+
+
+class InvalidRule(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class Placeholder:
+    "Stands for any single push in a rule"
+
+    name: str
+
+
+Token = Union[CScriptOp, Placeholder]
+
+
+@dataclass(frozen=True)
+class Rule:
+    text: str
+    pattern: tuple[Token, ...]
+    replacement: tuple[Token, ...]
+
+    @classmethod
+    def parse(cls, text: str) -> Rule:
+        pattern, arrow, replacement = text.partition("->")
+        if not arrow:
+            raise InvalidRule(f"Rule {text!r} has no '->'")
+        ret = cls(
+            text=text,
+            pattern=_parse_tokens(pattern, text),
+            replacement=_parse_tokens(replacement, text),
+        )
+        if not ret.pattern:
+            raise InvalidRule(f"Rule {text!r} has an empty pattern")
+        unbound = {t for t in ret.replacement if isinstance(t, Placeholder)} - set(
+            ret.pattern
+        )
+        if unbound:
+            raise InvalidRule(f"Rule {text!r} uses unmatched placeholders: {unbound}")
+        return ret
+
+    def match(self, items: Sequence[Item]) -> dict[Placeholder, Item] | None:
+        "Match the pattern to the items (of the same length)"
+        bindings: dict[Placeholder, Item] = {}
+        for token, item in zip(self.pattern, items):
+            if isinstance(token, Placeholder):
+                if not is_push(item) or bindings.setdefault(token, item) != item:
+                    return None
+            elif not isinstance(item, CScriptOp) or item != token:
+                return None
+        return bindings
+
+    def apply(self, bindings: dict[Placeholder, Item]) -> list[Item]:
+        return [
+            bindings[token] if isinstance(token, Placeholder) else token
+            for token in self.replacement
+        ]
+
+
+@dataclass
+class OptimizationResult:
+    script: CScript
+    original_size: int
+    # Number of times each rule was applied
+    applied_rules: Counter[str] = field(default_factory=Counter)
+
+    @property
+    def savings(self) -> int:
+        return self.original_size - len(self.script)
+
+
+class PeepholeOptimizer:
+    def __init__(self, rules: Iterable[str] = DEFAULT_RULES):
+        self.rules = [Rule.parse(text) for text in rules]
+        for rule in self.rules:
+            check_rule(rule)
+        self.max_pattern_length = max(len(rule.pattern) for rule in self.rules)
+        # Rules by the last token of the pattern (None for placeholders)
+        self._rules_by_last_token: dict[CScriptOp | None, list[Rule]] = {}
+        for rule in self.rules:
+            last = rule.pattern[-1]
+            key = None if isinstance(last, Placeholder) else last
+            self._rules_by_last_token.setdefault(key, []).append(rule)
+
+    def optimize(self, script: CScript) -> OptimizationResult:
+        """
+        Rewrite the script with the rules until none of them match.
+
+        The items are moved from the input to the output one by one, and each rule whose pattern ends
+        with the last item is tried on the end of the output. The replacement of a match is put back on
+        the input, so that it can be part of further matches.
+        """
+        result = OptimizationResult(script=script, original_size=len(script))
+        items = get_script_items(script)
+        if OP_CODESEPARATOR in items:
+            # Signatures commit to the position of the last executed OP_CODESEPARATOR
+            logger.info("Not optimizing a script with OP_CODESEPARATOR")
+            return result
+
+        pending = items[::-1]
+        output: list[Item] = []
+        while pending:
+            item = pending.pop()
+            output.append(item)
+            candidates = self._rules_by_last_token.get(
+                item if isinstance(item, CScriptOp) else None, []
+            )
+            if is_push(item) and isinstance(item, CScriptOp):
+                candidates = candidates + self._rules_by_last_token.get(None, [])
+            for rule in candidates:
+                length = len(rule.pattern)
+                if length > len(output):
+                    continue
+                bindings = rule.match(output[-length:])
+                if bindings is None:
+                    continue
+                del output[-length:]
+                pending.extend(reversed(rule.apply(bindings)))
+                # Items before the match might now match with the replacement
+                num_back = min(self.max_pattern_length - 1, len(output))
+                if num_back:
+                    pending.extend(reversed(output[-num_back:]))
+                    del output[-num_back:]
+                result.applied_rules[rule.text] += 1
+                break
+
+        result.script = CScript(output)
+        return result
+
+
+def optimize_script(script: CScript) -> CScript:
+    return PeepholeOptimizer().optimize(script).script
+
+
+def check_equivalent_by_eval(
+    original: CScript,
+    optimized: CScript,
+    witness_stacks: Iterable[list[bytes]],
+) -> list[str]:
+    """
+    Differential check of an optimization: evaluate both scripts with each witness stack (ignoring
+    signature checks), and return a description of each case where the outcomes differ: one fails
+    and the other doesn't, or they leave different stacks.
+    """
+    mismatches = []
+    for index, witness_elems in enumerate(witness_stacks):
+        original_outcome = _get_eval_outcome(original, witness_elems)
+        optimized_outcome = _get_eval_outcome(optimized, witness_elems)
+        # The reasons can differ, e.g. OP_1 OP_PICK and OP_OVER on a stack of one item
+        both_fail = original_outcome[0] == optimized_outcome[0] == "error"
+        if original_outcome != optimized_outcome and not both_fail:
+            mismatches.append(
+                f"witness {index}: original: {original_outcome}, optimized: {optimized_outcome}"
+            )
+    return mismatches
+
+
+def _get_eval_outcome(script: CScript, witness_elems: list[bytes]) -> tuple:
+    try:
+        stack = eval_tapscript(
+            witness_elems=witness_elems,
+            script=script,
+            ignore_signature_errors=True,
+            verify_stack=False,
+        )
+    except EvalScriptError as e:
+        return ("error", type(e).__name__)
+    return ("ok", list(stack))
+
+
+def get_script_items(script: CScript) -> list[Item]:
+    return [
+        data if data is not None and OP_0 < op <= OP_PUSHDATA4 else CScriptOp(op)
+        for op, data, _ in script.raw_iter()
+    ]
+
+
+def is_push(item: Item) -> bool:
+    return (
+        isinstance(item, bytes) or item in (OP_0, OP_1NEGATE) or OP_1 <= item <= OP_16
+    )
+
+
+def check_rule(rule: Rule):
+    """
+    Check that the replacement of the rule is smaller, and equivalent to the pattern: that for each
+    initial depth of the stacks where the pattern runs, the replacement leaves the same stacks, and
+    that it fails where the pattern fails.
+    """
+    size_diff = _get_fixed_size(rule.replacement) - _get_fixed_size(rule.pattern)
+    placeholders_added = Counter(
+        t for t in rule.replacement if isinstance(t, Placeholder)
+    ) - Counter(t for t in rule.pattern if isinstance(t, Placeholder))
+    if size_diff >= 0 or placeholders_added:
+        raise InvalidRule(f"Rule {rule.text!r} doesn't make scripts smaller")
+
+    num_checked = 0
+    for depth in range(MAX_CHECKED_DEPTH + 1):
+        for alt_depth in range(MAX_CHECKED_DEPTH + 1):
+            where = f"with {depth} stack items and {alt_depth} altstack items"
+            expected, pattern_error = _try_run_symbolic(rule.pattern, depth, alt_depth)
+            actual, replacement_error = _try_run_symbolic(
+                rule.replacement, depth, alt_depth
+            )
+            if pattern_error is not None:
+                if replacement_error is None:
+                    raise InvalidRule(
+                        f"Rule {rule.text!r}: the replacement runs {where}, where the pattern "
+                        f"fails ({pattern_error})"
+                    )
+                continue
+            if replacement_error is not None:
+                raise InvalidRule(
+                    f"Rule {rule.text!r}: the replacement fails ({replacement_error}) {where}, "
+                    f"where the pattern doesn't"
+                )
+            if actual != expected:
+                raise InvalidRule(
+                    f"Rule {rule.text!r}: the replacement isn't equivalent {where}. "
+                    f"Expected {expected}, got {actual}"
+                )
+            num_checked += 1
+    if not num_checked:
+        raise InvalidRule(f"Rule {rule.text!r}: the pattern never runs")
+
+
+def _parse_tokens(s: str, text: str) -> tuple[Token, ...]:
+    tokens = []
+    for word in s.split():
+        if word.startswith("<") and word.endswith(">"):
+            tokens.append(Placeholder(word[1:-1]))
+        elif word in OPCODES_BY_NAME:
+            tokens.append(OPCODES_BY_NAME[word])
+        else:
+            raise InvalidRule(f"Unknown token {word!r} in rule {text!r}")
+    return tuple(tokens)
+
+
+def _get_fixed_size(tokens: Sequence[Token]) -> int:
+    return sum(0 if isinstance(t, Placeholder) else 1 for t in tokens)
+
+
+# The symbolic model of the stacks. Stack items are tuples (terms): ("input", i) for the initial
+# items, ("const", bytes) for pushed numbers, ("push", name) for placeholders, and (opcode name, *args)
+# for the results of other operations.
+
+
+class _Failed(Exception):
+    pass
+
+
+class _Unsupported(InvalidRule):
+    pass
+
+
+# Operations that always leave the stacks the same way, as (number of items in, indices out)
+_STACK_OPS = {
+    "OP_DUP": (1, (0, 0)),
+    "OP_DROP": (1, ()),
+    "OP_NIP": (2, (1,)),
+    "OP_OVER": (2, (0, 1, 0)),
+    "OP_ROT": (3, (1, 2, 0)),
+    "OP_SWAP": (2, (1, 0)),
+    "OP_TUCK": (2, (1, 0, 1)),
+    "OP_2DROP": (2, ()),
+    "OP_2DUP": (2, (0, 1, 0, 1)),
+    "OP_3DUP": (3, (0, 1, 2, 0, 1, 2)),
+    "OP_2OVER": (4, (0, 1, 2, 3, 0, 1)),
+    "OP_2ROT": (6, (2, 3, 4, 5, 0, 1)),
+    "OP_2SWAP": (4, (2, 3, 0, 1)),
+}
+# Other operations, modeled as functions of their arguments: (number of items in, number out)
+_FUNCTION_OPS = {
+    "OP_ADD": (2, 1),
+    "OP_SUB": (2, 1),
+    "OP_EQUAL": (2, 1),
+    "OP_NUMEQUAL": (2, 1),
+    "OP_CHECKSIG": (2, 1),
+}
+# Operations that are the same as a sequence of others
+_MACRO_OPS = {
+    "OP_1ADD": ("OP_1", "OP_ADD"),
+    "OP_1SUB": ("OP_1", "OP_SUB"),
+    "OP_EQUALVERIFY": ("OP_EQUAL", "OP_VERIFY"),
+    "OP_NUMEQUALVERIFY": ("OP_NUMEQUAL", "OP_VERIFY"),
+    "OP_CHECKSIGVERIFY": ("OP_CHECKSIG", "OP_VERIFY"),
+}
+
+
+def _run_symbolic(
+    tokens: Sequence[Token], depth: int, alt_depth: int
+) -> tuple[list, list, list]:
+    "Run the tokens on symbolic stacks of the given depths, return (stack, altstack, verified)"
+    stack = [("input", i) for i in range(depth)]
+    altstack = [("altinput", i) for i in range(alt_depth)]
+    verified = []
+
+    def pop(stack, n=1):
+        if len(stack) < n:
+            raise _Failed("stack underflow")
+        ret = stack[len(stack) - n :]
+        del stack[len(stack) - n :]
+        return ret
+
+    def run(token: Token):
+        if isinstance(token, Placeholder):
+            stack.append(("push", token.name))
+            return
+        name = str(token)
+        if is_push(token):
+            stack.append(("const", _get_pushed_bytes(token)))
+        elif name in _MACRO_OPS:
+            for sub in _MACRO_OPS[name]:
+                run(OPCODES_BY_NAME[sub])
+        elif name in _STACK_OPS:
+            num_in, out = _STACK_OPS[name]
+            args = pop(stack, num_in)
+            stack.extend(args[i] for i in out)
+        elif name in ("OP_PICK", "OP_ROLL"):
+            (index_item,) = pop(stack)
+            if index_item[0] != "const":
+                raise _Unsupported(f"{name} with a non-constant index")
+            index = _decode_num(index_item[1])
+            if index < 0 or index >= len(stack):
+                raise _Failed(f"{name} index out of range")
+            item = stack[-index - 1]
+            if name == "OP_ROLL":
+                del stack[-index - 1]
+            stack.append(item)
+        elif name == "OP_TOALTSTACK":
+            altstack.extend(pop(stack))
+        elif name == "OP_FROMALTSTACK":
+            stack.extend(pop(altstack))
+        elif name == "OP_VERIFY":
+            verified.extend(pop(stack))
+        elif name in _FUNCTION_OPS:
+            num_in, num_out = _FUNCTION_OPS[name]
+            args = tuple(pop(stack, num_in))
+            stack.extend((name, args, i) for i in range(num_out))
+        else:
+            raise _Unsupported(f"The stack model doesn't support {name}")
+
+    for token in tokens:
+        run(token)
+    return stack, altstack, verified
+
+
+def _try_run_symbolic(
+    tokens: Sequence[Token], depth: int, alt_depth: int
+) -> tuple[tuple[list, list, list] | None, _Failed | None]:
+    "Like _run_symbolic, but return (stacks, None), or (None, the failure) if the tokens fail"
+    try:
+        return _run_symbolic(tokens, depth, alt_depth), None
+    except _Failed as e:
+        return None, e
+
+
+def _get_pushed_bytes(op: CScriptOp) -> bytes:
+    "Bytes pushed by OP_0, OP_1NEGATE and OP_1..OP_16"
+    if op == OP_0:
+        return b""
+    if op == OP_1NEGATE:
+        return b"\x81"
+    return bytes([op - OP_1 + 1])
+
+
+def _decode_num(data: bytes) -> int:
+    "Decode a script number (little-endian, with the sign in the highest bit)"
+    if not data:
+        return 0
+    value = int.from_bytes(data, "little")
+    sign_bit = 0x80 << (8 * (len(data) - 1))
+    if value & sign_bit:
+        return -(value & ~sign_bit)
+    return value
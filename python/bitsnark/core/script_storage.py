@@ -0,0 +1,104 @@
+"""Content-addressed storage of tx template scripts"""
+
+import hashlib
+import logging
+from typing import Iterator
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.orm.session import Session
+
+from .models import TransactionTemplate, Script
+from .parsing import parse_hex_bytes, serialize_hex
+
+logger = logging.getLogger(__name__)
+
+# Keys in inputs and spending conditions that contain (potentially large) script bytes
+SCRIPT_KEYS = ("script", "controlBlock")
+# Max number of scripts to look up and insert per statement
+INSERT_BATCH_SIZE = 500
+
+
+def get_script_hash(script: bytes) -> bytes:
+    return hashlib.sha256(script).digest()
+
+
+def compact_setup_scripts(
+    *,
+    dbsession: Session,
+    setup_id: str,
+) -> int:
+    """
+    Move inline scripts and control blocks of all tx templates of a setup to the scripts table.
+
+    The inline `script`/`controlBlock` keys are replaced by `scriptHash`/`controlBlockHash`,
+    which TransactionTemplate.load_script resolves when the bytes are actually needed.
+    Identical scripts are only stored once. Returns the number of scripts moved.
+
+    The TypeScript agent only reads and writes inline scripts, so this must not be used on setups
+    the agent still works on.
+    """
+    tx_templates = dbsession.scalars(
+        select(TransactionTemplate).filter_by(setup_id=setup_id)
+    ).all()
+
+    scripts: dict[bytes, bytes] = {}
+    num_moved = 0
+    for tx_template in tx_templates:
+        inputs_changed = False
+        for inp in tx_template.inputs:
+            for script in _move_scripts_to_hashes(inp):
+                scripts[get_script_hash(script)] = script
+                inputs_changed = True
+                num_moved += 1
+
+        outputs_changed = False
+        for output in tx_template.outputs:
+            for spending_condition in output.get("spendingConditions", []):
+                for script in _move_scripts_to_hashes(spending_condition):
+                    scripts[get_script_hash(script)] = script
+                    outputs_changed = True
+                    num_moved += 1
+
+        if inputs_changed:
+            flag_modified(tx_template, "inputs")
+        if outputs_changed:
+            flag_modified(tx_template, "outputs")
+
+    _insert_new_scripts(dbsession, scripts)
+    dbsession.flush()
+
+    logger.info(
+        "Moved %d scripts of setup %s to the scripts table (%d unique)",
+        num_moved,
+        setup_id,
+        len(scripts),
+    )
+    return num_moved
+
+
+def _insert_new_scripts(dbsession: Session, scripts: dict[bytes, bytes]):
+    "Insert the scripts (by hash) that aren't in the scripts table yet"
+    hashes = list(scripts)
+    for i in range(0, len(hashes), INSERT_BATCH_SIZE):
+        batch = hashes[i : i + INSERT_BATCH_SIZE]
+        stored = set(
+            dbsession.scalars(select(Script.hash).where(Script.hash.in_(batch)))
+        )
+        rows = [
+            {"hash": script_hash, "script_bytes": scripts[script_hash]}
+            for script_hash in batch
+            if script_hash not in stored
+        ]
+        if rows:
+            dbsession.execute(insert(Script), rows)
+
+
+def _move_scripts_to_hashes(obj: dict) -> Iterator[bytes]:
+    for key in SCRIPT_KEYS:
+        raw = obj.pop(key, None)
+        if raw is None:
+            continue
+        script = parse_hex_bytes(raw)
+        obj[f"{key}Hash"] = serialize_hex(get_script_hash(script))
+        yield script
@@ -0,0 +1,111 @@
+"""Local cache of passed script tests, keyed by the hash of everything the outcome depends on."""
+
+from __future__ import annotations
+import functools
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from typing import TYPE_CHECKING, Any
+
+from .. import scripteval
+
+if TYPE_CHECKING:
+    from .script_testing import TestCase
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = ".test_scripts_cache.sqlite3"
+# Bump when the outcome of a test can change for the same inputs (e.g. the tests check more)
+CACHE_VERSION = 1
+
+
+@functools.cache
+def get_evaluator_hash() -> str:
+    "Hash of the source of the script evaluator, so that changes to it invalidate the cached results"
+    with open(scripteval.__file__, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_test_case_key(test_case: TestCase, *, flags: dict[str, Any]) -> str:
+    """
+    Hash of the script, the witness, the role and the flags (everything else that affects the
+    outcome, e.g. offline or on the node, and the keys used for signing), and of the version of the
+    cache and of the script evaluator.
+    """
+    h = hashlib.sha256()
+    for part in (
+        bytes(test_case.script),
+        json.dumps(
+            [
+                elem.hex() if isinstance(elem, bytes) else elem
+                for elem in test_case.witness_elems
+            ]
+        ).encode(),
+        test_case.role.encode(),
+        json.dumps(
+            {**flags, "timeout_blocks": test_case.timeout_blocks}, sort_keys=True
+        ).encode(),
+        f"{CACHE_VERSION}:{get_evaluator_hash()}".encode(),
+    ):
+        # Length-prefixed, so that the parts can't run into each other
+        h.update(len(part).to_bytes(8, "big"))
+        h.update(part)
+    return h.hexdigest()
+
+
+class ScriptTestCache:
+    """
+    Passed script tests, stored in an SQLite file. Failures are not cached, so they are always
+    re-tested.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS passed (
+                    key TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    duration REAL,
+                    witness_size INTEGER,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+
+    def get_many(self, keys: list[str]) -> dict[str, dict]:
+        "Return the cached entries of the keys that have one"
+        ret = {}
+        # Stay below the max number of SQL variables
+        for i in range(0, len(keys), 500):
+            chunk = keys[i : i + 500]
+            rows = self._conn.execute(
+                f"SELECT key, duration, witness_size FROM passed WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for key, duration, witness_size in rows:
+                ret[key] = {"duration": duration, "witness_size": witness_size}
+        return ret
+
+    def put_many(self, entries: list[tuple[str, str, float | None, int | None]]):
+        "Store (key, name, duration, witness_size) of passed tests"
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO passed (key, name, duration, witness_size, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(*entry, now) for entry in entries],
+            )
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,73 @@
+"""Machine-readable reports of script test results (JSON and JUnit XML), e.g. for CI."""
+
+import json
+import xml.etree.ElementTree as ET
+from typing import Sequence
+
+from .script_testing import Result
+
+
+def get_result_report(result: Result) -> dict:
+    "Per-case entry of the reports"
+    test_case = result.test_case
+    return {
+        "name": test_case.sources_repr(),
+        "tx_template": test_case.tx_template.name,
+        "output_index": test_case.output_index,
+        "spending_condition_index": test_case.spending_condition_index,
+        "role": test_case.role,
+        "success": result.success,
+        "duration": result.duration,
+        "script_size": len(test_case.script),
+        "witness_size": result.witness_size,
+        "cached": result.cached,
+        "reason": result.reason,
+        "error": None if result.error is None else str(result.error),
+    }
+
+
+def write_json_report(path: str, results: Sequence[Result], *, duration: float):
+    cases = [get_result_report(result) for result in results]
+    report = {
+        "tests": len(cases),
+        "failures": sum(not case["success"] for case in cases),
+        "duration": duration,
+        "cases": cases,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+
+def write_junit_report(
+    path: str,
+    results: Sequence[Result],
+    *,
+    duration: float,
+    suite_name: str = "test_scripts",
+):
+    cases = [get_result_report(result) for result in results]
+    testsuite = ET.Element(
+        "testsuite",
+        name=suite_name,
+        tests=str(len(cases)),
+        failures=str(sum(not case["success"] for case in cases)),
+        time=f"{duration:.3f}",
+    )
+    for case in cases:
+        testcase = ET.SubElement(
+            testsuite,
+            "testcase",
+            classname=case["tx_template"],
+            name=case["name"],
+            time=f"{case['duration'] or 0:.3f}",
+        )
+        properties = ET.SubElement(testcase, "properties")
+        for name in ("role", "script_size", "witness_size", "cached"):
+            if case[name] is not None:
+                ET.SubElement(properties, "property", name=name, value=str(case[name]))
+        if not case["success"]:
+            failure = ET.SubElement(
+                testcase, "failure", message=case["reason"] or "Failed"
+            )
+            failure.text = case["error"]
+    ET.ElementTree(testsuite).write(path, encoding="utf-8", xml_declaration=True)
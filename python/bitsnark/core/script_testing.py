@@ -1,12 +1,19 @@
 """Re-usable code for testing scripts of tx templates"""
 
+import asyncio
+import functools
+import hashlib
 import itertools
 import logging
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from decimal import Decimal
-from typing import Iterable, Literal
+from typing import Callable, Iterable, Literal
 
 from bitcointx.core import (
+    CTransaction,
     CTxIn,
     CTxOut,
     CMutableTransaction,
@@ -16,12 +23,14 @@ from bitcointx.core import (
 )
 from bitcointx.core.key import XOnlyPubKey, CKey
 from bitcointx.core.psbt import PartiallySignedTransaction
+from bitcointx.core.scripteval import VerifyScriptError
 from bitcointx.core.script import CScript, TaprootScriptTree, OP_RETURN, CScriptWitness
 from bitcointx.wallet import P2TRCoinAddress
 
-from ..btc.rpc import BitcoinRPC
-from ..core.models import TransactionTemplate
-from ..core.parsing import parse_hex_bytes, parse_witness_element
+from ..btc.async_rpc import AsyncBitcoinRPC
+from ..btc.rpc import BitcoinRPC, JSONRPCError
+from ..core.models import TransactionTemplate, has_script
+from ..core.parsing import parse_witness_element
 from ..core.signing import sign_input
 from ..scripteval import eval_tapscript
 
@@ -36,6 +45,15 @@ class TestCase:
     tx_template: TransactionTemplate
     output_index: int
     spending_condition_index: int
+    timeout_blocks: int | None = None
+
+    def __getstate__(self):
+        # Sent to worker processes without the (big) template, the rest is enough to run the test.
+        # Scripts don't survive pickling, so they are sent as bytes.
+        return {**self.__dict__, "tx_template": None, "script": bytes(self.script)}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, script=CScript(state["script"], name="script"))
 
     def script_repr(self, *, limit: int = None, newlines: bool = False):
         ret = repr(self.script)
@@ -70,6 +88,11 @@ class Result:
     reason: str | None = None
     spent_output: str | None = None  # txid:index
     spending_txid: str | None = None
+    # Seconds spent building, signing and evaluating the spending transaction
+    duration: float | None = None
+    witness_size: int | None = None
+    # Passed in an earlier run with the same script, witness and flags (see script_test_cache)
+    cached: bool = False
 
 
 def collect_script_test_cases(
@@ -99,7 +122,7 @@ def collect_script_test_cases(
                 ):
                     continue
 
-                if "script" not in spending_condition:
+                if not has_script(spending_condition):
                     logger.info(
                         "Skipping spending condition without script (%s/%s/%s)",
                         tx_template.name,
@@ -150,99 +173,55 @@ def collect_script_test_cases(
 
                 test_case = TestCase(
                     script=CScript(
-                        parse_hex_bytes(spending_condition["script"]), name="script"
+                        tx_template.load_script(spending_condition), name="script"
                     ),
                     role=spending_condition_role,
                     witness_elems=witness_elems,
                     tx_template=tx_template,
                     output_index=output_index,
                     spending_condition_index=spending_condition["index"],
+                    timeout_blocks=spending_condition.get("timeoutBlocks"),
                 )
                 test_cases.append(test_case)
 
     return test_cases
 
 
-def execute_script_test_case(
-    *,
-    bitcoin_rpc: BitcoinRPC,
-    test_case: TestCase,
-    change_address: str,
-    prover_privkey: CKey,
-    verifier_privkey: CKey,
-    debug: bool = False,
-    evaluate: bool = False,
-    print_witness: bool = False,
-    internal_pubkey: XOnlyPubKey = XOnlyPubKey.fromhex(
-        "0000000000000000000000000000000000000000000000000000000000000001"
-    ),
-    amount_sat: int = 100_000,
-) -> Result:
-    # logger.info('Script: %s', test_case.script_repr())
+DEFAULT_INTERNAL_PUBKEY = XOnlyPubKey.fromhex(
+    "0000000000000000000000000000000000000000000000000000000000000001"
+)
 
-    amount_btc = Decimal(amount_sat) / Decimal(10**8)
 
-    taptree = TaprootScriptTree(
+def get_test_case_taptree(
+    test_case: TestCase, internal_pubkey: XOnlyPubKey = DEFAULT_INTERNAL_PUBKEY
+) -> TaprootScriptTree:
+    "Taproot tree with the script of the test case as its only leaf"
+    return TaprootScriptTree(
         leaves=[test_case.script],
         internal_pubkey=internal_pubkey,
     )
-    address = P2TRCoinAddress.from_script_tree(taptree)
-
-    outputs = [
-        {
-            str(address): str(amount_btc),
-        }
-    ]
-
-    funded_psbt_response = bitcoin_rpc.call(
-        "walletcreatefundedpsbt",
-        [],  # Inputs
-        outputs,  # Outputs
-        0,  # Locktime
-        {
-            "add_inputs": True,
-            "changeAddress": change_address,
-            "changePosition": 1,
-            "fee_rate": 10,
-        },
-    )
-
-    process_psbt_response = bitcoin_rpc.call(
-        "walletprocesspsbt",
-        funded_psbt_response["psbt"],
-    )
-    if not process_psbt_response["complete"]:
-        raise ValueError(f"PSBT not complete: {process_psbt_response}")
-    signed_psbt = PartiallySignedTransaction.from_base64(process_psbt_response["psbt"])
-
-    script_tx = signed_psbt.extract_transaction()
-    serialized_script_tx = script_tx.serialize().hex()
 
-    script_txid = bitcoin_rpc.call(
-        "sendrawtransaction",
-        serialized_script_tx,
-    )
-    bitcoin_rpc.mine_blocks()
-    logger.info(
-        f"Broadcast script transaction %s, attempting to spend it next", script_txid
-    )
 
-    timeout_blocks = test_case.tx_template.outputs[test_case.output_index][
-        "spendingConditions"
-    ][test_case.spending_condition_index].get("timeoutBlocks")
-    if timeout_blocks:
-        logger.info("Mining %d blocks to test timeout", timeout_blocks)
-        bitcoin_rpc.mine_blocks(timeout_blocks)
+def build_spending_transaction(
+    *,
+    test_case: TestCase,
+    taptree: TaprootScriptTree,
+    spent_outpoint: COutPoint,
+    spent_output: CTxOut,
+    prover_privkey: CKey,
+    verifier_privkey: CKey,
+) -> tuple[CMutableTransaction, list]:
+    """
+    Build a transaction spending the output of the test case's taptree with the script of the test case,
+    signed by both the prover and the verifier.
 
-    # Spend the output
+    Returns the transaction and the witness elements given to the script (including the signatures).
+    """
     spending_tx = CMutableTransaction(
         vin=[
             CTxIn(
-                COutPoint(
-                    hash=bytes.fromhex(script_txid)[::-1],
-                    n=0,
-                ),
-                nSequence=(timeout_blocks or 0xFFFFFFFF),
+                spent_outpoint,
+                nSequence=(test_case.timeout_blocks or 0xFFFFFFFF),
             )
         ],
         vout=[
@@ -263,12 +242,7 @@ def execute_script_test_case(
     assert spent_script == test_case.script
 
     # Get signatures
-    spent_outputs = [
-        CTxOut(
-            nValue=amount_sat,
-            scriptPubKey=address.to_scriptPubKey(),
-        )
-    ]
+    spent_outputs = [spent_output]
     prover_signature = sign_input(
         script=spent_script,
         tx=spending_tx,
@@ -307,23 +281,491 @@ def execute_script_test_case(
             )
         ]
     )
+    return spending_tx, full_witness_elems
 
-    serialized_spending_tx = spending_tx.serialize().hex()
 
+def _log_witness(spending_tx: CMutableTransaction, full_witness_elems: list):
+    *_, control_block = spending_tx.wit.vtxinwit[0].scriptWitness.stack
+    logger.info(
+        "Witness elems:\n%s:",
+        "\n".join(
+            f"{i:03d}: {elem.hex()}" for i, elem in enumerate(full_witness_elems)
+        ),
+    )
+    logger.info("Control block: %s", control_block.hex())
+
+
+def execute_script_test_case_offline(
+    *,
+    test_case: TestCase,
+    prover_privkey: CKey,
+    verifier_privkey: CKey,
+    debug: bool = False,
+    print_witness: bool = False,
+    internal_pubkey: XOnlyPubKey = DEFAULT_INTERNAL_PUBKEY,
+    amount_sat: int = 100_000,
+) -> Result:
+    """
+    Test spending the script of the test case without a node.
+
+    The output is "funded" by a transaction that is built locally and never broadcast, as only the
+    spent output matters for the signatures. The spending transaction is signed as in
+    execute_script_test_case, and its witness is evaluated with eval_tapscript, checking the Schnorr
+    signatures. Policy (e.g. standardness) and timelocks are not checked, so passing tests can be
+    confirmed on a node with execute_script_test_case.
+    """
+    start_time = time.perf_counter()
+    taptree = get_test_case_taptree(test_case, internal_pubkey)
+    address = P2TRCoinAddress.from_script_tree(taptree)
+    funding_tx = CMutableTransaction(
+        vin=[
+            CTxIn(
+                COutPoint(
+                    hash=hashlib.sha256(test_case.script).digest(),
+                    n=0,
+                )
+            )
+        ],
+        vout=[CTxOut(nValue=amount_sat, scriptPubKey=address.to_scriptPubKey())],
+        nVersion=2,
+    )
+    funding_txid = funding_tx.GetTxid()
+    spent_output = funding_tx.vout[0]
+
+    spending_tx, full_witness_elems = build_spending_transaction(
+        test_case=test_case,
+        taptree=taptree,
+        spent_outpoint=COutPoint(hash=funding_txid, n=0),
+        spent_output=spent_output,
+        prover_privkey=prover_privkey,
+        verifier_privkey=verifier_privkey,
+    )
     if print_witness:
-        logger.info(
-            "Witness elems:\n%s:",
-            "\n".join(
-                f"{i:03d}: {elem.hex()}" for i, elem in enumerate(full_witness_elems)
+        _log_witness(spending_tx, full_witness_elems)
+
+    # Evaluate the witness as serialized, as the node would
+    witness = spending_tx.wit.vtxinwit[0].scriptWitness
+    *witness_elems, spent_script, _ = witness.stack
+    try:
+        eval_tapscript(
+            witness_elems=witness_elems,
+            script=CScript(spent_script),
+            txTo=spending_tx,
+            inIdx=0,
+            spent_outputs=[spent_output],
+            debug=debug,
+        )
+    except VerifyScriptError as e:
+        return Result(
+            test_case=test_case,
+            success=False,
+            error=e,
+            reason=f"eval_tapscript: {e}",
+            duration=time.perf_counter() - start_time,
+            witness_size=len(witness.serialize()),
+        )
+    return Result(
+        test_case=test_case,
+        success=True,
+        spent_output=f"{funding_txid[::-1].hex()}:0",
+        spending_txid=spending_tx.GetTxid()[::-1].hex(),
+        duration=time.perf_counter() - start_time,
+        witness_size=len(witness.serialize()),
+    )
+
+
+def execute_script_test_cases_offline(
+    *,
+    test_cases: list[TestCase],
+    prover_privkey: CKey,
+    verifier_privkey: CKey,
+    jobs: int = 1,
+    debug: bool = False,
+    print_witness: bool = False,
+    on_result: Callable[[Result], None] | None = None,
+) -> list[Result]:
+    """
+    Run execute_script_test_case_offline for the test cases, in jobs worker processes (evaluating
+    scripts is CPU bound). Exceptions are returned as failed results. With debug, everything runs
+    in this process, to be able to debug it.
+
+    on_result is called with each result as soon as it's ready (in the order of test_cases).
+    """
+    use_processes = jobs > 1 and len(test_cases) > 1 and not debug
+    run = functools.partial(
+        _execute_script_test_case_offline_safely,
+        prover_secret=bytes(prover_privkey),
+        verifier_secret=bytes(verifier_privkey),
+        debug=debug,
+        print_witness=print_witness,
+        portable_errors=use_processes,
+    )
+    results = []
+    if use_processes:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            # Test cases without their templates are sent to the workers, so the results point back
+            # to the original test cases
+            for test_case, result in zip(
+                test_cases,
+                executor.map(
+                    run,
+                    test_cases,
+                    chunksize=max(1, len(test_cases) // (jobs * 4)),
+                ),
+            ):
+                result.test_case = test_case
+                results.append(result)
+                if on_result is not None:
+                    on_result(result)
+    else:
+        for test_case in test_cases:
+            result = run(test_case)
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+    return results
+
+
+def _execute_script_test_case_offline_safely(
+    test_case: TestCase,
+    *,
+    prover_secret: bytes,
+    verifier_secret: bytes,
+    debug: bool,
+    print_witness: bool,
+    portable_errors: bool,
+) -> Result:
+    start_time = time.perf_counter()
+    try:
+        result = execute_script_test_case_offline(
+            test_case=test_case,
+            prover_privkey=CKey(prover_secret),
+            verifier_privkey=CKey(verifier_secret),
+            debug=debug,
+            print_witness=print_witness,
+        )
+    except Exception as e:
+        logger.exception(e)
+        result = Result(
+            test_case=test_case,
+            success=False,
+            error=e,
+            reason="An exception occured",
+            duration=time.perf_counter() - start_time,
+        )
+    if portable_errors:
+        # Sent back to the main process, which has the test case already. Script errors carry the
+        # whole evaluation state, which isn't needed there either (and doesn't survive pickling).
+        result.test_case = None
+        if result.error is not None:
+            result.error = RuntimeError(
+                f"{type(result.error).__name__}: {result.error}"
+            )
+    return result
+
+
+def fund_test_outputs(
+    *,
+    bitcoin_rpc: BitcoinRPC,
+    outputs: list[CTxOut],
+    change_address: str,
+    fee_rate_sat_per_vb: int = 10,
+) -> str:
+    """
+    Fund the outputs with a single wallet transaction (the outputs first, in order, then the change),
+    broadcast it and mine it. Returns its txid.
+
+    The outputs are funded as a raw transaction, so that many of them can have the same script.
+    """
+    funded = bitcoin_rpc.call(
+        "fundrawtransaction",
+        CMutableTransaction(vin=[], vout=outputs, nVersion=2).serialize().hex(),
+        {
+            "add_inputs": True,
+            "changeAddress": change_address,
+            "changePosition": len(outputs),
+            "fee_rate": fee_rate_sat_per_vb,
+        },
+    )
+    signed = bitcoin_rpc.call("signrawtransactionwithwallet", funded["hex"])
+    if not signed["complete"]:
+        raise ValueError(f"Funding transaction not complete: {signed}")
+    txid = bitcoin_rpc.call("sendrawtransaction", signed["hex"])
+    bitcoin_rpc.mine_blocks()
+    logger.info("Funded %d test outputs with transaction %s", len(outputs), txid)
+    return txid
+
+
+def send_test_transactions(
+    *,
+    bitcoin_rpc: BitcoinRPC,
+    txs: list[CTransaction | CMutableTransaction],
+    jobs: int = 1,
+) -> list[tuple[str | None, str | None]]:
+    """
+    Test and send the (independent) transactions in batched requests, and mine them in one block.
+
+    Each is tested with its own testmempoolaccept call, so that one failing doesn't affect the others,
+    and only the accepted ones are sent (in a second request). The transactions are split into jobs
+    chunks, tested and sent concurrently (with an AsyncBitcoinRPC on the same node) so that the node can
+    validate them in parallel (up to its -rpcthreads).
+
+    Returns (txid, None) for each sent transaction, and (None, reason) for the others.
+    """
+    chunk_size = max(1, math.ceil(len(txs) / jobs))
+    chunks = [txs[i : i + chunk_size] for i in range(0, len(txs), chunk_size)]
+    chunk_results = asyncio.run(_test_and_send_chunks(bitcoin_rpc.url, chunks))
+
+    ret = [tx_result for chunk_result in chunk_results for tx_result in chunk_result]
+    if any(txid is not None for txid, _ in ret):
+        bitcoin_rpc.mine_blocks()
+    return ret
+
+
+async def _test_and_send_chunks(
+    url: str, chunks: list[list[CTransaction | CMutableTransaction]]
+) -> list[list[tuple[str | None, str | None]]]:
+    async with AsyncBitcoinRPC(url, max_concurrency=max(len(chunks), 1)) as async_rpc:
+        return await asyncio.gather(
+            *(_test_and_send(async_rpc, chunk) for chunk in chunks)
+        )
+
+
+async def _test_and_send(
+    async_rpc: AsyncBitcoinRPC, txs: list[CTransaction | CMutableTransaction]
+) -> list[tuple[str | None, str | None]]:
+    "Test transactions in one batched request, and send the accepted ones in another"
+    serialized_txs = [tx.serialize().hex() for tx in txs]
+    async with async_rpc.batch() as batch:
+        mempoolaccept_calls = [
+            batch.call("testmempoolaccept", [serialized_tx])
+            for serialized_tx in serialized_txs
+        ]
+
+    ret: list[tuple[str | None, str | None]] = []
+    accepted = {}
+    for i, mempoolaccept_call in enumerate(mempoolaccept_calls):
+        mempool_accept = mempoolaccept_call.result()
+        if not mempool_accept[0]["allowed"]:
+            logger.info("Mempool rejection: %s", mempool_accept)
+            ret.append(
+                (None, f'testmempoolaccept: {mempool_accept[0]["reject-reason"]}')
+            )
+        else:
+            accepted[i] = serialized_txs[i]
+            ret.append((None, None))
+    if not accepted:
+        return ret
+
+    async with async_rpc.batch() as batch:
+        send_calls = {
+            i: batch.call("sendrawtransaction", serialized_tx)
+            for i, serialized_tx in accepted.items()
+        }
+    for i, send_call in send_calls.items():
+        try:
+            ret[i] = (send_call.result(), None)
+        except JSONRPCError as e:
+            ret[i] = (None, f"sendrawtransaction: {e}")
+    return ret
+
+
+def execute_script_test_cases(
+    *,
+    bitcoin_rpc: BitcoinRPC,
+    test_cases: list[TestCase],
+    change_address: str,
+    prover_privkey: CKey,
+    verifier_privkey: CKey,
+    debug: bool = False,
+    evaluate: bool = False,
+    print_witness: bool = False,
+    internal_pubkey: XOnlyPubKey = DEFAULT_INTERNAL_PUBKEY,
+    amount_sat: int = 100_000,
+    jobs: int = 1,
+) -> list[Result]:
+    """
+    Test spending the scripts of the test cases on the node, like execute_script_test_case, but in a
+    constant number of round-trips: the outputs of all the test cases are funded by a single transaction,
+    and the spending transactions are tested and sent together (in jobs concurrent requests), and mined
+    in a single block.
+    """
+    if not test_cases:
+        return []
+    taptrees = [
+        get_test_case_taptree(test_case, internal_pubkey) for test_case in test_cases
+    ]
+    spent_outputs = [
+        CTxOut(
+            nValue=amount_sat,
+            scriptPubKey=P2TRCoinAddress.from_script_tree(taptree).to_scriptPubKey(),
+        )
+        for taptree in taptrees
+    ]
+    funding_txid = fund_test_outputs(
+        bitcoin_rpc=bitcoin_rpc,
+        outputs=spent_outputs,
+        change_address=change_address,
+    )
+    max_timeout_blocks = max(test_case.timeout_blocks or 0 for test_case in test_cases)
+    if max_timeout_blocks:
+        logger.info("Mining %d blocks to test timeouts", max_timeout_blocks)
+        bitcoin_rpc.mine_blocks(max_timeout_blocks)
+
+    results: list[Result | None] = [None] * len(test_cases)
+    spending_txs = {}
+    durations = {}
+    for index, (test_case, taptree, spent_output) in enumerate(
+        zip(test_cases, taptrees, spent_outputs)
+    ):
+        start_time = time.perf_counter()
+        try:
+            spending_tx, full_witness_elems = build_spending_transaction(
+                test_case=test_case,
+                taptree=taptree,
+                spent_outpoint=COutPoint(
+                    hash=bytes.fromhex(funding_txid)[::-1], n=index
+                ),
+                spent_output=spent_output,
+                prover_privkey=prover_privkey,
+                verifier_privkey=verifier_privkey,
+            )
+            if print_witness:
+                _log_witness(spending_tx, full_witness_elems)
+            if evaluate:
+                eval_tapscript(
+                    witness_elems=full_witness_elems,
+                    script=test_case.script,
+                    txTo=spending_tx,
+                    inIdx=0,
+                    spent_outputs=[spent_output],
+                    debug=debug,
+                )
+        except Exception as e:
+            logger.exception(e)
+            results[index] = Result(
+                test_case=test_case,
+                success=False,
+                error=e,
+                reason="An exception occured",
+                duration=time.perf_counter() - start_time,
+            )
+            continue
+        spending_txs[index] = spending_tx
+        durations[index] = time.perf_counter() - start_time
+
+    if debug:
+        breakpoint()
+
+    sent = send_test_transactions(
+        bitcoin_rpc=bitcoin_rpc, txs=list(spending_txs.values()), jobs=jobs
+    )
+    for index, (txid, reason) in zip(spending_txs, sent):
+        test_case = test_cases[index]
+        results[index] = Result(
+            test_case=test_case,
+            success=txid is not None,
+            reason=reason,
+            spent_output=None if txid is None else f"{funding_txid}:{index}",
+            spending_txid=txid,
+            duration=durations[index],
+            witness_size=len(
+                spending_txs[index].wit.vtxinwit[0].scriptWitness.serialize()
             ),
         )
-        logger.info("Control block: %s", control_block.hex())
+    return results
+
+
+def execute_script_test_case(
+    *,
+    bitcoin_rpc: BitcoinRPC,
+    test_case: TestCase,
+    change_address: str,
+    prover_privkey: CKey,
+    verifier_privkey: CKey,
+    debug: bool = False,
+    evaluate: bool = False,
+    print_witness: bool = False,
+    internal_pubkey: XOnlyPubKey = DEFAULT_INTERNAL_PUBKEY,
+    amount_sat: int = 100_000,
+) -> Result:
+    # logger.info('Script: %s', test_case.script_repr())
+
+    amount_btc = Decimal(amount_sat) / Decimal(10**8)
+
+    taptree = get_test_case_taptree(test_case, internal_pubkey)
+    address = P2TRCoinAddress.from_script_tree(taptree)
+    outputs = [
+        {
+            str(address): str(amount_btc),
+        }
+    ]
+
+    funded_psbt_response = bitcoin_rpc.call(
+        "walletcreatefundedpsbt",
+        [],  # Inputs
+        outputs,  # Outputs
+        0,  # Locktime
+        {
+            "add_inputs": True,
+            "changeAddress": change_address,
+            "changePosition": 1,
+            "fee_rate": 10,
+        },
+    )
+
+    process_psbt_response = bitcoin_rpc.call(
+        "walletprocesspsbt",
+        funded_psbt_response["psbt"],
+    )
+    if not process_psbt_response["complete"]:
+        raise ValueError(f"PSBT not complete: {process_psbt_response}")
+    signed_psbt = PartiallySignedTransaction.from_base64(process_psbt_response["psbt"])
+
+    script_tx = signed_psbt.extract_transaction()
+    serialized_script_tx = script_tx.serialize().hex()
+
+    script_txid = bitcoin_rpc.call(
+        "sendrawtransaction",
+        serialized_script_tx,
+    )
+    bitcoin_rpc.mine_blocks()
+    logger.info(
+        f"Broadcast script transaction %s, attempting to spend it next", script_txid
+    )
+
+    timeout_blocks = test_case.timeout_blocks
+    if timeout_blocks:
+        logger.info("Mining %d blocks to test timeout", timeout_blocks)
+        bitcoin_rpc.mine_blocks(timeout_blocks)
+
+    # Spend the output
+    spent_output = CTxOut(
+        nValue=amount_sat,
+        scriptPubKey=address.to_scriptPubKey(),
+    )
+    spending_tx, full_witness_elems = build_spending_transaction(
+        test_case=test_case,
+        taptree=taptree,
+        spent_outpoint=COutPoint(hash=bytes.fromhex(script_txid)[::-1], n=0),
+        spent_output=spent_output,
+        prover_privkey=prover_privkey,
+        verifier_privkey=verifier_privkey,
+    )
+    spent_script = test_case.script
+
+    serialized_spending_tx = spending_tx.serialize().hex()
+
+    if print_witness:
+        _log_witness(spending_tx, full_witness_elems)
 
     if evaluate:
         eval_tapscript(
             witness_elems=full_witness_elems,
             script=spent_script,
-            ignore_signature_errors=True,
+            txTo=spending_tx,
+            inIdx=0,
+            spent_outputs=[spent_output],
             debug=debug,
         )
 
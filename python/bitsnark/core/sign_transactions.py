@@ -2,20 +2,24 @@ import argparse
 import logging
 import os
 import sys
-from typing import Sequence, Literal
+from typing import Sequence
 
 from bitcointx.core.key import CKey, XOnlyPubKey
 from bitcointx.core.script import SIGHASH_SINGLE, SIGHASH_ANYONECANPAY, SIGHASH_Type
 from sqlalchemy import create_engine, select, update
-from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy.orm.session import Session
 
 from bitsnark.conf import POSTGRES_BASE_URL
 from bitsnark.core.environ import load_bitsnark_dotenv
-from bitsnark.core.parsing import serialize_hex, parse_hex_bytes
+from bitsnark.core.parsing import parse_hex_bytes
 from bitsnark.core.transactions import construct_signable_transaction, MissingScript
 from tests.conftest import dbsession
 from .models import TransactionTemplate, Setups, SetupStatus
+from .signature_store import (
+    SignatureStore,
+    apply_stored_signatures,
+    get_signature_key,
+)
 from .types import Role
 
 logger = logging.getLogger(__name__)
@@ -66,6 +70,9 @@ def sign_setup(setup_id: str, agent_id: str, role: Role, dbsession: Session):
 
     print(f"Processing {len(tx_templates)} transaction templates...")
 
+    # Signatures of all templates are written in one batch at the end
+    signature_store = SignatureStore()
+
     for tx in tx_templates:
         print(f"Processing transaction #{tx.ordinal}: {tx.name}...")
         try:
@@ -74,6 +81,7 @@ def sign_setup(setup_id: str, agent_id: str, role: Role, dbsession: Session):
                 role=role,
                 private_key=private_key,
                 dbsession=dbsession,
+                signature_store=signature_store,
             )
         except MissingScript as e:
             sys.stderr.write(f"Warning: {e}")
@@ -92,6 +100,8 @@ def sign_setup(setup_id: str, agent_id: str, role: Role, dbsession: Session):
 
         print("")
 
+    signature_store.flush(dbsession)
+
     dbsession.execute(
         update(Setups).where(Setups.id == setup_id).values(status=SetupStatus.SIGNED)
     )
@@ -141,7 +151,14 @@ def sign_tx_template(
     role: Role,
     private_key: CKey,
     dbsession: Session,
+    signature_store: SignatureStore | None = None,
 ):
+    """
+    Sign all inputs of a tx template.
+
+    If `signature_store` is given, the signatures are only added to it and the caller is responsible
+    for flushing it. Otherwise they are written to the DB immediately.
+    """
     if tx_template.is_external:
         # We don't want to sign external transactions
         return True
@@ -156,19 +173,24 @@ def sign_tx_template(
     # Alter the template
     tx_template.txid = signable_tx.txid
 
+    flush_signatures = signature_store is None
+    if flush_signatures:
+        signature_store = SignatureStore()
+
     for signable_input in signable_tx.inputs:
-        index = signable_input.index
         signature = signable_input.sign(
             private_key=private_key,
             hashtype=sighash_type,
         )
+        signature_store.add(
+            tx_template=tx_template,
+            input_index=signable_input.index,
+            role=role,
+            signature=signature,
+        )
 
-        signature_key = get_signature_key(role)
-
-        tx_template.inputs[index][signature_key] = serialize_hex(signature)
-
-    # Make sure SQLAlchemy knows that the JSON object has changed
-    flag_modified(tx_template, "inputs")
+    if flush_signatures:
+        signature_store.flush(dbsession)
 
     return True
 
@@ -182,6 +204,7 @@ def verify_tx_template_signatures(
     ignore_missing_script: bool = False,
 ):
     signature_key = get_signature_key(signer_role)
+    apply_stored_signatures(dbsession, [tx_template])
     try:
         signable_tx = construct_signable_transaction(
             tx_template=tx_template,
@@ -222,16 +245,6 @@ def verify_tx_template_signatures(
         )
 
 
-def get_signature_key(role: Role) -> Literal["proverSignature", "verifierSignature"]:
-    role = role.lower()
-    if role == "prover":
-        return "proverSignature"
-    elif role == "verifier":
-        return "verifierSignature"
-    else:
-        raise ValueError(f"Unknown role {role}")
-
-
 def get_sighash_type(tx_template: TransactionTemplate) -> SIGHASH_Type | None:
     if tx_template.fundable:
         if len(tx_template.inputs) != 1:
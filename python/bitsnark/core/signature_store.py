@@ -0,0 +1,149 @@
+"""Batched storage of tx template input signatures."""
+
+from __future__ import annotations
+import logging
+from typing import Iterable, Literal
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm.session import Session
+
+from .models import TransactionTemplate, TemplateSignature
+from .parsing import serialize_hex
+from .types import Role
+
+logger = logging.getLogger(__name__)
+
+
+def get_signature_key(role: Role) -> Literal["proverSignature", "verifierSignature"]:
+    role = role.lower()
+    if role == "prover":
+        return "proverSignature"
+    elif role == "verifier":
+        return "verifierSignature"
+    else:
+        raise ValueError(f"Unknown role {role}")
+
+
+class SignatureStore:
+    """
+    Collect input signatures of tx templates and write them to the DB in one go.
+
+    Signatures are upserted to the `signatures` table with a single statement per setup. The (large)
+    `templates.inputs` JSON is not written: readers merge the signatures into the
+    `proverSignature`/`verifierSignature` keys of the inputs when loading templates (see
+    apply_stored_signatures, and getTemplates of the TS agent). The in-memory templates are updated
+    too, without marking the inputs as modified (which would make SQLAlchemy rewrite the whole JSON).
+    """
+
+    def __init__(self):
+        # (setup_id, template_name, input_index, role) -> serialized signature
+        self._pending: dict[tuple[str, str, int, str], str] = {}
+        self._templates: dict[tuple[str, str], TransactionTemplate] = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(
+        self,
+        *,
+        tx_template: TransactionTemplate,
+        input_index: int,
+        role: Role,
+        signature: bytes,
+    ):
+        role = role.lower()
+        get_signature_key(role)  # validates the role
+        key = (tx_template.setup_id, tx_template.name, input_index, role)
+        self._pending[key] = serialize_hex(signature)
+        self._templates[(tx_template.setup_id, tx_template.name)] = tx_template
+
+    def flush(self, dbsession: Session):
+        """
+        Persist all pending signatures. Must be called inside a transaction.
+        """
+        if not self._pending:
+            return
+
+        # Make sure the templates exist before their signatures are inserted
+        dbsession.flush()
+
+        by_setup: dict[str, list[dict]] = {}
+        for (setup_id, template_name, input_index, role), signature in sorted(
+            self._pending.items()
+        ):
+            by_setup.setdefault(setup_id, []).append(
+                {
+                    "setup_id": setup_id,
+                    "template_name": template_name,
+                    "input_index": input_index,
+                    "role": role,
+                    "signature": signature,
+                }
+            )
+
+        for setup_id, rows in by_setup.items():
+            logger.debug("Storing %d signatures for setup %s", len(rows), setup_id)
+            upsert = insert(TemplateSignature).values(rows)
+            upsert = upsert.on_conflict_do_update(
+                index_elements=[
+                    TemplateSignature.setup_id,
+                    TemplateSignature.template_name,
+                    TemplateSignature.input_index,
+                    TemplateSignature.role,
+                ],
+                set_={
+                    "signature": upsert.excluded.signature,
+                    "updated_at": sa.func.now(),
+                },
+            )
+            dbsession.execute(upsert)
+
+        # Keep the loaded objects in sync with the DB. Mutating the JSON in place does not mark it as
+        # modified, so this will not cause another UPDATE of the inputs.
+        for (
+            setup_id,
+            template_name,
+            input_index,
+            role,
+        ), signature in self._pending.items():
+            tx_template = self._templates[(setup_id, template_name)]
+            tx_template.inputs[input_index][get_signature_key(role)] = signature
+
+        self._pending.clear()
+        self._templates.clear()
+
+
+def apply_stored_signatures(
+    dbsession: Session, tx_templates: Iterable[TransactionTemplate]
+):
+    """
+    Merge the signatures of the `signatures` table into the inputs of the loaded templates.
+
+    Stored signatures take precedence over the ones in the inputs JSON (the agent deletes them when it
+    rewrites the inputs). Like in SignatureStore.flush, the inputs are not marked as modified.
+    """
+    templates_by_key = {
+        (tx_template.setup_id, tx_template.name): tx_template
+        for tx_template in tx_templates
+    }
+    if not templates_by_key:
+        return
+    rows = dbsession.execute(
+        sa.select(
+            TemplateSignature.setup_id,
+            TemplateSignature.template_name,
+            TemplateSignature.input_index,
+            TemplateSignature.role,
+            TemplateSignature.signature,
+        ).where(
+            sa.tuple_(TemplateSignature.setup_id, TemplateSignature.template_name).in_(
+                list(templates_by_key)
+            )
+        )
+    )
+    for setup_id, template_name, input_index, role, signature in rows:
+        inputs = templates_by_key[(setup_id, template_name)].inputs
+        # Signatures of inputs the template no longer has are ignored
+        if input_index < len(inputs):
+            inputs[input_index][get_signature_key(role)] = signature
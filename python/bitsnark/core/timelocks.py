@@ -0,0 +1,123 @@
+"""Relative timelocks (timeoutBlocks) of tx template inputs."""
+
+from __future__ import annotations
+import logging
+
+from sqlalchemy import select
+from sqlalchemy.orm.session import Session
+
+from .models import TransactionTemplate, Received
+
+logger = logging.getLogger(__name__)
+
+
+def get_timelock_maturity_height(
+    *,
+    dbsession: Session,
+    tx_template: TransactionTemplate,
+) -> int | None:
+    """
+    Height of the first block that can include the transaction, as far as the timeoutBlocks of the
+    spending conditions of its inputs are concerned (BIP68).
+
+    Returns 0 if no input is timelocked, and None if the transaction of a timelocked input
+    has not been received (confirmed) yet, or the template of an input is not found, so the height
+    is not known.
+    """
+    maturity_height = 0
+    for inp in tx_template.inputs:
+        if inp.get("funded"):
+            continue
+        # Only fetch the bit of the (potentially huge) previous outputs JSON that we need
+        timeout_blocks_column = TransactionTemplate.outputs[inp["outputIndex"]][
+            "spendingConditions"
+        ][inp["spendingConditionIndex"]]["timeoutBlocks"].as_integer()
+        row = dbsession.execute(
+            select(timeout_blocks_column, Received.block_height)
+            .select_from(TransactionTemplate)
+            .outerjoin(Received, Received.template_id == TransactionTemplate.id)
+            .where(TransactionTemplate.setup_id == tx_template.setup_id)
+            .where(TransactionTemplate.name == inp["templateName"])
+        ).one_or_none()
+        if row is None:
+            logger.warning(
+                "%s spends %s, which is not found, so it's not mature",
+                tx_template.name,
+                inp["templateName"],
+            )
+            return None
+        timeout_blocks, prev_block_height = row
+        if not timeout_blocks:
+            continue
+        if prev_block_height is None:
+            logger.debug(
+                "%s is timelocked on %s, which is not confirmed yet",
+                tx_template.name,
+                inp["templateName"],
+            )
+            return None
+        maturity_height = max(maturity_height, prev_block_height + timeout_blocks)
+    return maturity_height
+
+
+def is_timelock_mature(
+    *,
+    dbsession: Session,
+    tx_template: TransactionTemplate,
+    tip_height: int,
+) -> bool:
+    "Can the transaction be included in the next block (after tip_height)"
+    maturity_height = get_timelock_maturity_height(
+        dbsession=dbsession, tx_template=tx_template
+    )
+    return maturity_height is not None and maturity_height <= tip_height + 1
+
+
+def get_confirmation_deadline_height(
+    *,
+    dbsession: Session,
+    tx_template: TransactionTemplate,
+) -> int | None:
+    """
+    Height of the last block that can include the transaction before a competing spending condition
+    (with timeoutBlocks) of one of its inputs matures, after which the other party could spend the
+    output instead.
+
+    Returns None if no input has a competing timelocked spending condition, or the transaction of
+    such an input has not been received (confirmed) yet. Inputs whose templates are not found are
+    skipped.
+    """
+    deadline_height = None
+    for inp in tx_template.inputs:
+        if inp.get("funded"):
+            continue
+        spending_conditions_column = TransactionTemplate.outputs[inp["outputIndex"]][
+            "spendingConditions"
+        ]
+        row = dbsession.execute(
+            select(spending_conditions_column, Received.block_height)
+            .select_from(TransactionTemplate)
+            .outerjoin(Received, Received.template_id == TransactionTemplate.id)
+            .where(TransactionTemplate.setup_id == tx_template.setup_id)
+            .where(TransactionTemplate.name == inp["templateName"])
+        ).one_or_none()
+        if row is None:
+            logger.warning(
+                "%s spends %s, which is not found, so its deadline is not known",
+                tx_template.name,
+                inp["templateName"],
+            )
+            continue
+        spending_conditions, prev_block_height = row
+        competing_timeouts = [
+            spending_condition["timeoutBlocks"]
+            for index, spending_condition in enumerate(spending_conditions)
+            if index != inp["spendingConditionIndex"]
+            and spending_condition.get("timeoutBlocks")
+        ]
+        if not competing_timeouts or prev_block_height is None:
+            continue
+        input_deadline_height = prev_block_height + min(competing_timeouts) - 1
+        if deadline_height is None or input_deadline_height < deadline_height:
+            deadline_height = input_deadline_height
+    return deadline_height
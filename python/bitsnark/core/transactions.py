@@ -15,6 +15,7 @@ import sqlalchemy as sa
 from sqlalchemy.orm.session import Session
 from .models import TransactionTemplate
 from .parsing import parse_bignum, parse_hex_bytes, parse_witness_element
+from .signature_store import apply_stored_signatures
 from . import signing
 
 
@@ -200,14 +201,19 @@ def construct_signable_transaction(
             )
         )
 
-        script_raw = inp.get("script", spending_condition.get("script"))
-        if script_raw is None:
+        script = _load_input_script(
+            tx_template=tx_template,
+            inp=inp,
+            prev_tx=prev_tx,
+            spending_condition=spending_condition,
+        )
+        if script is None:
             raise MissingScript(
                 f"Spending condition {inp['spendingConditionIndex']} for transaction {prev_tx.name} "
                 f"(required by {tx_template.name} input #{input_index}) has no script"
             )
 
-        input_tapscripts.append(CScript(parse_hex_bytes(script_raw)))
+        input_tapscripts.append(CScript(script))
 
     tx_outputs = []
     for output_index, out in enumerate(tx_template.outputs):
@@ -282,6 +288,7 @@ def construct_signed_transaction(
         dbsession=dbsession,
         ignore_funded_inputs_and_outputs=ignore_funded_inputs_and_outputs,
     )
+    apply_stored_signatures(dbsession, [tx_template])
     tx = signable_tx.tx.to_mutable()
     if tx.wit is not None and tx.wit.serialize().strip(b"\x00"):
         raise ValueError(f"Transaction {tx_template.name} already has witness data")
@@ -334,12 +341,17 @@ def construct_signed_transaction(
             signatures.append(prover_signature)
 
         # TODO: refactor this so that it always uses inp['script']
-        script_raw = inp.get("script", spending_condition.get("script"))
-        if script_raw is None:
+        script = _load_input_script(
+            tx_template=tx_template,
+            inp=inp,
+            prev_tx=prev_tx,
+            spending_condition=spending_condition,
+        )
+        if script is None:
             raise ValueError(
                 f"Transaction {tx_template.name} input #{input_index} has no script or spendingCondition script"
             )
-        tapscript = CScript(parse_hex_bytes(script_raw))
+        tapscript = CScript(script)
 
         if tx_template.protocol_data:
             witness = [
@@ -350,14 +362,17 @@ def construct_signed_transaction(
             witness = []
 
         # TODO: refactor it to always use inp['controlBlock']
-        control_block_raw = inp.get(
-            "controlBlock", spending_condition.get("controlBlock")
+        control_block = _load_input_script(
+            tx_template=tx_template,
+            inp=inp,
+            prev_tx=prev_tx,
+            spending_condition=spending_condition,
+            key="controlBlock",
         )
-        if control_block_raw is None:
+        if control_block is None:
             raise ValueError(
                 f"Transaction {tx_template.name} input #{input_index} has no controlBlock or spendingCondition controlBlock"
             )
-        control_block = parse_hex_bytes(control_block_raw)
 
         input_witness = CTxInWitness(
             CScriptWitness(
@@ -376,3 +391,18 @@ def construct_signed_transaction(
         tx=tx.to_immutable(),
         signable_tx=signable_tx,
     )
+
+
+def _load_input_script(
+    *,
+    tx_template: TransactionTemplate,
+    inp: dict,
+    prev_tx: TransactionTemplate,
+    spending_condition: dict,
+    key: str = "script",
+) -> bytes | None:
+    # The input's own script takes precedence over the one in the spent spending condition
+    script = tx_template.load_script(inp, key)
+    if script is None:
+        script = prev_tx.load_script(spending_condition, key)
+    return script
@@ -0,0 +1,83 @@
+"""Share DB work between multiple listeners with SELECT ... FOR UPDATE SKIP LOCKED."""
+
+import logging
+from typing import Callable
+
+from sqlalchemy import Row, Select
+from sqlalchemy.orm.session import Session
+
+logger = logging.getLogger(__name__)
+
+
+def process_claimed(
+    *,
+    dbsession: Session,
+    query: Select,
+    process: Callable[[Row], None],
+) -> int:
+    """
+    Claim rows matching the query one at a time and process each in its own transaction.
+
+    The first column of the query must be the primary key of the (single) table to lock.
+    Claimed rows are locked with FOR UPDATE SKIP LOCKED, so rows that other workers are
+    processing are skipped instead of waited for. If processing a row raises, the changes made
+    while processing it are rolled back and the row is left for a later pass (or another worker).
+
+    Returns the number of rows claimed.
+    """
+    id_column = query.selected_columns[0]
+    claimed_ids = set()
+    while True:
+        claim_query = query.limit(1).with_for_update(
+            skip_locked=True, of=id_column.table
+        )
+        if claimed_ids:
+            # Don't retry rows that failed during this pass
+            claim_query = claim_query.where(id_column.notin_(claimed_ids))
+
+        with dbsession.begin():
+            row = dbsession.execute(claim_query).first()
+            if row is None:
+                return len(claimed_ids)
+            claimed_ids.add(row[0])
+            try:
+                with dbsession.begin_nested():
+                    process(row)
+            except Exception:
+                logger.exception("Error processing %s %s", id_column.table.name, row[0])
+
+
+def process_claimed_batch(
+    *,
+    dbsession: Session,
+    query: Select,
+    process: Callable[[list[Row]], None],
+    limit: int | None = None,
+) -> int:
+    """
+    Claim all rows matching the query (at most limit) at once and process them together in one transaction.
+
+    Like process_claimed, rows that other workers are processing are skipped. If processing raises,
+    all the changes are rolled back and the rows are left for a later pass (or another worker).
+
+    Returns the number of rows claimed.
+    """
+    id_column = query.selected_columns[0]
+    claim_query = query.with_for_update(skip_locked=True, of=id_column.table)
+    if limit is not None:
+        claim_query = claim_query.limit(limit)
+
+    with dbsession.begin():
+        rows = dbsession.execute(claim_query).all()
+        if not rows:
+            return 0
+        try:
+            with dbsession.begin_nested():
+                process(rows)
+        except Exception:
+            logger.exception(
+                "Error processing %s %s",
+                id_column.table.name,
+                ", ".join(str(row[0]) for row in rows),
+            )
+    return len(rows)
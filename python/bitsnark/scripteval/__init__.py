@@ -24,7 +24,7 @@ module.
 
 import hashlib
 import logging
-from typing import List, Set
+from typing import List, Optional, Set
 
 import bitcointx.core
 import bitcointx.core._bignum
@@ -85,6 +85,7 @@ from bitcointx.core.script import (
     OP_TUCK,
     OP_VERIFY,
     OP_WITHIN,
+    SIGHASH_Type,
     SIGVERSION_TAPSCRIPT,
 )
 from bitcointx.core.scripteval import (
@@ -132,9 +133,14 @@ def eval_tapscript(
     amount: int = 0,
     # TODO: sigversion taproot or tapscript? or base, since nothing supports taproot/tapscript?
     sigversion: SIGVERSION_Type = SIGVERSION_TAPSCRIPT,
-) -> None:
+    spent_outputs: Optional[List["bitcointx.core.CTxOut"]] = None,
+) -> List[bytes]:
     """
-    Evaluate tapscript, optionally ignoring signature checks
+    Evaluate tapscript, optionally ignoring signature checks. Returns the final stack.
+
+    Signatures are checked as in BIP342 (Schnorr signatures of the BIP341 signature hash) when the
+    outputs spent by all the inputs of txTo (spent_outputs) are given, as the signature hash commits
+    to them. Otherwise signature checks only pass with ignore_signature_errors.
     """
     try:
         return _eval_tapscript(
@@ -147,6 +153,7 @@ def eval_tapscript(
             sigversion=sigversion,
             ignore_signature_errors=ignore_signature_errors,
             verify_stack=verify_stack,
+            spent_outputs=spent_outputs,
         )
     except EvalScriptError as exc:
         state = exc.state
@@ -176,7 +183,8 @@ def _eval_tapscript(
     sigversion: SIGVERSION_Type = SIGVERSION_TAPSCRIPT,
     ignore_signature_errors: bool = False,
     verify_stack: bool = True,
-) -> None:
+    spent_outputs: Optional[List["bitcointx.core.CTxOut"]] = None,
+) -> List[bytes]:
     """
     Evaluate tapscript, optionally ignoring signature checks
 
@@ -188,6 +196,8 @@ def _eval_tapscript(
     altstack: List[bytes] = []
     vfExec: List[bool] = []
     pbegincodehash = 0
+    # Opcode position of the last executed OP_CODESEPARATOR, committed to by tapscript signatures
+    codeseparator_pos = -1
     nOpCount = [0]
     v_bytes: bytes
     v_int: int
@@ -219,7 +229,7 @@ def _eval_tapscript(
 
     for sop_index, (sop, sop_data, sop_pc) in enumerate(scriptIn.raw_iter()):
         fExec = _CheckExec(vfExec)
-        logger.info(
+        logger.debug(
             "%5d: %s %s (start byte: %s) (%s)",
             sop_index,
             sop,
@@ -363,13 +373,16 @@ def _eval_tapscript(
                 ok = checksig_tapscript(
                     vchSig,
                     vchPubKey,
-                    tmpScript,
+                    # Tapscript signatures commit to the whole leaf script
+                    scriptIn if sigversion == SIGVERSION_TAPSCRIPT else tmpScript,
                     txTo,
                     inIdx,
                     flags,
                     amount=amount,
                     sigversion=sigversion,
                     ignore_errors=ignore_signature_errors,
+                    spent_outputs=spent_outputs,
+                    codeseparator_pos=codeseparator_pos,
                 )
                 if not ok and SCRIPT_VERIFY_NULLFAIL in flags and len(vchSig):
                     raise VerifyScriptError(
@@ -392,6 +405,7 @@ def _eval_tapscript(
 
             elif sop == OP_CODESEPARATOR:
                 pbegincodehash = sop_pc
+                codeseparator_pos = sop_index
 
             elif sop == OP_DEPTH:
                 bn = len(stack)
@@ -644,6 +658,8 @@ def _eval_tapscript(
                 ),
             )
 
+    return stack
+
 
 def checksig_tapscript(
     sig: bytes,
@@ -655,11 +671,23 @@ def checksig_tapscript(
     amount: int = 0,
     sigversion: SIGVERSION_Type = SIGVERSION_BASE,
     ignore_errors: bool = False,
+    spent_outputs: Optional[List["bitcointx.core.CTxOut"]] = None,
+    codeseparator_pos: int = -1,
 ) -> bool:
-    # TODO: make it actually work with the signature checks, not just if ignore_errors=True
     try:
-        ret = _CheckSig(sig, pubkey, script, txTo, inIdx, flags, amount, sigversion)
-    except (VerifyOpFailedError, ValueError) as e:
+        if sigversion == SIGVERSION_TAPSCRIPT and spent_outputs is not None:
+            ret = _checksig_schnorr(
+                sig,
+                pubkey,
+                script,
+                txTo,
+                inIdx,
+                spent_outputs=spent_outputs,
+                codeseparator_pos=codeseparator_pos,
+            )
+        else:
+            ret = _CheckSig(sig, pubkey, script, txTo, inIdx, flags, amount, sigversion)
+    except (VerifyOpFailedError, VerifyScriptError, ValueError) as e:
         if ignore_errors:
             logger.warning("Ignoring signature check error: %s", e)
             return True
@@ -670,3 +698,51 @@ def checksig_tapscript(
         return True
 
     return ret
+
+
+def _checksig_schnorr(
+    sig: bytes,
+    pubkey: bytes,
+    script: CScript,
+    txTo: "bitcointx.core.CTransaction",
+    inIdx: int,
+    *,
+    spent_outputs: List["bitcointx.core.CTxOut"],
+    codeseparator_pos: int,
+) -> bool:
+    """
+    Signature check of OP_CHECKSIG(VERIFY) in tapscript (BIP342).
+
+    Returns False for an empty signature. A non-empty signature that doesn't verify fails the whole
+    script, so raises VerifyScriptError.
+    """
+    if len(pubkey) == 0:
+        raise VerifyScriptError("empty public key")
+    if len(sig) == 0:
+        return False
+    if len(pubkey) != 32:
+        # Unknown public key types are left for soft forks, and always succeed
+        return True
+
+    hashtype = None
+    if len(sig) == 65:
+        if sig[-1] == 0:
+            raise VerifyScriptError("invalid explicit SIGHASH_DEFAULT in signature")
+        try:
+            hashtype = SIGHASH_Type(sig[-1])
+        except ValueError as e:
+            raise VerifyScriptError(f"invalid hashtype in signature: {e}") from e
+        sig = sig[:-1]
+    elif len(sig) != 64:
+        raise VerifyScriptError(f"invalid Schnorr signature size {len(sig)}")
+
+    sighash = script.sighash_schnorr(
+        txTo,
+        inIdx,
+        spent_outputs=spent_outputs,
+        hashtype=hashtype,
+        codeseparator_pos=codeseparator_pos,
+    )
+    if not bitcointx.core.key.XOnlyPubKey(pubkey).verify_schnorr(sighash, sig):
+        raise VerifyScriptError("invalid Schnorr signature")
+    return True
@@ -0,0 +1,29 @@
+import time
+
+from bitsnark.btc.cache import LRUCache
+
+
+def test_lru_eviction():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    # b was the least recently used
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats.hits == 3
+    assert cache.stats.misses == 1
+    assert cache.stats.size == 2
+
+
+def test_ttl():
+    cache = LRUCache(10)
+    cache.put("a", 1, ttl=0.01)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    time.sleep(0.02)
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert cache.stats.size == 1
@@ -0,0 +1,53 @@
+import threading
+
+from bitsnark.btc.chain_tip import ChainTipWatcher
+from bitsnark.btc.rpc import ChainTip
+
+
+class StubNode:
+    "Stands in for BitcoinRPC, with a chain that only grows when mine() is called"
+
+    def __init__(self):
+        self.blocks = [ChainTip(hash="00", height=0)]
+        self.new_block = threading.Event()
+
+    def mine(self):
+        tip = self.blocks[-1]
+        self.blocks.append(
+            ChainTip(hash=f"{tip.height + 1:02x}", height=tip.height + 1)
+        )
+        self.new_block.set()
+
+    def get_chain_tip(self) -> ChainTip:
+        return self.blocks[-1]
+
+    def wait_for_new_block(self, timeout: float) -> ChainTip:
+        self.new_block.wait(timeout)
+        self.new_block.clear()
+        return self.blocks[-1]
+
+
+def test_wait_times_out_without_new_blocks():
+    node = StubNode()
+    watcher = ChainTipWatcher(node)
+    assert watcher.tip == ChainTip(hash="00", height=0)
+    assert watcher.wait(timeout=0.01) is None
+
+
+def test_wait_returns_new_block():
+    node = StubNode()
+    watcher = ChainTipWatcher(node)
+    assert watcher.tip.height == 0
+    threading.Timer(0.01, node.mine).start()
+    assert watcher.wait(timeout=5) == ChainTip(hash="01", height=1)
+    assert watcher.tip.height == 1
+
+
+def test_block_between_waits_is_not_missed():
+    node = StubNode()
+    watcher = ChainTipWatcher(node)
+    assert watcher.tip.height == 0
+    node.mine()
+    node.new_block.clear()
+    assert watcher.wait(timeout=0.01) == ChainTip(hash="01", height=1)
+    assert watcher.wait(timeout=0.01) is None
@@ -0,0 +1,117 @@
+import random
+
+import pytest
+from bitcointx.core import CMutableTransaction, COutPoint, CTxIn, CTxInWitness, CTxOut
+from bitcointx.core.script import CScript, CScriptWitness
+
+from bitsnark.btc.coin_selection import (
+    CHANGE_OUTPUT_WEIGHT,
+    CoinSelector,
+    InsufficientFunds,
+    P2TR_INPUT_WEIGHT,
+    P2WPKH_INPUT_WEIGHT,
+    get_transaction_weight,
+)
+from bitsnark.btc.utxos import WalletUTXO
+
+P2TR_SCRIPT = CScript(b"\x51\x20" + b"\x01" * 32)
+P2WPKH_SCRIPT = CScript(b"\x00\x14" + b"\x02" * 20)
+BASE_WEIGHT = 600
+BASE_VALUE_SAT = -10_000
+
+
+def make_utxos(amounts, script_pubkey=P2TR_SCRIPT):
+    return [
+        WalletUTXO(
+            txid=f"{i:064x}",
+            vout=0,
+            amount_sat=amount,
+            script_pubkey=script_pubkey,
+            confirmations=len(amounts) - i,
+        )
+        for i, amount in enumerate(amounts)
+    ]
+
+
+def make_selector(fee_rate_sat_per_vb=10, **kwargs):
+    return CoinSelector(
+        fee_rate_sat_per_vb=fee_rate_sat_per_vb,
+        base_weight=BASE_WEIGHT,
+        base_value_sat=BASE_VALUE_SAT,
+        **kwargs,
+    )
+
+
+def test_input_weights_match_signed_transactions():
+    for script_pubkey, witness, weight in [
+        (P2TR_SCRIPT, [b"s" * 65], P2TR_INPUT_WEIGHT),
+        (P2WPKH_SCRIPT, [b"s" * 72, b"p" * 33], P2WPKH_INPUT_WEIGHT),
+    ]:
+        txins = [CTxIn(COutPoint(b"\x03" * 32, i)) for i in range(2)]
+        witnesses = [CTxInWitness(CScriptWitness([b"w" * 64]))]
+        tx = CMutableTransaction(
+            vin=txins[:1],
+            vout=[CTxOut(1000, P2TR_SCRIPT)],
+            witness=None,
+        )
+        tx.wit.vtxinwit = witnesses
+        funded_tx = CMutableTransaction(
+            vin=txins, vout=[CTxOut(1000, P2TR_SCRIPT), CTxOut(1000, P2TR_SCRIPT)]
+        )
+        funded_tx.wit.vtxinwit = witnesses + [CTxInWitness(CScriptWitness(witness))]
+        assert (
+            get_transaction_weight(funded_tx)
+            == get_transaction_weight(tx) + weight + CHANGE_OUTPUT_WEIGHT
+        )
+
+
+def test_selection_pays_fee_rate():
+    selector = make_selector()
+    selection = selector.select(make_utxos([3000, 5000, 100_000]))
+    assert selection.has_change
+    total_in = sum(utxo.amount_sat for utxo in selection.utxos) + BASE_VALUE_SAT
+    assert total_in == selection.fee_sat + selection.change_sat
+    assert selection.fee_sat >= 10 * selection.vsize
+    assert selection.weight == (
+        BASE_WEIGHT + len(selection.utxos) * P2TR_INPUT_WEIGHT + CHANGE_OUTPUT_WEIGHT
+    )
+
+
+def test_changeless_match_is_preferred():
+    selector = make_selector()
+    # Exactly enough for the base transaction and one input, without change
+    exact_amount = (
+        selector.fee_for_weight(BASE_WEIGHT + P2TR_INPUT_WEIGHT) - BASE_VALUE_SAT
+    )
+    selection = selector.select(make_utxos([500_000, exact_amount, 300_000]))
+    assert [utxo.amount_sat for utxo in selection.utxos] == [exact_amount]
+    assert not selection.has_change
+    assert selection.fee_sat == selector.fee_for_weight(selection.weight)
+
+
+def test_uneconomical_coins_are_skipped():
+    selector = make_selector(fee_rate_sat_per_vb=100)
+    selection = selector.select(make_utxos([1000, 1000, 1_000_000]))
+    assert [utxo.amount_sat for utxo in selection.utxos] == [1_000_000]
+
+
+def test_insufficient_funds():
+    with pytest.raises(InsufficientFunds):
+        make_selector().select(make_utxos([5000, 4000]))
+
+
+def test_fees_are_never_below_fee_rate():
+    rng = random.Random(1)
+    for _ in range(200):
+        fee_rate = rng.choice([1, 2, 7, 25])
+        amounts = [rng.randint(500, 50_000) for _ in range(rng.randint(1, 30))]
+        script_pubkey = rng.choice([P2TR_SCRIPT, P2WPKH_SCRIPT])
+        selector = make_selector(fee_rate)
+        try:
+            selection = selector.select(make_utxos(amounts, script_pubkey))
+        except InsufficientFunds:
+            continue
+        total_in = sum(utxo.amount_sat for utxo in selection.utxos) + BASE_VALUE_SAT
+        assert total_in == selection.fee_sat + selection.change_sat
+        assert selection.fee_sat >= fee_rate * selection.vsize
+        assert selection.change_sat == 0 or selection.change_sat > 546
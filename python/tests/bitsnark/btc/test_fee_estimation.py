@@ -0,0 +1,99 @@
+from decimal import Decimal
+from fractions import Fraction
+
+from bitsnark.btc.fee_estimation import FeeEstimator
+
+
+class StubResult:
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+class StubNode:
+    "Stands in for BitcoinRPC of a node, with estimates in BTC/kvB per confirmation target"
+
+    def __init__(self, estimates, *, min_fee=Decimal("0.00001")):
+        self.tip_hash = "00"
+        self.estimates = estimates
+        self.min_fee = min_fee
+        self.num_batches = 0
+
+    def call(self, method, *args):
+        assert method == "getbestblockhash"
+        return self.tip_hash
+
+    def batch(self):
+        self.num_batches += 1
+        return StubBatch(self)
+
+
+class StubBatch:
+    def __init__(self, node):
+        self.node = node
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def call(self, method, *args):
+        if method == "getmempoolinfo":
+            return StubResult(
+                {
+                    "mempoolminfee": self.node.min_fee,
+                    "minrelaytxfee": Decimal("0.00001"),
+                }
+            )
+        assert method == "estimatesmartfee"
+        (conf_target,) = args
+        # Like the node, fall back to the nearest higher target with an estimate
+        for blocks in sorted(self.node.estimates):
+            if blocks >= conf_target:
+                return StubResult(
+                    {"feerate": self.node.estimates[blocks], "blocks": blocks}
+                )
+        return StubResult({"errors": ["Insufficient data or no feerate found"]})
+
+
+def test_fetched_once_per_block():
+    node = StubNode({1: Decimal("0.0002")})
+    estimator = FeeEstimator(node, fallback_fee_rate_sat_per_vb=5)
+    assert estimator.get_fee_rate(1) == 20
+    assert estimator.get_fee_rate(6) == 20
+    assert node.num_batches == 1
+    node.tip_hash = "01"
+    node.estimates = {1: Decimal("0.0003")}
+    assert estimator.get_fee_rate(1) == 30
+    assert node.num_batches == 2
+
+
+def test_fee_rate_for_deadline():
+    node = StubNode(
+        {2: Decimal("0.0005"), 6: Decimal("0.0001"), 144: Decimal("0.00002")}
+    )
+    estimator = FeeEstimator(node, fallback_fee_rate_sat_per_vb=5)
+    assert estimator.get_fee_rate_for_deadline(5) == 50
+    assert estimator.get_fee_rate_for_deadline(6) == 10
+    assert estimator.get_fee_rate_for_deadline(1000) == 2
+    # Nothing confirms in time, so the fastest estimate
+    assert estimator.get_fee_rate_for_deadline(1) == 50
+    assert estimator.get_fee_rate_for_deadline(0) == 50
+    # The routine target
+    assert estimator.get_fee_rate_for_deadline(None) == 10
+
+
+def test_not_below_mempool_minimum():
+    node = StubNode({1: Decimal("0.00002")}, min_fee=Decimal("0.000035"))
+    estimator = FeeEstimator(node, fallback_fee_rate_sat_per_vb=1)
+    assert estimator.get_fee_rate(1) == Fraction(7, 2)
+
+
+def test_fallback_without_estimates():
+    node = StubNode({})
+    estimator = FeeEstimator(node, fallback_fee_rate_sat_per_vb=7)
+    assert estimator.get_fee_rate(1) == 7
+    assert estimator.get_fee_rate_for_deadline(None) == 7
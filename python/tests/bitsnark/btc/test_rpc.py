@@ -0,0 +1,30 @@
+import json
+
+import pytest
+
+from bitsnark.btc.rpc import parse_btc_amount_sat
+
+
+@pytest.mark.parametrize(
+    "raw, sat",
+    [
+        ("0.00000001", 1),
+        ("0.00012345", 12345),
+        ("50.00000000", 5_000_000_000),
+        ("20999999.97690000", 2_099_999_997_690_000),
+        ("21000000.00000000", 2_100_000_000_000_000),
+        ("0.29999999", 29_999_999),
+        ("-0.10000000", -10_000_000),
+        ("0.1", 10_000_000),
+        ("1e-05", 1000),
+    ],
+)
+def test_parse_btc_amount_sat(raw, sat):
+    assert parse_btc_amount_sat(raw) == sat
+
+
+def test_parse_json_amounts_as_sat():
+    response = '[{"txid": "ab", "vout": 1, "amount": 0.00100000, "confirmations": 6}]'
+    assert json.loads(response, parse_float=parse_btc_amount_sat) == [
+        {"txid": "ab", "vout": 1, "amount": 100_000, "confirmations": 6}
+    ]
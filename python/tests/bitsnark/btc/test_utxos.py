@@ -0,0 +1,106 @@
+import threading
+
+import pytest
+
+from bitsnark.btc.utxos import WalletUTXOManager
+
+
+class StubWallet:
+    "Stands in for BitcoinRPC of a wallet"
+
+    def __init__(self, amounts):
+        self.tip_hash = "00"
+        self.unspents = [
+            {
+                "txid": f"{i:064x}",
+                "vout": 0,
+                "amount": amount,
+                "scriptPubKey": "51",
+                "confirmations": 10 - i,
+                "spendable": True,
+            }
+            for i, amount in enumerate(amounts)
+        ]
+        self.num_listings = 0
+
+    def call(self, method, *args):
+        assert method == "getbestblockhash"
+        return self.tip_hash
+
+    def call_sats(self, method, *args):
+        assert method == "listunspent"
+        self.num_listings += 1
+        return list(self.unspents)
+
+
+def take(n):
+    return lambda available: available[:n]
+
+
+def test_lists_once_per_block():
+    wallet = StubWallet([1000, 2000])
+    manager = WalletUTXOManager(wallet)
+    manager.refresh_if_new_block()
+    manager.refresh_if_new_block()
+    assert wallet.num_listings == 1
+    wallet.tip_hash = "01"
+    manager.refresh_if_new_block()
+    assert wallet.num_listings == 2
+
+
+def test_reservations_are_exclusive():
+    wallet = StubWallet(range(1, 101))
+    manager = WalletUTXOManager(wallet)
+    manager.refresh()
+    reserved = []
+
+    def reserve():
+        for _ in range(10):
+            reserved.extend(manager.reserve(take(1)))
+
+    threads = [threading.Thread(target=reserve) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({(utxo.txid, utxo.vout) for utxo in reserved}) == 100
+    assert manager.available == []
+
+
+def test_oldest_first_and_release():
+    wallet = StubWallet([1000, 2000, 3000])
+    manager = WalletUTXOManager(wallet)
+    manager.refresh()
+    (utxo,) = manager.reserve(take(1))
+    assert utxo.amount_sat == 1000
+    assert utxo.txout.nValue == 1000
+    manager.release([utxo])
+    assert [u.amount_sat for u in manager.available] == [1000, 2000, 3000]
+
+
+def test_failed_selection_reserves_nothing():
+    wallet = StubWallet([1000])
+    manager = WalletUTXOManager(wallet)
+    manager.refresh()
+
+    def select(available):
+        raise RuntimeError()
+
+    with pytest.raises(RuntimeError):
+        manager.reserve(select)
+    assert len(manager.available) == 1
+
+
+def test_spent_coins_are_not_resurrected():
+    wallet = StubWallet([1000, 2000])
+    manager = WalletUTXOManager(wallet)
+    manager.refresh()
+    spent = manager.reserve(take(1))
+    manager.mark_spent(spent)
+    # The wallet hasn't seen the spending transaction yet
+    manager.refresh()
+    assert [u.amount_sat for u in manager.available] == [2000]
+    # Now it has
+    wallet.unspents.pop(0)
+    manager.refresh()
+    assert [u.amount_sat for u in manager.available] == [2000]
@@ -0,0 +1,193 @@
+from types import SimpleNamespace
+
+import pytest
+from bitcointx.core import (
+    CMutableTransaction,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+)
+from bitcointx.core.script import CScript
+
+from bitsnark.btc.rpc import JSONRPCError
+from bitsnark.cli import broadcast
+from bitsnark.cli.broadcast import (
+    NotTested,
+    ParentNotBroadcast,
+    broadcast_transaction_package,
+    sort_topologically,
+)
+
+
+def make_template(name, ordinal, parents=(), setup_id="setup"):
+    tx = CMutableTransaction(
+        [CTxIn(COutPoint(name.encode().ljust(32, b"\0"), 0))],
+        [CTxOut(1000, CScript(b"\x51\x20" + b"\x01" * 32))],
+    ).to_immutable()
+    return SimpleNamespace(
+        name=name,
+        ordinal=ordinal,
+        setup_id=setup_id,
+        inputs=[{"templateName": parent} for parent in parents],
+        tx=tx,
+        txid=tx.GetTxid()[::-1].hex(),
+    )
+
+
+class StubResult:
+    def __init__(self, value=None, error=None):
+        self.value = value
+        self.error = error
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class StubNode:
+    "Stands in for BitcoinRPC, rejecting the transactions of some templates"
+
+    def __init__(self, tx_templates, rejected=()):
+        self.names = {t.tx.serialize().hex(): t.name for t in tx_templates}
+        self.parents = {
+            t.name: [inp["templateName"] for inp in t.inputs] for t in tx_templates
+        }
+        self.rejected = set(rejected)
+        self.mempool = []
+        # The methods called in each batch
+        self.batches = []
+
+    def batch(self):
+        self.batches.append([])
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def call(self, method, *args):
+        self.batches[-1].append(method)
+        if method == "testmempoolaccept":
+            (tx_hexes,) = args
+            results = []
+            for tx_hex in tx_hexes:
+                if results and not results[-1].get("allowed"):
+                    # The rest of the package is not tested
+                    results.append({"package-error": "transaction failed"})
+                elif self.names[tx_hex] in self.rejected:
+                    results.append({"allowed": False, "reject-reason": "bad"})
+                else:
+                    results.append({"allowed": True})
+            return StubResult(results)
+        assert method == "sendrawtransaction"
+        (tx_hex,) = args
+        name = self.names[tx_hex]
+        if name in self.rejected or any(
+            parent in self.names.values() and parent not in self.mempool
+            for parent in self.parents[name]
+        ):
+            return StubResult(error=JSONRPCError(message="rejected", code=-26))
+        self.mempool.append(name)
+        return StubResult(txid_of(tx_hex))
+
+
+def txid_of(tx_hex):
+    return CTransaction.deserialize(bytes.fromhex(tx_hex)).GetTxid()[::-1].hex()
+
+
+@pytest.fixture(autouse=True)
+def built_transactions(monkeypatch):
+    monkeypatch.setattr(
+        broadcast,
+        "get_signed_transaction",
+        lambda tx_template, dbsession: tx_template.tx,
+    )
+
+
+def test_parents_first_then_by_ordinal():
+    templates = [
+        make_template("C", 0, parents=["B"]),
+        make_template("B", 1, parents=["A"]),
+        make_template("A", 2),
+        make_template("D", 3),
+    ]
+    assert [t.name for t in sort_topologically(templates)] == ["A", "B", "C", "D"]
+
+
+def test_tested_then_sent():
+    templates = [
+        make_template("CHILD", 0, parents=["PARENT"]),
+        make_template("PARENT", 1),
+        make_template("OTHER", 0, setup_id="other"),
+    ]
+    node = StubNode(templates)
+    errors = broadcast_transaction_package(templates, None, node)
+    assert errors == [None, None, None]
+    assert node.batches == [
+        ["testmempoolaccept", "testmempoolaccept"],
+        ["sendrawtransaction"] * 3,
+    ]
+    assert node.mempool == ["PARENT", "CHILD", "OTHER"]
+
+
+def test_rejected_parent():
+    templates = [
+        make_template("PARENT", 0),
+        make_template("CHILD", 1, parents=["PARENT"]),
+        make_template("OTHER", 2),
+        make_template("OTHER_SETUP", 0, setup_id="other"),
+    ]
+    node = StubNode(templates, rejected=["PARENT"])
+    errors = broadcast_transaction_package(templates, None, node)
+    assert isinstance(errors[0], ValueError)
+    assert isinstance(errors[1], ParentNotBroadcast)
+    # Not tested because of another transaction in the package, so not rejected itself
+    assert isinstance(errors[2], NotTested)
+    assert not isinstance(errors[2], ValueError)
+    assert errors[3] is None
+    # Only the accepted transaction is sent
+    assert node.batches[1] == ["sendrawtransaction"]
+    assert node.mempool == ["OTHER_SETUP"]
+
+
+def test_packages_sent_before_testing_the_next(monkeypatch):
+    monkeypatch.setattr(broadcast, "MAX_PACKAGE_COUNT", 2)
+    templates = [make_template("A", 0)]
+    for i, name in enumerate("BCDE", start=1):
+        templates.append(make_template(name, i, parents=[templates[-1].name]))
+    node = StubNode(templates, rejected=["D"])
+    errors = broadcast_transaction_package(templates, None, node)
+    assert errors[:2] == [None, None]
+    assert isinstance(errors[3], ValueError)
+    assert isinstance(errors[4], ParentNotBroadcast)
+    assert node.mempool == ["A", "B", "C"]
+    # E is not tested, as its parent in the previous package was rejected
+    assert node.batches == [
+        ["testmempoolaccept"],
+        ["sendrawtransaction"] * 2,
+        ["testmempoolaccept"],
+        ["sendrawtransaction"],
+    ]
+
+
+def test_children_of_unbuildable_are_not_sent(monkeypatch):
+    templates = [
+        make_template("PARENT", 0),
+        make_template("CHILD", 1, parents=["PARENT"]),
+    ]
+
+    def get_signed_transaction(tx_template, dbsession):
+        if tx_template.name == "PARENT":
+            raise RuntimeError("not signed")
+        return tx_template.tx
+
+    monkeypatch.setattr(broadcast, "get_signed_transaction", get_signed_transaction)
+    node = StubNode(templates)
+    errors = broadcast_transaction_package(templates, None, node)
+    assert isinstance(errors[0], RuntimeError)
+    assert isinstance(errors[1], ParentNotBroadcast)
+    assert node.batches == []
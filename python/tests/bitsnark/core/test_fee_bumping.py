@@ -0,0 +1,172 @@
+from fractions import Fraction
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from bitsnark.btc.rpc import JSONRPCError
+from bitsnark.btc.utxos import WalletUTXOManager
+from bitsnark.core.fee_bumping import FeeBumpPolicy, bump_transaction_fee
+from bitsnark.core.funding import fund_tx_templates_from_wallet
+from bitsnark.core.models import Received, TransactionTemplate
+
+from .test_funding import (
+    TEMPLATE_AMOUNT_SAT,
+    StubWallet,
+    get_funded_tx,
+    make_template,
+    unfunded_transactions,  # noqa: F401 (autouse fixture)
+)
+
+# Bumped far enough that the replacement needs more coins
+POLICY = FeeBumpPolicy(bump_factor=Fraction(50))
+
+
+@pytest.fixture()
+def dbsession():
+    engine = sa.create_engine("sqlite://")
+    TransactionTemplate.__table__.create(engine)
+    Received.__table__.create(engine)
+    with Session(engine) as dbsession:
+        yield dbsession
+
+
+def get_wallet_coins(tx):
+    return {(tx_in.prevout.hash[::-1].hex(), tx_in.prevout.n) for tx_in in tx.vin[1:]}
+
+
+def publish_funded_template(dbsession, wallet, utxo_manager):
+    "A funded template that has been in the mempool since block 100 at 2 sat/vB"
+    parent = make_template("PARENT")
+    parent.fundable = False
+    parent.outputs = [{"index": 0, "spendingConditions": [{}]}]
+    tx_template = make_template("A")
+    dbsession.add_all([parent, tx_template])
+    dbsession.flush()
+    errors = fund_tx_templates_from_wallet(
+        tx_templates=[tx_template],
+        dbsession=dbsession,
+        bitcoin_rpc=wallet,
+        fee_rate_sat_per_vb=2,
+        utxo_manager=utxo_manager,
+    )
+    assert errors == [None]
+    dbsession.commit()
+
+    tx = get_funded_tx(wallet, tx_template)
+    fee_sat = sum(wallet.coins[coin] for coin in get_wallet_coins(tx)) - sum(
+        tx_out.nValue for tx_out in tx.vout[1:]
+    )
+    wallet.mempool_entries[tx_template.txid] = {
+        "fees": {"base": fee_sat, "descendant": fee_sat},
+        "vsize": tx.get_virtual_size(),
+        "descendantsize": tx.get_virtual_size(),
+        "height": 100,
+        "spentby": [],
+    }
+    return tx_template, tx
+
+
+def bump(tx_template, dbsession, wallet, utxo_manager):
+    return bump_transaction_fee(
+        tx_template=tx_template,
+        dbsession=dbsession,
+        bitcoin_rpc=wallet,
+        tip_height=110,
+        policy=POLICY,
+        utxo_manager=utxo_manager,
+    )
+
+
+def get_available(utxo_manager):
+    return {(utxo.txid, utxo.vout) for utxo in utxo_manager.available}
+
+
+def test_replace_by_fee(dbsession):
+    wallet = StubWallet([3_000, 100_000])
+    utxo_manager = WalletUTXOManager(wallet)
+    tx_template, tx = publish_funded_template(dbsession, wallet, utxo_manager)
+    old_coins = get_wallet_coins(tx)
+
+    assert bump(tx_template, dbsession, wallet, utxo_manager)
+    (replacement,) = wallet.sent
+    assert replacement.vin[0] == tx.vin[0]
+    assert tx_template.txid == replacement.GetTxid()[::-1].hex()
+    new_coins = get_wallet_coins(replacement)
+    assert new_coins - old_coins
+    # Coins of the replacement are locked, and the ones it no longer uses are unlocked
+    assert wallet.locked == new_coins
+    assert get_available(utxo_manager) == set(wallet.coins) - new_coins
+
+
+def test_replace_evicted_by_fee(dbsession):
+    wallet = StubWallet([3_000, 100_000])
+    utxo_manager = WalletUTXOManager(wallet)
+    tx_template, tx = publish_funded_template(dbsession, wallet, utxo_manager)
+    entry = wallet.mempool_entries.pop(tx_template.txid)
+    # Like bitcoind, the fee only counts the wallet's inputs, not the protocol input
+    wallet.wallet_txs[tx_template.txid] = {
+        "confirmations": 0,
+        "fee": -(entry["fees"]["base"] - TEMPLATE_AMOUNT_SAT),
+        "hex": tx.serialize().hex(),
+    }
+
+    assert bump(tx_template, dbsession, wallet, utxo_manager)
+    (replacement,) = wallet.sent
+    assert replacement.vin[0] == tx.vin[0]
+    fee_sat = (
+        TEMPLATE_AMOUNT_SAT
+        + sum(wallet.coins[coin] for coin in get_wallet_coins(replacement))
+        - sum(tx_out.nValue for tx_out in replacement.vout)
+    )
+    assert Fraction(fee_sat, replacement.get_virtual_size()) >= POLICY.bump_factor * 2
+
+
+def test_not_bumped_if_not_a_wallet_transaction(dbsession):
+    wallet = StubWallet([3_000, 100_000])
+    utxo_manager = WalletUTXOManager(wallet)
+    tx_template, tx = publish_funded_template(dbsession, wallet, utxo_manager)
+    del wallet.mempool_entries[tx_template.txid]
+
+    assert not bump(tx_template, dbsession, wallet, utxo_manager)
+    assert wallet.sent == []
+    assert wallet.locked == get_wallet_coins(tx)
+
+
+def test_failed_replacement_releases_coins(dbsession):
+    wallet = StubWallet([3_000, 100_000])
+    utxo_manager = WalletUTXOManager(wallet)
+    tx_template, tx = publish_funded_template(dbsession, wallet, utxo_manager)
+    old_coins = get_wallet_coins(tx)
+    old_inputs = list(tx_template.inputs)
+    # The replacement is rejected, the child is sent without testing
+    wallet.rejected_methods.add("testmempoolaccept")
+
+    assert bump(tx_template, dbsession, wallet, utxo_manager)
+    # The template is unchanged, and its coins still locked
+    assert tx_template.txid == tx.GetTxid()[::-1].hex()
+    assert tx_template.inputs == old_inputs
+    assert wallet.locked == old_coins
+    # The coins reserved for the replacement were released, so the child could use them
+    (child,) = wallet.sent
+    assert child.vin[0].prevout.hash == tx.GetTxid()
+    assert child.vin[0].prevout.n == 1
+    child_coins = get_wallet_coins(child)
+    assert child_coins == set(wallet.coins) - old_coins
+    assert get_available(utxo_manager) == set()
+
+
+def test_failed_child_releases_coins(dbsession):
+    wallet = StubWallet([3_000, 100_000])
+    utxo_manager = WalletUTXOManager(wallet)
+    tx_template, tx = publish_funded_template(dbsession, wallet, utxo_manager)
+    old_coins = get_wallet_coins(tx)
+    available = get_available(utxo_manager)
+    assert available
+    wallet.rejected_methods.update(["testmempoolaccept", "sendrawtransaction"])
+
+    with pytest.raises(JSONRPCError):
+        bump(tx_template, dbsession, wallet, utxo_manager)
+    assert wallet.sent == []
+    assert wallet.locked == old_coins
+    assert get_available(utxo_manager) == available
@@ -0,0 +1,328 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+import sqlalchemy as sa
+from bitcointx.core import (
+    CMutableTransaction,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxInWitness,
+    CTxOut,
+    CTxWitness,
+)
+from bitcointx.core.psbt import PartiallySignedTransaction
+from bitcointx.core.script import CScript, CScriptWitness
+from bitcointx.wallet import CCoinAddress
+from sqlalchemy.orm import Session
+
+from bitsnark.btc.rpc import JSONRPCError
+from bitsnark.btc.utxos import WalletUTXOManager
+from bitsnark.core import funding
+from bitsnark.core.funding import (
+    MIN_NON_DUST_SAT,
+    _split_wallet_coins,
+    fund_tx_templates_from_wallet,
+)
+from bitsnark.core.models import OutgoingStatus, TransactionTemplate
+
+TEMPLATE_AMOUNT_SAT = 10_000
+
+
+class StubResult:
+    def __init__(self, value=None, error=None):
+        self.value = value
+        self.error = error
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class StubBatch:
+    "Calls are made right away, their results are returned when asked for"
+
+    def __init__(self, node):
+        self.node = node
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def call(self, method, *args):
+        try:
+            return StubResult(self.node.call(method, *args))
+        except JSONRPCError as e:
+            return StubResult(error=e)
+
+
+class StubWallet:
+    "Stands in for BitcoinRPC of a wallet with the given coins"
+
+    def __init__(self, amounts, *, rejected_methods=()):
+        self.coins = {(f"{i + 1:064x}", 0): amount for i, amount in enumerate(amounts)}
+        self.rejected_methods = set(rejected_methods)
+        self.locked = set()
+        # Mempool entries (getmempoolentry) by txid
+        self.mempool_entries = {}
+        # Wallet transactions (gettransaction) by txid
+        self.wallet_txs = {}
+        self.sent = []
+        # Signed transactions by their first outpoint's txid (the template's input when funding)
+        self.signed = {}
+        self.calls = []
+        self.num_addresses = 0
+
+    def batch(self):
+        return StubBatch(self)
+
+    def get_outputs(self, outpoints):
+        return [
+            CTxOut(
+                self.coins[(outpoint.hash[::-1].hex(), outpoint.n)],
+                CScript(bytes.fromhex("0014" + "00" * 20)),
+            )
+            for outpoint in outpoints
+        ]
+
+    def call_sats(self, method, *args):
+        if method == "getmempoolentry":
+            (txid,) = args
+            if txid not in self.mempool_entries:
+                raise JSONRPCError(message="Transaction not in mempool", code=-5)
+            return self.mempool_entries[txid]
+        if method == "gettransaction":
+            (txid,) = args
+            if txid not in self.wallet_txs:
+                raise JSONRPCError(
+                    message="Invalid or non-wallet transaction id", code=-5
+                )
+            return self.wallet_txs[txid]
+        assert method == "listunspent"
+        return [
+            {
+                "txid": txid,
+                "vout": vout,
+                "amount": amount,
+                "scriptPubKey": "0014" + "00" * 20,
+                "confirmations": 1,
+            }
+            for (txid, vout), amount in self.coins.items()
+        ]
+
+    def call(self, method, *args):
+        self.calls.append(method)
+        if method == "getbestblockhash":
+            return "00"
+        if method in ("getnewaddress", "getrawchangeaddress"):
+            self.num_addresses += 1
+            return str(
+                CCoinAddress.from_scriptPubKey(
+                    CScript([0, self.num_addresses.to_bytes(20, "big")])
+                )
+            )
+        if method == "walletprocesspsbt":
+            (psbt_base64,) = args
+            psbt = PartiallySignedTransaction.from_base64(psbt_base64)
+            for psbt_input in psbt.inputs:
+                if not psbt_input.is_final():
+                    psbt_input.final_script_witness = CScriptWitness(
+                        [b"\x30" * 72, b"\x02" * 33]
+                    )
+            tx = psbt.extract_transaction()
+            self.signed[tx.vin[0].prevout.hash] = tx
+            return {"complete": True, "psbt": psbt.to_base64()}
+        if method == "testmempoolaccept":
+            ((tx_hex,),) = args
+            txid = CTransaction.deserialize(bytes.fromhex(tx_hex)).GetTxid()[::-1].hex()
+            if method in self.rejected_methods:
+                return [{"txid": txid, "allowed": False, "reject-reason": "bad"}]
+            return [{"txid": txid, "allowed": True}]
+        if method == "sendrawtransaction":
+            if method in self.rejected_methods:
+                raise JSONRPCError(message="bad", code=-26)
+            (tx_hex,) = args
+            tx = CTransaction.deserialize(bytes.fromhex(tx_hex))
+            self.sent.append(tx)
+            return tx.GetTxid()[::-1].hex()
+        if method == "lockunspent":
+            unlock, outpoints = args
+            keys = {(outpoint["txid"], outpoint["vout"]) for outpoint in outpoints}
+            if unlock:
+                self.locked -= keys
+            else:
+                self.locked |= keys
+            return True
+        raise JSONRPCError(message=f"Unexpected {method}", code=-32601)
+
+
+@pytest.fixture()
+def dbsession():
+    with Session(sa.create_engine("sqlite://")) as dbsession:
+        yield dbsession
+
+
+@pytest.fixture(autouse=True)
+def unfunded_transactions(monkeypatch):
+    "Each template is a signed transaction spending and paying TEMPLATE_AMOUNT_SAT, which needs a fee"
+
+    def construct_signed_transaction(
+        tx_template, dbsession, ignore_funded_inputs_and_outputs=False
+    ):
+        tx = CMutableTransaction(
+            [CTxIn(COutPoint(tx_template.name.encode().ljust(32, b"\0"), 0))],
+            [CTxOut(TEMPLATE_AMOUNT_SAT, CScript(b"\x51\x20" + b"\x01" * 32))],
+            witness=CTxWitness([CTxInWitness(CScriptWitness([b"\x01" * 65]))]),
+        )
+        return SimpleNamespace(
+            tx=tx.to_immutable(),
+            signable_tx=SimpleNamespace(
+                spent_outputs=[
+                    CTxOut(TEMPLATE_AMOUNT_SAT, CScript(b"\x51\x20" + b"\x02" * 32))
+                ]
+            ),
+        )
+
+    monkeypatch.setattr(
+        funding, "construct_signed_transaction", construct_signed_transaction
+    )
+
+
+def make_template(name):
+    return TransactionTemplate(
+        name=name,
+        setup_id="setup",
+        role="PROVER",
+        is_external=False,
+        txid="00" * 32,
+        unknown_txid=True,
+        fundable=True,
+        funded=False,
+        ordinal=0,
+        inputs=[
+            {
+                "index": 0,
+                "templateName": "PARENT",
+                "outputIndex": 0,
+                "spendingConditionIndex": 0,
+            }
+        ],
+        outputs=[{"index": 0}],
+        status=OutgoingStatus.READY,
+        updated_at=datetime.datetime(2024, 1, 1),
+    )
+
+
+def get_funded_tx(wallet, tx_template):
+    return wallet.signed[tx_template.name.encode().ljust(32, b"\0")]
+
+
+def check_funded(wallet, tx_templates, fee_rate_sat_per_vb):
+    "Check the funding of the templates, and return the wallet coins they spend"
+    used_coins = []
+    for tx_template in tx_templates:
+        tx = get_funded_tx(wallet, tx_template)
+        assert tx_template.funded
+        assert tx_template.txid == tx.GetTxid()[::-1].hex()
+        assert len(tx_template.inputs) == len(tx.vin)
+        assert len(tx_template.outputs) == len(tx.vout)
+        coins = [
+            (tx_in.prevout.hash[::-1].hex(), tx_in.prevout.n) for tx_in in tx.vin[1:]
+        ]
+        used_coins.extend(coins)
+        # Everything but the fee is paid back to the wallet as change (if it's not dust)
+        change_sat = sum(tx_out.nValue for tx_out in tx.vout[1:])
+        assert all(tx_out.nValue > MIN_NON_DUST_SAT for tx_out in tx.vout[1:])
+        fee_sat = sum(wallet.coins[coin] for coin in coins) - change_sat
+        min_fee_sat = fee_rate_sat_per_vb * tx.get_virtual_size()
+        assert min_fee_sat <= fee_sat <= min_fee_sat + MIN_NON_DUST_SAT
+    assert len(set(used_coins)) == len(used_coins)
+    return used_coins
+
+
+def test_fund_together_without_reusing_coins(dbsession):
+    wallet = StubWallet([50_000, 40_000, 30_000, 20_000])
+    utxo_manager = WalletUTXOManager(wallet)
+    tx_templates = [make_template(name) for name in ["A", "B", "C"]]
+    errors = fund_tx_templates_from_wallet(
+        tx_templates=tx_templates,
+        dbsession=dbsession,
+        bitcoin_rpc=wallet,
+        fee_rate_sat_per_vb=10,
+        utxo_manager=utxo_manager,
+    )
+    assert errors == [None, None, None]
+    used_coins = check_funded(wallet, tx_templates, 10)
+    assert wallet.locked == set(used_coins)
+    assert [(utxo.txid, utxo.vout) for utxo in utxo_manager.available] == [
+        coin for coin in wallet.coins if coin not in used_coins
+    ]
+    assert wallet.sent == []
+
+
+def test_out_of_funds_for_one(dbsession):
+    wallet = StubWallet([50_000])
+    tx_templates = [make_template(name) for name in ["A", "B"]]
+    errors = fund_tx_templates_from_wallet(
+        tx_templates=tx_templates,
+        dbsession=dbsession,
+        bitcoin_rpc=wallet,
+        fee_rate_sat_per_vb=10,
+        presplit=False,
+    )
+    assert errors[0] is None
+    assert isinstance(errors[1], funding.OutOfFunds)
+    check_funded(wallet, tx_templates[:1], 10)
+    assert not tx_templates[1].funded
+
+
+def test_split_coins_when_not_enough_separate_coins(dbsession):
+    wallet = StubWallet([1_000_000])
+    utxo_manager = WalletUTXOManager(wallet)
+    tx_templates = [make_template(name) for name in ["A", "B", "C"]]
+    errors = fund_tx_templates_from_wallet(
+        tx_templates=tx_templates,
+        dbsession=dbsession,
+        bitcoin_rpc=wallet,
+        fee_rate_sat_per_vb=10,
+        utxo_manager=utxo_manager,
+    )
+    assert errors == [None, None, None]
+    (split_tx,) = wallet.sent
+    assert [tx_in.prevout.hash[::-1].hex() for tx_in in split_tx.vin] == [f"{1:064x}"]
+    split_txid = split_tx.GetTxid()[::-1].hex()
+    for vout, txout in enumerate(split_tx.vout):
+        wallet.coins[(split_txid, vout)] = txout.nValue
+    # Each template is funded by its own coin of the split
+    used_coins = check_funded(wallet, tx_templates, 10)
+    assert used_coins == [(split_txid, 0), (split_txid, 1), (split_txid, 2)]
+    # The change of the split is available for the next funding
+    assert [(utxo.txid, utxo.vout) for utxo in utxo_manager.available] == [
+        (split_txid, 3)
+    ]
+
+
+def test_split_not_sent_if_rejected(dbsession):
+    wallet = StubWallet([1_000_000], rejected_methods=["testmempoolaccept"])
+    utxo_manager = WalletUTXOManager(wallet)
+    utxo_manager.refresh()
+    (coin,) = utxo_manager.available
+    with pytest.raises(funding.TestMempoolAcceptFailure):
+        _split_wallet_coins(
+            fundings=[
+                funding._Funding.prepare(
+                    tx_template=make_template(name),
+                    dbsession=dbsession,
+                    fee_rate_sat_per_vb=10,
+                )
+                for name in ["A", "B"]
+            ],
+            bitcoin_rpc=wallet,
+            utxo_manager=utxo_manager,
+        )
+    assert "sendrawtransaction" not in wallet.calls
+    assert utxo_manager.available == [coin]
@@ -0,0 +1,372 @@
+import asyncio
+import contextlib
+import queue
+import threading
+import time
+
+import pytest
+import sqlalchemy as sa
+
+from bitsnark.btc.rpc import ChainTip
+from bitsnark.core import listener_runtime
+from bitsnark.core.listener_runtime import Agent, ListenerRuntime, Stage
+from bitsnark.core.notifications import StatusChange
+
+
+class FakeListener:
+    "Stands in for StatusChangeListener"
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.broken = False
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def drain(self):
+        if self.broken:
+            raise OSError("Connection lost")
+        return []
+
+
+class FakeNotifications:
+    """
+    Stands in for wait_for_status_changes, delivering the changes passed to notify().
+    Returns nothing once closed, so that the runtime's waiting thread can finish.
+    """
+
+    def __init__(self):
+        self.pending = queue.Queue()
+        self.closed = threading.Event()
+        self.num_waits = 0
+        # Listeners of the current wait
+        self.waiting = []
+        # Connecting a listener to these fails
+        self.failing_engines = set()
+        self.listeners = []
+
+    def connect(self, engine):
+        "Stands in for creating a StatusChangeListener"
+        if engine in self.failing_engines:
+            raise OSError("Connection refused")
+        listener = FakeListener(engine)
+        self.listeners.append(listener)
+        return listener
+
+    def break_connection(self, engine):
+        for listener in self.listeners:
+            if listener.engine is engine:
+                listener.broken = True
+
+    def notify(self, engine, table):
+        self.pending.put((engine, StatusChange(table=table, id=1, status="READY")))
+
+    def __call__(self, listeners, timeout):
+        self.num_waits += 1
+        self.waiting = listeners
+        changes = {listener: [] for listener in listeners}
+        deadline = time.monotonic() + timeout
+        while not self.closed.is_set() and time.monotonic() < deadline:
+            if any(listener.broken for listener in listeners):
+                raise OSError("Connection lost")
+            try:
+                engine, change = self.pending.get(timeout=0.01)
+            except queue.Empty:
+                continue
+            for listener in listeners:
+                if listener.engine is engine:
+                    changes[listener].append(change)
+            return changes
+        return changes
+
+
+class FakeChainTipWatcher:
+    def __init__(self, notifications: FakeNotifications):
+        self._tip = ChainTip(hash="00", height=0)
+        self.blocks = queue.Queue()
+        self._closed = notifications.closed
+        self.node_down = False
+        self.num_waits = 0
+
+    @property
+    def tip(self):
+        if self.node_down:
+            raise ConnectionRefusedError("Node is down")
+        return self._tip
+
+    def mine(self):
+        self.blocks.put(None)
+
+    def wait(self, timeout):
+        self.num_waits += 1
+        while not self._closed.is_set():
+            try:
+                self.blocks.get(timeout=0.01)
+            except queue.Empty:
+                continue
+            self._tip = ChainTip(
+                hash=f"{self._tip.height + 1:02x}", height=self._tip.height + 1
+            )
+            return self._tip
+        return None
+
+
+class StageRuns:
+    "Records the passes of the stages, in order"
+
+    def __init__(self):
+        self.runs = []
+        self._lock = threading.Lock()
+
+    def stage(self, agent_id, name, *, before_run=None, **kwargs):
+        def run(dbsession):
+            if before_run is not None:
+                before_run()
+            with self._lock:
+                self.runs.append((agent_id, name, threading.current_thread().name))
+
+        return Stage(name=name, run=run, **kwargs)
+
+    def count(self, agent_id, name):
+        with self._lock:
+            return sum(1 for run in self.runs if run[:2] == (agent_id, name))
+
+
+@pytest.fixture()
+def notifications(monkeypatch):
+    notifications = FakeNotifications()
+    monkeypatch.setattr(listener_runtime, "StatusChangeListener", notifications.connect)
+    monkeypatch.setattr(listener_runtime, "wait_for_status_changes", notifications)
+    return notifications
+
+
+def make_agent(agent_id, stages):
+    return Agent(agent_id=agent_id, engine=sa.create_engine("sqlite://"), stages=stages)
+
+
+def run_runtime(runtime, notifications, scenario):
+    "Run the runtime while the scenario (a coroutine function) runs, then stop it"
+
+    async def main():
+        task = asyncio.create_task(runtime.run())
+        try:
+            await scenario()
+        finally:
+            notifications.closed.set()
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    asyncio.run(main())
+
+
+async def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        await asyncio.sleep(0.005)
+
+
+def test_stages_woken_by_their_tables_and_upstream(notifications):
+    stage_runs = StageRuns()
+    agent = make_agent(
+        "agent",
+        [
+            stage_runs.stage(
+                "agent", "sign", tables=("setups",), downstream=("broadcast",)
+            ),
+            stage_runs.stage("agent", "broadcast", tables=("templates",)),
+            stage_runs.stage("agent", "blocks", tables=(), on_new_block=True),
+        ],
+    )
+    chain_tip_watcher = FakeChainTipWatcher(notifications)
+    runtime = ListenerRuntime(
+        agents=[agent], poll_interval=60, chain_tip_watcher=chain_tip_watcher
+    )
+
+    async def scenario():
+        # Every stage runs on startup, and broadcast once more after sign
+        await wait_for(lambda: stage_runs.count("agent", "broadcast") == 2)
+        assert stage_runs.count("agent", "sign") == 1
+        assert stage_runs.count("agent", "blocks") == 1
+
+        notifications.notify(agent.engine, "templates")
+        await wait_for(lambda: stage_runs.count("agent", "broadcast") == 3)
+
+        notifications.notify(agent.engine, "setups")
+        await wait_for(lambda: stage_runs.count("agent", "broadcast") == 4)
+        assert stage_runs.count("agent", "sign") == 2
+
+        chain_tip_watcher.mine()
+        await wait_for(lambda: stage_runs.count("agent", "blocks") == 2)
+        await asyncio.sleep(0.05)
+        assert stage_runs.count("agent", "sign") == 2
+        assert stage_runs.count("agent", "broadcast") == 4
+
+    run_runtime(runtime, notifications, scenario)
+
+
+def test_node_down_at_startup(notifications):
+    stage_runs = StageRuns()
+    agent = make_agent(
+        "agent", [stage_runs.stage("agent", "blocks", tables=(), on_new_block=True)]
+    )
+    chain_tip_watcher = FakeChainTipWatcher(notifications)
+    chain_tip_watcher.node_down = True
+    runtime = ListenerRuntime(
+        agents=[agent], poll_interval=0.01, chain_tip_watcher=chain_tip_watcher
+    )
+
+    async def scenario():
+        # The stage runs on the poll meanwhile
+        await wait_for(lambda: stage_runs.count("agent", "blocks") >= 2)
+        assert chain_tip_watcher.num_waits == 0
+        chain_tip_watcher.node_down = False
+        await wait_for(lambda: chain_tip_watcher.num_waits > 0)
+
+    run_runtime(runtime, notifications, scenario)
+
+
+def test_wake_ups_while_busy_are_coalesced(notifications):
+    stage_runs = StageRuns()
+    started = threading.Event()
+    release = threading.Event()
+
+    def block_first_run():
+        if not started.is_set():
+            started.set()
+            release.wait(5)
+
+    agent = make_agent(
+        "agent", [stage_runs.stage("agent", "broadcast", before_run=block_first_run)]
+    )
+    runtime = ListenerRuntime(agents=[agent], poll_interval=60)
+
+    async def scenario():
+        await wait_for(started.is_set)
+        num_waits = notifications.num_waits
+        for _ in range(3):
+            notifications.notify(agent.engine, "templates")
+        # The watcher waits again only after waking the stage up for all the changes
+        await wait_for(lambda: notifications.num_waits >= num_waits + 3)
+        release.set()
+        await wait_for(lambda: stage_runs.count("agent", "broadcast") == 2)
+        await asyncio.sleep(0.05)
+        assert stage_runs.count("agent", "broadcast") == 2
+
+    run_runtime(runtime, notifications, scenario)
+
+
+def test_busy_agent_does_not_starve_others(notifications):
+    stage_runs = StageRuns()
+    # The busy agent's stage wakes itself up after every pass, so it always has a pass queued
+    busy = make_agent(
+        "busy",
+        [
+            stage_runs.stage(
+                "busy",
+                "work",
+                downstream=("work",),
+                before_run=lambda: time.sleep(0.02),
+            )
+        ],
+    )
+    idle = make_agent("idle", [stage_runs.stage("idle", "work")])
+    runtime = ListenerRuntime(agents=[busy, idle], poll_interval=60, max_workers=1)
+
+    async def scenario():
+        await wait_for(lambda: stage_runs.count("idle", "work") == 1)
+        await wait_for(lambda: stage_runs.count("busy", "work") >= 3)
+        for _ in range(3):
+            num_busy_runs = stage_runs.count("busy", "work")
+            num_idle_runs = stage_runs.count("idle", "work")
+            notifications.notify(idle.engine, "templates")
+            await wait_for(
+                lambda: stage_runs.count("idle", "work") == num_idle_runs + 1
+            )
+            # The idle agent's pass only waits for the busy agent's current and queued pass
+            assert stage_runs.count("busy", "work") <= num_busy_runs + 3
+
+    run_runtime(runtime, notifications, scenario)
+
+    # All passes ran in the shared pool of one thread
+    assert {thread_name for _, _, thread_name in stage_runs.runs} == {"listener_0"}
+
+
+def test_status_listener_reconnects(notifications, monkeypatch):
+    monkeypatch.setattr(listener_runtime, "RECONNECT_DELAY", 0.01)
+    stage_runs = StageRuns()
+    agent = make_agent("agent", [stage_runs.stage("agent", "broadcast")])
+    notifications.failing_engines.add(agent.engine)
+    runtime = ListenerRuntime(agents=[agent], poll_interval=60)
+
+    async def wait_until_listening(num_listeners):
+        await wait_for(
+            lambda: len(notifications.listeners) == num_listeners
+            and notifications.waiting == notifications.listeners[-1:]
+        )
+        # Let the wake-up of the (re)connection run
+        await asyncio.sleep(0.05)
+
+    async def check_notified():
+        num_runs = stage_runs.count("agent", "broadcast")
+        notifications.notify(agent.engine, "templates")
+        await wait_for(lambda: stage_runs.count("agent", "broadcast") == num_runs + 1)
+
+    async def scenario():
+        # The stage runs on the poll while the listener can't connect
+        await wait_for(lambda: stage_runs.count("agent", "broadcast") >= 2)
+        notifications.failing_engines.clear()
+        await wait_until_listening(1)
+        await check_notified()
+
+        num_runs = stage_runs.count("agent", "broadcast")
+        notifications.break_connection(agent.engine)
+        await wait_until_listening(2)
+        assert stage_runs.count("agent", "broadcast") > num_runs
+        await check_notified()
+
+    run_runtime(runtime, notifications, scenario)
+
+
+def test_failing_agent_db_does_not_stop_others(notifications, monkeypatch):
+    monkeypatch.setattr(listener_runtime, "RECONNECT_DELAY", 0.01)
+    stage_runs = StageRuns()
+    failing = make_agent("failing", [stage_runs.stage("failing", "broadcast")])
+    healthy = make_agent("healthy", [stage_runs.stage("healthy", "broadcast")])
+    runtime = ListenerRuntime(agents=[failing, healthy], poll_interval=60)
+
+    def get_waiting_engines():
+        return {listener.engine for listener in notifications.waiting}
+
+    async def scenario():
+        await wait_for(
+            lambda: get_waiting_engines() == {failing.engine, healthy.engine}
+        )
+        # The failing agent's DB goes away, and can't be reconnected to for now
+        notifications.failing_engines.add(failing.engine)
+        notifications.break_connection(failing.engine)
+        await wait_for(lambda: get_waiting_engines() == {healthy.engine})
+        for _ in range(3):
+            num_runs = stage_runs.count("healthy", "broadcast")
+            notifications.notify(healthy.engine, "templates")
+            await wait_for(
+                lambda: stage_runs.count("healthy", "broadcast") == num_runs + 1
+            )
+        # Meanwhile the failing agent's stage runs on each reconnection attempt
+        num_runs = stage_runs.count("failing", "broadcast")
+        await wait_for(lambda: stage_runs.count("failing", "broadcast") > num_runs)
+
+        notifications.failing_engines.clear()
+        await wait_for(
+            lambda: get_waiting_engines() == {failing.engine, healthy.engine}
+        )
+        await asyncio.sleep(0.05)
+        num_runs = stage_runs.count("failing", "broadcast")
+        notifications.notify(failing.engine, "templates")
+        await wait_for(lambda: stage_runs.count("failing", "broadcast") == num_runs + 1)
+
+    run_runtime(runtime, notifications, scenario)
@@ -0,0 +1,87 @@
+import datetime
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from bitsnark.core.models import (
+    OutgoingStatus,
+    TemplateSummary,
+    TransactionTemplate,
+    load_tx_templates,
+    select_template_summaries,
+)
+
+
+@pytest.fixture()
+def dbsession():
+    engine = sa.create_engine("sqlite://")
+    TransactionTemplate.__table__.create(engine)
+    with Session(engine) as dbsession:
+        yield dbsession
+
+
+def add_template(dbsession, name, ordinal):
+    tx_template = TransactionTemplate(
+        txid=f"{ordinal:064x}",
+        setup_id="setup",
+        name=name,
+        role="PROVER",
+        is_external=False,
+        unknown_txid=False,
+        fundable=False,
+        ordinal=ordinal,
+        inputs=[{"index": 0}],
+        outputs=[],
+        status=OutgoingStatus.READY,
+        updated_at=datetime.datetime(2024, 1, 1),
+    )
+    dbsession.add(tx_template)
+    return tx_template
+
+
+def test_summaries_and_full_templates(dbsession):
+    for ordinal, name in enumerate(["A", "B", "C"]):
+        add_template(dbsession, name, ordinal)
+    dbsession.commit()
+    dbsession.expunge_all()
+
+    summaries = [
+        TemplateSummary._make(row)
+        for row in dbsession.execute(
+            select_template_summaries().order_by(TransactionTemplate.ordinal.desc())
+        )
+    ]
+    assert [summary.name for summary in summaries] == ["C", "B", "A"]
+    assert summaries[0].status == OutgoingStatus.READY
+
+    statements = []
+    sa.event.listen(
+        dbsession.get_bind(),
+        "before_cursor_execute",
+        lambda *args: statements.append(args[2]),
+    )
+    tx_templates = load_tx_templates(dbsession, summaries)
+    assert [tx_template.name for tx_template in tx_templates] == ["C", "B", "A"]
+    assert tx_templates[0].inputs == [{"index": 0}]
+    assert tx_templates[0].funded is False
+    assert len(statements) == 1
+    assert load_tx_templates(dbsession, []) == []
+
+
+def test_templates_deleted_after_the_summaries_are_skipped(dbsession):
+    for ordinal, name in enumerate(["A", "B", "C"]):
+        add_template(dbsession, name, ordinal)
+    dbsession.commit()
+    summaries = dbsession.execute(
+        select_template_summaries().order_by(TransactionTemplate.ordinal)
+    ).all()
+
+    dbsession.execute(
+        sa.delete(TransactionTemplate).where(TransactionTemplate.name == "B")
+    )
+    dbsession.commit()
+    dbsession.expunge_all()
+
+    tx_templates = load_tx_templates(dbsession, summaries)
+    assert [tx_template.name for tx_template in tx_templates] == ["A", "C"]
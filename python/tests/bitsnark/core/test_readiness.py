@@ -0,0 +1,47 @@
+import datetime
+import itertools
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from bitsnark.core.models import Setups, SetupStatus
+from bitsnark.core.readiness import wait_for_setups_checked_height, wait_until
+
+
+def test_wait_until():
+    calls = itertools.count(1)
+    wait_until(lambda: next(calls) >= 3, timeout=5, poll_interval=0.001)
+    assert next(calls) == 4
+
+
+def test_wait_until_times_out():
+    with pytest.raises(TimeoutError, match="the thing"):
+        wait_until(lambda: False, timeout=0.01, description="the thing")
+
+
+def test_wait_for_setups_checked_height():
+    engine = sa.create_engine("sqlite://")
+    Setups.__table__.create(engine)
+    with Session(engine) as dbsession:
+        for setup_id, height in [("a", 5), ("b", 3), ("c", None)]:
+            dbsession.add(
+                Setups(
+                    id=setup_id,
+                    protocol_version="0.2",
+                    status=SetupStatus.SIGNED,
+                    last_checked_block_height=height,
+                    created_at=datetime.datetime(2024, 1, 1),
+                )
+            )
+        dbsession.commit()
+
+        assert wait_for_setups_checked_height(dbsession, 5, setup_ids=["a"]) == 5
+        assert wait_for_setups_checked_height(dbsession, 3, setup_ids=["a", "b"]) == 3
+        with pytest.raises(TimeoutError):
+            wait_for_setups_checked_height(
+                dbsession, 4, setup_ids=["a", "b"], timeout=0.01
+            )
+        # A setup that was never checked holds up waiting for all of them
+        with pytest.raises(TimeoutError):
+            wait_for_setups_checked_height(dbsession, 0, timeout=0.01)
@@ -0,0 +1,132 @@
+import random
+
+import pytest
+from bitcointx.core.script import (
+    CScript,
+    OP_0,
+    OP_1,
+    OP_2,
+    OP_3,
+    OP_2DROP,
+    OP_2OVER,
+    OP_CODESEPARATOR,
+    OP_DROP,
+    OP_DUP,
+    OP_EQUAL,
+    OP_EQUALVERIFY,
+    OP_OVER,
+    OP_PICK,
+    OP_ROLL,
+    OP_ROT,
+    OP_SWAP,
+    OP_TOALTSTACK,
+    OP_FROMALTSTACK,
+    OP_VERIFY,
+)
+
+from bitsnark.core.script_optimizer import (
+    InvalidRule,
+    PeepholeOptimizer,
+    Rule,
+    check_equivalent_by_eval,
+    check_rule,
+)
+
+
+@pytest.fixture(scope="module")
+def optimizer():
+    return PeepholeOptimizer()
+
+
+def test_rewrites(optimizer):
+    script = CScript(
+        [
+            OP_1,
+            OP_ROLL,
+            OP_3,
+            OP_PICK,
+            OP_3,
+            OP_PICK,
+            b"ab",
+            b"cd",
+            OP_SWAP,
+            OP_0,
+            OP_PICK,
+            OP_EQUAL,
+            OP_VERIFY,
+        ]
+    )
+    result = optimizer.optimize(script)
+    assert result.script == CScript(
+        [OP_SWAP, OP_2OVER, b"cd", b"ab", OP_DUP, OP_EQUALVERIFY]
+    )
+    assert result.savings == len(script) - len(result.script)
+    assert result.applied_rules["OP_0 OP_PICK -> OP_DUP"] == 1
+
+
+def test_rewrites_cascade(optimizer):
+    # 1 ROLL becomes SWAP, SWAP DROP becomes NIP, which leaves NIP DROP
+    script = CScript([OP_1, OP_ROLL, OP_DROP, OP_DROP])
+    assert optimizer.optimize(script).script == CScript([OP_2DROP])
+
+
+def test_codeseparator_not_optimized(optimizer):
+    script = CScript([OP_1, OP_ROLL, OP_CODESEPARATOR])
+    assert optimizer.optimize(script).script == script
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        # Copies the 3rd and 2nd items, but OP_2OVER copies the 4th and 3rd
+        "OP_2 OP_PICK OP_2 OP_PICK -> OP_2OVER",
+        # Needs only one item, OP_2DUP needs two
+        "OP_DUP OP_DUP -> OP_2DUP",
+        "OP_OVER OP_SWAP -> OP_TUCK",
+        # Would succeed where the pattern fails, with too few items
+        "OP_DUP OP_DROP ->",
+        "OP_SWAP OP_SWAP ->",
+        "OP_0 OP_ROLL ->",
+        "OP_TOALTSTACK OP_FROMALTSTACK ->",
+        # Not smaller
+        "OP_SWAP -> OP_1 OP_ROLL",
+        # Not supported by the model
+        "OP_IF OP_ENDIF ->",
+        "<a> OP_PICK -> <a> OP_PICK",
+        "OP_FOO ->",
+    ],
+)
+def test_invalid_rules_rejected(text):
+    with pytest.raises(InvalidRule):
+        check_rule(Rule.parse(text))
+
+
+def test_random_scripts_evaluate_the_same(optimizer):
+    rng = random.Random(1)
+    ops = [
+        OP_0,
+        OP_1,
+        OP_2,
+        OP_3,
+        OP_DUP,
+        OP_DROP,
+        OP_OVER,
+        OP_PICK,
+        OP_ROLL,
+        OP_ROT,
+        OP_SWAP,
+        OP_TOALTSTACK,
+        OP_FROMALTSTACK,
+        b"xy",
+    ]
+    # Also too short stacks, where the scripts fail
+    witness_stacks = [
+        [bytes([i]) * (i + 1) for i in range(depth)] for depth in (0, 1, 2, 3, 8)
+    ]
+    num_optimized = 0
+    for _ in range(200):
+        script = CScript(rng.choice(ops) for _ in range(12))
+        optimized = optimizer.optimize(script).script
+        num_optimized += optimized != script
+        assert check_equivalent_by_eval(script, optimized, witness_stacks) == []
+    assert num_optimized > 0
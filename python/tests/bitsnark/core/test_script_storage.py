@@ -0,0 +1,107 @@
+import datetime
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from bitsnark.core.models import (
+    OutgoingStatus,
+    Script,
+    TransactionTemplate,
+    has_script,
+)
+from bitsnark.core.parsing import serialize_hex
+from bitsnark.core.script_storage import compact_setup_scripts, get_script_hash
+
+SCRIPT = bytes.fromhex("51" * 40)
+OTHER_SCRIPT = bytes.fromhex("52" * 40)
+CONTROL_BLOCK = bytes.fromhex("c0" + "01" * 32)
+
+
+@pytest.fixture()
+def dbsession():
+    engine = sa.create_engine("sqlite://")
+    TransactionTemplate.__table__.create(engine)
+    Script.__table__.create(engine)
+    with Session(engine) as dbsession:
+        yield dbsession
+
+
+def add_template(dbsession, name, ordinal, setup_id="setup"):
+    tx_template = TransactionTemplate(
+        txid=f"{ordinal:064x}",
+        setup_id=setup_id,
+        name=name,
+        role="PROVER",
+        is_external=False,
+        unknown_txid=False,
+        fundable=False,
+        ordinal=ordinal,
+        inputs=[
+            {
+                "index": 0,
+                "script": serialize_hex(SCRIPT),
+                "controlBlock": serialize_hex(CONTROL_BLOCK),
+            }
+        ],
+        outputs=[
+            {
+                "index": 0,
+                "spendingConditions": [
+                    {"script": serialize_hex(SCRIPT)},
+                    {"timeoutBlocks": 5},
+                ],
+            }
+        ],
+        status=OutgoingStatus.READY,
+        updated_at=datetime.datetime(2024, 1, 1),
+    )
+    dbsession.add(tx_template)
+    return tx_template
+
+
+def test_compact_and_load_scripts(dbsession):
+    for i, name in enumerate("AB"):
+        add_template(dbsession, name, i)
+    other_setup_template = add_template(dbsession, "A", 2, setup_id="other")
+    other_setup_template.inputs[0]["script"] = serialize_hex(OTHER_SCRIPT)
+    dbsession.flush()
+
+    assert compact_setup_scripts(dbsession=dbsession, setup_id="setup") == 6
+    # Compacting again moves nothing
+    assert compact_setup_scripts(dbsession=dbsession, setup_id="setup") == 0
+    assert compact_setup_scripts(dbsession=dbsession, setup_id="other") == 3
+    dbsession.commit()
+    dbsession.expunge_all()
+
+    # Identical scripts are only stored once
+    assert dbsession.scalar(sa.select(sa.func.count()).select_from(Script)) == 3
+    for tx_template in dbsession.scalars(sa.select(TransactionTemplate)):
+        inp = tx_template.inputs[0]
+        spending_condition, timeout_condition = tx_template.outputs[0][
+            "spendingConditions"
+        ]
+        assert "script" not in inp
+        assert has_script(inp)
+        assert has_script(inp, "controlBlock")
+        assert not has_script(timeout_condition)
+        expected_script = SCRIPT if tx_template.setup_id == "setup" else OTHER_SCRIPT
+        assert tx_template.load_script(inp) == expected_script
+        assert tx_template.load_script(inp, "controlBlock") == CONTROL_BLOCK
+        assert tx_template.load_script(spending_condition) == SCRIPT
+        assert tx_template.load_script(timeout_condition) is None
+
+
+def test_load_inline_and_missing_scripts(dbsession):
+    tx_template = add_template(dbsession, "A", 0)
+    dbsession.flush()
+    assert tx_template.load_script(tx_template.inputs[0]) == SCRIPT
+
+    missing = {"scriptHash": serialize_hex(get_script_hash(OTHER_SCRIPT))}
+    assert has_script(missing)
+    with pytest.raises(LookupError):
+        tx_template.load_script(missing)
+
+    dbsession.expunge(tx_template)
+    with pytest.raises(ValueError):
+        tx_template.load_script(missing)
@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+
+from bitsnark.core import script_test_cache
+from bitsnark.core.script_test_cache import ScriptTestCache, get_test_case_key
+
+
+def make_test_case(script=b"\x51", witness_elems=(b"\x01\x02", 3), role="PROVER"):
+    return SimpleNamespace(
+        script=script,
+        witness_elems=list(witness_elems),
+        role=role,
+        timeout_blocks=None,
+    )
+
+
+def test_key_changes_with_inputs():
+    key = get_test_case_key(make_test_case(), flags={"offline": True})
+    assert key == get_test_case_key(make_test_case(), flags={"offline": True})
+    assert key != get_test_case_key(make_test_case(), flags={"offline": False})
+    assert key != get_test_case_key(
+        make_test_case(script=b"\x52"), flags={"offline": True}
+    )
+    assert key != get_test_case_key(
+        make_test_case(witness_elems=[b"\x01\x02", 4]), flags={"offline": True}
+    )
+    assert key != get_test_case_key(
+        make_test_case(role="VERIFIER"), flags={"offline": True}
+    )
+
+
+def test_key_changes_with_versions(monkeypatch):
+    key = get_test_case_key(make_test_case(), flags={})
+    monkeypatch.setattr(
+        script_test_cache, "CACHE_VERSION", script_test_cache.CACHE_VERSION + 1
+    )
+    assert key != get_test_case_key(make_test_case(), flags={})
+    monkeypatch.undo()
+    monkeypatch.setattr(script_test_cache, "get_evaluator_hash", lambda: "0" * 64)
+    assert key != get_test_case_key(make_test_case(), flags={})
+
+
+def test_persisted(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    with ScriptTestCache(path) as cache:
+        assert cache.get_many(["a", "b"]) == {}
+        cache.put_many([("a", "tx/0/0", 0.5, 100)])
+    with ScriptTestCache(path) as cache:
+        assert cache.get_many(["a", "b"]) == {
+            "a": {"duration": 0.5, "witness_size": 100}
+        }
@@ -0,0 +1,110 @@
+import datetime
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from bitsnark.core.models import OutgoingStatus, Received, TransactionTemplate
+from bitsnark.core.timelocks import (
+    get_confirmation_deadline_height,
+    get_timelock_maturity_height,
+    is_timelock_mature,
+)
+
+
+@pytest.fixture()
+def dbsession():
+    engine = sa.create_engine("sqlite://")
+    TransactionTemplate.__table__.create(engine)
+    Received.__table__.create(engine)
+    with Session(engine) as dbsession:
+        yield dbsession
+
+
+def add_template(dbsession, name, ordinal, *, inputs=(), outputs=()):
+    tx_template = TransactionTemplate(
+        txid=f"{ordinal:064x}",
+        setup_id="setup",
+        name=name,
+        role="PROVER",
+        is_external=False,
+        unknown_txid=False,
+        fundable=False,
+        ordinal=ordinal,
+        inputs=list(inputs),
+        outputs=list(outputs),
+        status=OutgoingStatus.READY,
+        updated_at=datetime.datetime(2024, 1, 1),
+    )
+    dbsession.add(tx_template)
+    dbsession.flush()
+    return tx_template
+
+
+def spend(template_name, spending_condition_index):
+    return {
+        "index": 0,
+        "templateName": template_name,
+        "outputIndex": 0,
+        "spendingConditionIndex": spending_condition_index,
+    }
+
+
+@pytest.fixture()
+def parent(dbsession):
+    parent = add_template(
+        dbsession,
+        "PARENT",
+        0,
+        outputs=[{"index": 0, "spendingConditions": [{}, {"timeoutBlocks": 10}]}],
+    )
+    dbsession.add(
+        Received(
+            template_id=parent.id,
+            txid=parent.txid,
+            block_hash="00" * 32,
+            block_height=100,
+            index_in_block=1,
+            detected_at=datetime.datetime(2024, 1, 1),
+        )
+    )
+    dbsession.flush()
+    return parent
+
+
+def test_timelocks(dbsession, parent):
+    timelocked = add_template(dbsession, "TIMELOCKED", 1, inputs=[spend("PARENT", 1)])
+    assert (
+        get_timelock_maturity_height(dbsession=dbsession, tx_template=timelocked) == 110
+    )
+    assert not is_timelock_mature(
+        dbsession=dbsession, tx_template=timelocked, tip_height=108
+    )
+    assert is_timelock_mature(
+        dbsession=dbsession, tx_template=timelocked, tip_height=109
+    )
+
+    competing = add_template(dbsession, "COMPETING", 2, inputs=[spend("PARENT", 0)])
+    assert get_timelock_maturity_height(dbsession=dbsession, tx_template=competing) == 0
+    assert (
+        get_confirmation_deadline_height(dbsession=dbsession, tx_template=competing)
+        == 109
+    )
+
+
+def test_missing_parent(dbsession, parent):
+    tx_template = add_template(
+        dbsession, "ORPHAN", 1, inputs=[spend("PARENT", 0), spend("MISSING", 1)]
+    )
+    assert (
+        get_timelock_maturity_height(dbsession=dbsession, tx_template=tx_template)
+        is None
+    )
+    assert not is_timelock_mature(
+        dbsession=dbsession, tx_template=tx_template, tip_height=1000
+    )
+    # The deadline of the input that is found still counts
+    assert (
+        get_confirmation_deadline_height(dbsession=dbsession, tx_template=tx_template)
+        == 109
+    )
@@ -0,0 +1,127 @@
+import pytest
+from bitcointx.core import CMutableTransaction, COutPoint, CTxIn, CTxOut
+from bitcointx.core.key import CKey, XOnlyPubKey
+from bitcointx.core.script import (
+    CScript,
+    OP_1,
+    OP_CHECKSIG,
+    OP_CODESEPARATOR,
+    SIGHASH_ALL,
+)
+from bitcointx.core.scripteval import VerifyScriptError
+from bitcointx.core.secp256k1 import get_secp256k1
+
+from bitsnark.scripteval import eval_tapscript
+
+
+def _has_secp256k1() -> bool:
+    try:
+        get_secp256k1()
+    except ImportError:
+        return False
+    return True
+
+
+needs_secp256k1 = pytest.mark.skipif(
+    not _has_secp256k1(), reason="libsecp256k1 is not installed"
+)
+
+SPENT_OUTPUTS = [CTxOut(100_000, CScript([OP_1, b"\x01" * 32]))]
+
+
+def make_spending_tx():
+    return CMutableTransaction(
+        [CTxIn(COutPoint(b"\x02" * 32, 0))],
+        [CTxOut(90_000, CScript([OP_1, b"\x03" * 32]))],
+    )
+
+
+def sign(key, script, tx, *, codeseparator_pos=-1, hashtype=None):
+    sighash = script.sighash_schnorr(
+        tx,
+        0,
+        spent_outputs=SPENT_OUTPUTS,
+        hashtype=hashtype,
+        codeseparator_pos=codeseparator_pos,
+    )
+    sig = key.sign_schnorr_no_tweak(sighash)
+    return sig if hashtype is None else sig + bytes([hashtype])
+
+
+def eval_checksig(script, sig, tx, spent_outputs=SPENT_OUTPUTS):
+    return eval_tapscript(
+        witness_elems=[sig],
+        script=script,
+        txTo=tx,
+        inIdx=0,
+        spent_outputs=spent_outputs,
+        verify_stack=False,
+    )
+
+
+def test_empty_signature_fails_the_check():
+    script = CScript([b"\x04" * 32, OP_CHECKSIG])
+    (result,) = eval_checksig(script, b"", make_spending_tx())
+    assert not any(result)
+
+
+def test_empty_public_key_fails_the_script():
+    script = CScript([b"", OP_CHECKSIG])
+    with pytest.raises(VerifyScriptError, match="empty public key"):
+        eval_checksig(script, b"\x05" * 64, make_spending_tx())
+
+
+def test_unknown_public_key_type_succeeds():
+    # Left for soft forks
+    script = CScript([b"\x04" * 33, OP_CHECKSIG])
+    assert eval_checksig(script, b"\x05" * 64, make_spending_tx()) == [b"\x01"]
+
+
+def test_invalid_signature_size_fails_the_script():
+    script = CScript([b"\x04" * 32, OP_CHECKSIG])
+    with pytest.raises(VerifyScriptError, match="size"):
+        eval_checksig(script, b"\x05" * 63, make_spending_tx())
+
+
+@needs_secp256k1
+@pytest.mark.parametrize("hashtype", [None, SIGHASH_ALL])
+def test_valid_signature(hashtype):
+    key = CKey.from_secret_bytes(b"\x06" * 32)
+    script = CScript([XOnlyPubKey(key.pub), OP_CHECKSIG])
+    tx = make_spending_tx()
+    sig = sign(key, script, tx, hashtype=hashtype)
+    assert eval_checksig(script, sig, tx) == [b"\x01"]
+
+
+@needs_secp256k1
+def test_invalid_signature_fails_the_script():
+    key = CKey.from_secret_bytes(b"\x06" * 32)
+    script = CScript([XOnlyPubKey(key.pub), OP_CHECKSIG])
+    tx = make_spending_tx()
+    sig = sign(key, script, tx)
+    with pytest.raises(VerifyScriptError, match="invalid Schnorr signature"):
+        eval_checksig(script, bytes([sig[0] ^ 1]) + sig[1:], tx)
+    # The signature hash commits to the spent outputs
+    with pytest.raises(VerifyScriptError, match="invalid Schnorr signature"):
+        eval_checksig(
+            script,
+            sig,
+            tx,
+            spent_outputs=[CTxOut(100_001, SPENT_OUTPUTS[0].scriptPubKey)],
+        )
+
+
+@needs_secp256k1
+def test_signature_commits_to_codeseparator_position():
+    key = CKey.from_secret_bytes(b"\x06" * 32)
+    # The OP_CODESEPARATOR is the opcode at position 0
+    script = CScript([OP_CODESEPARATOR, XOnlyPubKey(key.pub), OP_CHECKSIG])
+    tx = make_spending_tx()
+    assert eval_checksig(script, sign(key, script, tx, codeseparator_pos=0), tx) == [
+        b"\x01"
+    ]
+    for wrong_pos in [-1, 1]:
+        with pytest.raises(VerifyScriptError, match="invalid Schnorr signature"):
+            eval_checksig(
+                script, sign(key, script, tx, codeseparator_pos=wrong_pos), tx
+            )
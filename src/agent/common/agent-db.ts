@@ -69,6 +69,34 @@ export const templateFields = [
     'protocol_data'
 ];
 
+// The signatures made by the python signer are stored in the signatures table, so that signing doesn't
+// rewrite the (large) inputs JSON. They are merged into the inputs when the templates are read, and
+// deleted when the inputs are rewritten (by then the inputs contain them, or they are stale).
+const inputsWithSignatures = `COALESCE(
+    (
+        SELECT jsonb_agg(
+            e.elem || COALESCE(
+                (
+                    SELECT jsonb_object_agg(
+                        CASE s.role WHEN 'prover' THEN 'proverSignature' ELSE 'verifierSignature' END,
+                        s.signature
+                    )
+                    FROM signatures AS s
+                    WHERE s.setup_id = templates.setup_id
+                    AND s.template_name = templates.name
+                    AND s.input_index = e.idx - 1
+                ),
+                '{}'::jsonb
+            )
+            ORDER BY e.idx
+        )
+        FROM jsonb_array_elements(templates.inputs) WITH ORDINALITY AS e(elem, idx)
+    ),
+    templates.inputs
+) AS inputs`;
+
+const templateSelectFields = templateFields.map((name) => (name == 'inputs' ? inputsWithSignatures : name));
+
 function toCap(s: string): string {
     return s.length > 0 ? s.split('')[0].toUpperCase() + s.split('').slice(1).join('') : '';
 }
@@ -204,7 +232,7 @@ export class AgentDb extends Db {
     public async getTemplate(setupId: string, templateName: string): Promise<Template> {
         const rows = (
             await this.query<Template>(
-                `SELECT ${templateFields.join(', ')}
+                `SELECT ${templateSelectFields.join(', ')}
                     FROM templates WHERE setup_id = $1 AND name = $2`,
                 [setupId, templateName]
             )
@@ -217,7 +245,7 @@ export class AgentDb extends Db {
     public async getTemplates(setupId: string): Promise<Template[]> {
         const rows = (
             await this.query<Template>(
-                `SELECT ${templateFields.join(', ')}
+                `SELECT ${templateSelectFields.join(', ')}
                     FROM templates WHERE setup_id = $1
                     ORDER BY ordinal ASC`,
                 [setupId]
@@ -255,6 +283,10 @@ export class AgentDb extends Db {
                 template.name,
                 ...objToRow(fields, template)
             ]);
+            await this.query(`DELETE FROM signatures WHERE setup_id = $1 AND template_name = $2`, [
+                setupId,
+                template.name
+            ]);
         }
     }
 